@@ -33,7 +33,87 @@ class Settings(BaseSettings):
     MONGO_PASSWORD: str
     MONGO_DATABASE: str = 'main'
     MONGO_URI: str
+    # Mongo client pool and timeouts (see app.database.client). None keeps the driver default.
+    # Size the pool to the requests one uvicorn worker runs concurrently: every worker has its own pool.
+    MONGO_MAX_POOL_SIZE: int = 100
+    MONGO_MIN_POOL_SIZE: int = 0
+    MONGO_MAX_IDLE_TIME_MS: Optional[int] = None
+    # How long a request waits for a free pooled connection before failing.
+    MONGO_WAIT_QUEUE_TIMEOUT_MS: Optional[int] = None
+    MONGO_SERVER_SELECTION_TIMEOUT_MS: Optional[int] = None
+    MONGO_CONNECT_TIMEOUT_MS: Optional[int] = None
+    MONGO_SOCKET_TIMEOUT_MS: Optional[int] = None
+    # Wire compression, in order of preference, e.g. 'zstd,snappy,zlib' (zstd and snappy need their
+    # python packages). Empty = no compression.
+    MONGO_COMPRESSORS: str = ''
     KEY_HASH: str
+    # How patient records are written: 'envelope' (one sealed blob) or 'leaf' (legacy per-field).
+    # Both formats are always readable.
+    RECORD_ENCRYPTION_FORMAT: str = 'envelope'
+
+    @validator("RECORD_ENCRYPTION_FORMAT")
+    def check_record_encryption_format(cls, v: str) -> str:
+        if v not in ('envelope', 'leaf'):
+            raise ValueError(v)
+        return v
+
+    # Library reading lab slip form fields: 'pypdf2' or 'pymupdf' (faster on large forms, same output).
+    PDF_FORM_BACKEND: str = 'pypdf2'
+
+    @validator("PDF_FORM_BACKEND")
+    def check_pdf_form_backend(cls, v: str) -> str:
+        if v not in ('pypdf2', 'pymupdf'):
+            raise ValueError(v)
+        return v
+
+    # Worker processes for CPU-bound work (bulk decryption, ...). 0 = one per CPU.
+    PROCESS_POOL_WORKERS: int = 0
+    # Patient lists up to this size are decrypted inline; larger ones go to the process pool.
+    BULK_DECRYPT_INLINE_MAX: int = 100
+    BULK_DECRYPT_CHUNK_SIZE: int = 250
+    # Patients fetched, decrypted and sent per batch by GET /api/patients/stream.
+    PATIENT_STREAM_BATCH_SIZE: int = 200
+    # Longest date range (in days) translated into a date bucket lookup; longer ranges scan.
+    DATE_BUCKET_MAX_DAYS: int = 366
+    # PDF parsing and OCR run on their own process pool. DOCUMENT_MAX_JOBS jobs (0 = one per worker)
+    # are admitted at once; others wait up to DOCUMENT_ADMISSION_TIMEOUT_S for a slot, then get a 503.
+    DOCUMENT_POOL_WORKERS: int = 2
+    DOCUMENT_MAX_JOBS: int = 0
+    DOCUMENT_ADMISSION_TIMEOUT_S: float = 10
+    # Longest a single document (PDF parse or OCR) may take; also passed to tesseract.
+    DOCUMENT_JOB_TIMEOUT_S: float = 60
+    # Results PDF pages with at least this many letters and digits in their text layer are read without OCR.
+    TEXT_LAYER_MIN_CHARS: int = 20
+    # Results PDFs with more pages are rejected. At most DOCUMENT_MAX_PAGE_JOBS pages of one PDF are OCR'd
+    # at once (0 = half the document job slots, at least one), so one long scan can't take every slot.
+    RESULT_MAX_PAGES: int = 50
+    DOCUMENT_MAX_PAGE_JOBS: int = 0
+    # Layout template (app.utils.images.templates) whose regions are OCR'd instead of whole result pages.
+    # Empty = always OCR whole pages. Off by default: the AK State boxes aren't calibrated against real scans yet.
+    RESULT_OCR_TEMPLATE: str = ''
+
+    @validator("RESULT_OCR_TEMPLATE")
+    def check_result_ocr_template(cls, v: str) -> str:
+        if v not in ('', 'ak_state'):
+            raise ValueError(v)
+        return v
+
+    # OCR'd PIDs are matched against known ones (app.database.pid_index): up to PID_MATCH_CANDIDATES,
+    # within PID_MATCH_MAX_COST (look-alike characters cost 0.5, other edits 1) and PID_MATCH_MAX_EDITS
+    # edits other than look-alikes.
+    PID_MATCH_CANDIDATES: int = 5
+    PID_MATCH_MAX_COST: float = 2.0
+    PID_MATCH_MAX_EDITS: int = 1
+
+    # Batch lab slip uploads: most files (zip members included) and bytes (once unzipped) per request,
+    # and files per process pool job.
+    BATCH_UPLOAD_MAX_FILES: int = 1000
+    BATCH_UPLOAD_MAX_BYTES: int = 512 * 1024 * 1024
+    BATCH_UPLOAD_CHUNK_SIZE: int = 8
+    # Days the upload ledger remembers a file, so a re-upload of it is recognized without reprocessing.
+    UPLOAD_LEDGER_TTL_DAYS: int = 30
+    # Times a patient write is re-read and retried after losing a race to a concurrent write.
+    PATIENT_WRITE_RETRIES: int = 5
 
     SIGNALWIRE_DOMAIN: str
     SIGNALWIRE_ACCESS_TOKEN: str
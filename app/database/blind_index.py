@@ -0,0 +1,134 @@
+'''
+Blind index: keyed, deterministic tokens for selected encrypted fields.
+
+Tokens are HMAC-SHA256(field:value) under a key derived (HKDF) from the master key,
+stored in plaintext under BLIND_INDEX_FIELD so equality queries on encrypted fields
+can be answered by Mongo (and its indexes) without decrypting anything.
+'''
+import hashlib
+import hmac
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Any, Dict, List, Tuple, Union
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from app.core.config import settings
+from app.utils.datetimes import to_dt
+
+BLIND_INDEX_FIELD = 'blind_index'
+# Bump when the set of tokens changes, so migrations know which documents to re-encrypt.
+BLIND_INDEX_VERSION = 2
+VERSION_KEY = '_v'
+
+# Query field -> path in the patient record. A path through 'test_results'
+# yields one token per test.
+BLIND_INDEX_FIELDS: Dict[str, Tuple[str, ...]] = {
+    'last_name': ('last_name',),
+    'dob': ('dob',),
+    'gender': ('gender',),
+    'zip': ('physical_address', 'zip'),
+    'positive': ('test_results', 'positive'),
+}
+
+# Coarse (one per UTC day) tokens for datetime fields, so date ranges can be
+# translated into an $in over the days they cover.
+DATE_BUCKET_FIELDS: Dict[str, Tuple[str, ...]] = {
+    'collection_day': ('test_results', 'lab_slip_collection_datetime'),
+}
+
+# Documents without tokens at the current version (not migrated yet, or indexed by an
+# older version). Token lookups can't tell whether they match.
+NOT_INDEXED = {f'{BLIND_INDEX_FIELD}.{VERSION_KEY}': {'$ne': BLIND_INDEX_VERSION}}
+
+
+@lru_cache(maxsize=8)
+def derive_key(master_key: bytes, purpose: bytes) -> bytes:
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=purpose).derive(master_key)
+
+
+def blind_token(field: str, value: Any, master_key: bytes) -> str:
+    key = derive_key(master_key, b'camai-blind-index')
+    return hmac.new(key, f'{field}:{value}'.encode('utf8'), hashlib.sha256).hexdigest()
+
+
+def _values_at(record: Any, path: Tuple[str, ...]) -> list:
+    if not path:
+        return [record]
+    if isinstance(record, list):
+        return [v for i in record for v in _values_at(i, path)]
+    if isinstance(record, dict):
+        return _values_at(record.get(path[0]), path[1:])
+    return []
+
+
+def day_bucket(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).date().isoformat()
+
+
+def blind_index_tokens(record: dict, master_key: bytes) -> Dict[str, Union[int, str, List[str]]]:
+    tokens = {VERSION_KEY: BLIND_INDEX_VERSION}
+    for field, path in BLIND_INDEX_FIELDS.items():
+        values = [v for v in _values_at(record, path) if v is not None and v != '']
+        if 'test_results' in path:
+            tokens[field] = sorted({blind_token(field, v, master_key) for v in values})
+        elif values:
+            tokens[field] = blind_token(field, values[0], master_key)
+    for field, path in DATE_BUCKET_FIELDS.items():
+        dts = [to_dt(v) for v in _values_at(record, path) if v]
+        tokens[field] = sorted({blind_token(field, day_bucket(dt), master_key) for dt in dts if dt})
+    return tokens
+
+
+def tokens_for_test(test: dict, master_key: bytes) -> Dict[str, List[str]]:
+    '''
+    The per-test blind index tokens (fields under test_results) contributed by a single test.
+    '''
+    tokens = blind_index_tokens({'test_results': [test]}, master_key=master_key)
+    return {k: v for k, v in tokens.items() if isinstance(v, list) and v}
+
+
+def or_not_indexed(token_query: dict) -> dict:
+    '''
+    Widens a token lookup to also return NOT_INDEXED documents, which then have to be
+    filtered after decryption. Returns {} (no pushdown) for an empty lookup.
+    '''
+    return {'$or': [token_query, NOT_INDEXED]} if token_query else {}
+
+
+def all_of(*queries: dict) -> dict:
+    '''
+    Combines Mongo queries with $and, leaving out empty ones.
+    '''
+    queries = [q for q in queries if q]
+    if len(queries) < 2:
+        return queries[0] if queries else {}
+    return {'$and': queries}
+
+
+def blind_index_query(query: dict, master_key: bytes) -> dict:
+    '''
+    Translates equality filters on blind-indexed fields into token lookups.
+    Other fields are ignored. Matching on 'positive' is per patient (any test),
+    and NOT_INDEXED documents are always returned, so row-level filters still
+    need to be applied after decryption.
+    '''
+    return or_not_indexed({f'{BLIND_INDEX_FIELD}.{k}': blind_token(k, v, master_key)
+                           for k, v in query.items() if k in BLIND_INDEX_FIELDS})
+
+
+def date_range_query(field: str, start: datetime, end: datetime, master_key: bytes) -> dict:
+    '''
+    Translates a (UTC) datetime range on a date-bucketed field into an $in over its day tokens.
+    Returns {} (no pushdown) for ranges longer than settings.DATE_BUCKET_MAX_DAYS.
+    Buckets are whole days, and NOT_INDEXED documents are always returned,
+    so exact filtering still has to happen after decryption.
+    '''
+    start_day = start.astimezone(timezone.utc).date()
+    end_day = end.astimezone(timezone.utc).date()
+    n_days = (end_day - start_day).days + 1
+    if n_days < 1 or n_days > settings.DATE_BUCKET_MAX_DAYS:
+        return {}
+    tokens = [blind_token(field, (start_day + timedelta(days=i)).isoformat(), master_key) for i in range(n_days)]
+    return or_not_indexed({f'{BLIND_INDEX_FIELD}.{field}': {'$in': tokens}})
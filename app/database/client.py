@@ -0,0 +1,157 @@
+'''
+The application's Mongo client: opened on startup and closed on shutdown (see app.main),
+configured from settings, with connection pool statistics.
+'''
+import threading
+import time
+from typing import Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import monitoring
+
+from app.core.config import settings
+
+_MONGO_CLIENT: Optional[AsyncIOMotorClient] = None
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    '''
+    Connection pool counters, fed by pymongo's pool events.
+    A checkout's wait is the time between asking the pool for a connection and getting one;
+    both events fire on the (executor) thread doing the checkout, so the start is kept per thread.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connections_open = 0
+            self.checked_out = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.waiting = 0
+            self.total_wait = 0.0
+            self.max_wait = 0.0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'connections_open': self.connections_open,
+                'checked_out': self.checked_out,
+                'waiting': self.waiting,
+                'checkouts': self.checkouts,
+                'checkout_failures': self.checkout_failures,
+                'mean_wait_ms': 1000 * self.total_wait / self.checkouts if self.checkouts else 0.0,
+                'max_wait_ms': 1000 * self.max_wait,
+                'max_pool_size': settings.MONGO_MAX_POOL_SIZE,
+                'min_pool_size': settings.MONGO_MIN_POOL_SIZE,
+            }
+
+    def _checkout_ended(self) -> float:
+        started = getattr(self._started, 'at', None)
+        self._started.at = None
+        self.waiting -= 1
+        return time.perf_counter() - started if started is not None else 0.0
+
+    def connection_check_out_started(self, event):
+        self._started.at = time.perf_counter()
+        with self._lock:
+            self.waiting += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            wait = self._checkout_ended()
+            self.checkouts += 1
+            self.checked_out += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self._checkout_ended()
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections_open += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections_open -= 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+POOL_STATS = PoolStats()
+
+
+def mongo_client_options() -> dict:
+    '''
+    Client keyword arguments from settings; unset (None / empty) settings keep the driver defaults.
+    '''
+    options = {
+        'maxPoolSize': settings.MONGO_MAX_POOL_SIZE,
+        'minPoolSize': settings.MONGO_MIN_POOL_SIZE,
+        'maxIdleTimeMS': settings.MONGO_MAX_IDLE_TIME_MS,
+        'waitQueueTimeoutMS': settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        'serverSelectionTimeoutMS': settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        'connectTimeoutMS': settings.MONGO_CONNECT_TIMEOUT_MS,
+        'socketTimeoutMS': settings.MONGO_SOCKET_TIMEOUT_MS,
+        'compressors': settings.MONGO_COMPRESSORS,
+    }
+    options = {k: v for k, v in options.items() if v is not None and v != ''}
+    options['event_listeners'] = [POOL_STATS]
+    return options
+
+
+def open_mongo_client() -> AsyncIOMotorClient:
+    '''
+    Creates the client (on startup); a no-op if it is already open.
+    '''
+    global _MONGO_CLIENT
+    if _MONGO_CLIENT is None:
+        _MONGO_CLIENT = AsyncIOMotorClient(settings.MONGO_URI, **mongo_client_options())
+    return _MONGO_CLIENT
+
+
+def close_mongo_client():
+    global _MONGO_CLIENT
+    if _MONGO_CLIENT is not None:
+        _MONGO_CLIENT.close()
+        _MONGO_CLIENT = None
+        POOL_STATS.reset()
+
+
+def get_mongo_client() -> AsyncIOMotorClient:
+    '''
+    The open client. Outside of the app (scripts, tests) it is opened on first use.
+    Also usable as a route dependency: Depends(get_mongo_client).
+    '''
+    return _MONGO_CLIENT or open_mongo_client()
+
+
+def get_database() -> AsyncIOMotorDatabase:
+    '''
+    Route dependency: Depends(get_database).
+    '''
+    return get_mongo_client().get_database(settings.MONGO_DATABASE)
@@ -0,0 +1,41 @@
+from typing import Awaitable, Callable
+
+from pymongo import ReturnDocument
+
+from app.database.patient import get_patient_collection
+
+'''
+Atomic counters (one document per name in the "counters" collection), used to hand
+out PID suffixes and email aliases in a single operation, without racing other uploads.
+Counter names are built from hashes, never from plaintext identifiers.
+'''
+
+
+async def get_counter_collection():
+    _, database, _ = await get_patient_collection()
+    return database.get_collection('counters')
+
+
+async def next_sequence(name: str, step: int = 1) -> int:
+    '''
+    Atomically increments counter name by step (creating it at 0 first if needed),
+    and returns the new value.
+    '''
+    collection = await get_counter_collection()
+    counter = await collection.find_one_and_update({'_id': name},
+                                                   {'$inc': {'seq': step}},
+                                                   upsert=True,
+                                                   return_document=ReturnDocument.AFTER)
+    return counter['seq']
+
+
+async def next_sequence_after(name: str, floor: Callable[[], Awaitable[int]]) -> int:
+    '''
+    next_sequence, for counters whose first values may already be taken (by records older than the counter).
+    A counter that doesn't exist yet is first seeded with await floor(), the last value taken. Seeding uses
+    $max and happens before the increment, so concurrent first users agree: every value handed out is above floor.
+    '''
+    collection = await get_counter_collection()
+    if not await collection.find_one({'_id': name}, {'_id': 1}):
+        await collection.update_one({'_id': name}, {'$max': {'seq': await floor()}}, upsert=True)
+    return await next_sequence(name)
@@ -1,14 +1,20 @@
-from typing import Union, List, Any
+from collections.abc import Mapping
+from typing import Union, List, Any, Optional, Tuple, Iterator
+from functools import lru_cache
 import asyncio
 import os
 import base64
-import dill as pickle
+import hmac
+import uuid
 
 import cryptography
 from cryptography.fernet import Fernet
 import hashlib
 
 from app.core.config import settings
+from app.database import serialization
+from app.database.blind_index import BLIND_INDEX_FIELD, blind_index_tokens, blind_token
+from app.utils.workers import map_chunks
 
 from app.core.types import Json
 
@@ -21,22 +27,58 @@ def decode_base64_string(enc_string: str) -> bytes:
     return base64.b64decode(enc_string.encode('utf8'))
 
 
+@lru_cache(maxsize=8)
+def get_fernet(key: bytes) -> Fernet:
+    '''
+    Fernet setup (key parsing and splitting) is cached per key, instead of being paid per leaf.
+    '''
+    return Fernet(key)
+
+
 DO_NOT_ENCRYPT = {
     'fishery_id',
     'fishery_name',
     'pid_hash',
-    'base_email_hash'
+    'base_email_hash',
+    BLIND_INDEX_FIELD,
+    'version'
+}
+
+'''
+Record formats
+'''
+# Per-leaf encryption: every non-DO_NOT_ENCRYPT leaf is its own ciphertext.
+# Legacy documents carry no format field at all.
+LEAF_FORMAT = 1
+# Envelope encryption: all sensitive fields (tests included) are serialized once and sealed as a single blob.
+SINGLE_BLOB_ENVELOPE_FORMAT = 2
+# Envelope encryption, with every test sealed as its own sub-document in test_results
+# ({slot, test_token, sealed}), so single tests can be $push-ed / $set without touching the rest.
+ENVELOPE_FORMAT = 3
+
+FORMAT_FIELD = 'enc_format'
+ENVELOPE_FIELD = 'sealed'
+# Random, stable id of a sealed test within its patient (for positional updates).
+TEST_SLOT_FIELD = 'slot'
+# Blind index token of the test's test_id (None until the result is in).
+TEST_TOKEN_FIELD = 'test_token'
+# Plaintext write counter, bumped by every write (optimistic concurrency, see app.database.patient).
+VERSION_FIELD = 'version'
+
+RECORD_FORMATS = {
+    'leaf': LEAF_FORMAT,
+    'envelope': ENVELOPE_FORMAT
 }
 
 
 def encrypt(value: Any, key: bytes):
     if value:
-        # pickle to bytestring
-        pickled = pickle.dumps(value)
+        # serialize to bytestring
+        serialized = serialization.dumps(value)
         # make cipher
-        cipher_suite = Fernet(key)
+        cipher_suite = get_fernet(key)
         # encrypt
-        cipher_text = cipher_suite.encrypt(pickled)
+        cipher_text = cipher_suite.encrypt(serialized)
         return cipher_text
 
     else:
@@ -48,9 +90,9 @@ def decrypt(encrypted: Any, key: bytes):
         try:
             # Only decrypt bytes objects
             if isinstance(encrypted, bytes):
-                cipher_suite = Fernet(key)
+                cipher_suite = get_fernet(key)
                 decrypted_bytes = cipher_suite.decrypt(encrypted)
-                decrypted_object = pickle.loads(decrypted_bytes)
+                decrypted_object = serialization.loads(decrypted_bytes)
                 return decrypted_object
             else:
                 # Otherwise, 'encrypted' is likely already unencrypted
@@ -93,7 +135,286 @@ def decrypt_object(object_data: Json,
         return decrypt(object_data, key=master_key)
 
 
-async def validate_key(key_data: str):
-    target = settings.KEY_HASH
+def record_format(document: dict) -> int:
+    return document.get(FORMAT_FIELD, LEAF_FORMAT)
+
+
+def test_id_token(test_id: str, master_key: bytes) -> Optional[str]:
+    if test_id:
+        return blind_token('test_id', test_id, master_key)
+    return None
+
+
+def seal_test(test: dict, master_key: bytes, slot: str = None) -> dict:
+    return {TEST_SLOT_FIELD: slot or uuid.uuid4().hex,
+            TEST_TOKEN_FIELD: test_id_token(test.get('test_id'), master_key),
+            ENVELOPE_FIELD: get_fernet(master_key).encrypt(serialization.dumps(test))}
+
+
+def open_test(sealed_test: dict, master_key: bytes) -> dict:
+    try:
+        return serialization.loads(get_fernet(master_key).decrypt(sealed_test[ENVELOPE_FIELD]))
+    except:
+        return {ENVELOPE_FIELD: 'INVALID KEY'}
+
+
+def seal_record(record: dict, master_key: bytes) -> dict:
+    '''
+    Envelope-encrypt a record: DO_NOT_ENCRYPT fields (and _id) stay as plaintext
+    top-level keys, each test is sealed on its own (see seal_test), and everything
+    else is serialized once and sealed as one ciphertext.
+    '''
+    sealed = {FORMAT_FIELD: ENVELOPE_FORMAT}
+    sensitive = {}
+    for k, v in record.items():
+        if k in DO_NOT_ENCRYPT or k == '_id':
+            sealed[k] = v
+        elif k == 'test_results':
+            sealed[k] = [seal_test(t, master_key=master_key) for t in (v or [])]
+        elif k not in (FORMAT_FIELD, ENVELOPE_FIELD):
+            sensitive[k] = v
+    sealed[ENVELOPE_FIELD] = get_fernet(master_key).encrypt(serialization.dumps(sensitive))
+    return sealed
+
+
+def open_record(document: dict, master_key: bytes) -> dict:
+    '''
+    Opens both envelope formats: tests sealed separately, or inside the main blob.
+    '''
+    opened = {k: v for k, v in document.items() if k not in (FORMAT_FIELD, ENVELOPE_FIELD, 'test_results')}
+    if 'test_results' in document:
+        opened['test_results'] = [open_test(t, master_key=master_key) for t in document['test_results']]
+    if ENVELOPE_FIELD not in document:
+        # Fetched with a projection that only needed plaintext fields and/or tests.
+        return opened
+    try:
+        sensitive = serialization.loads(get_fernet(master_key).decrypt(document[ENVELOPE_FIELD]))
+    except:
+        opened[ENVELOPE_FIELD] = 'INVALID KEY'
+        return opened
+    opened.update(sensitive)
+    return opened
+
+
+def open_tests(document: dict, master_key: bytes) -> List[Tuple[Any, dict]]:
+    '''
+    Decrypts only the tests of a patient document, as (slot, test) pairs.
+    For formats without sealed tests, the slot is the test's index in test_results.
+    '''
+    return LazyRecord(document, master_key=master_key).tests()
+
+
+def encrypt_record(record: dict, master_key: bytes, record_format: int = None) -> dict:
+    '''
+    Encrypt a whole record in the configured storage format
+    (settings.RECORD_ENCRYPTION_FORMAT, unless record_format is given),
+    along with its blind index tokens.
+    '''
+    record = dict(record)
+    record[BLIND_INDEX_FIELD] = blind_index_tokens(record, master_key=master_key)
+    if record_format is None:
+        record_format = RECORD_FORMATS[settings.RECORD_ENCRYPTION_FORMAT]
+    if record_format == ENVELOPE_FORMAT:
+        return seal_record(record, master_key=master_key)
+    return encrypt_object(record, master_key=master_key)
+
+
+def storage_projection(projection: List[str]) -> List[str]:
+    '''
+    The stored fields needed to decrypt the record fields in projection, for any format
+    (a Mongo find() projection). Per-leaf documents store every field on its own;
+    envelope documents keep all but tests and DO_NOT_ENCRYPT fields in the sealed blob,
+    and single-blob envelope documents (SINGLE_BLOB_ENVELOPE_FORMAT) keep their tests in it too.
+    '''
+    stored = set(projection) | {FORMAT_FIELD}
+    if any(f not in DO_NOT_ENCRYPT for f in projection):
+        stored.add(ENVELOPE_FIELD)
+    return sorted(stored)
+
+
+def _needs_blob(projection: List[str]) -> bool:
+    return any(f not in DO_NOT_ENCRYPT and f != 'test_results' for f in projection)
+
+
+def decrypt_record(document: dict, master_key: bytes, projection: List[str] = None) -> dict:
+    '''
+    Decrypt a whole record, whatever format it was stored in.
+    Blind index tokens and the version are storage metadata, and are dropped.
+    With a projection (record fields; the document should be fetched with storage_projection),
+    only those fields (and _id) are returned.
+    '''
+    if record_format(document) == LEAF_FORMAT:
+        record = decrypt_object(document, master_key=master_key)
+    else:
+        if projection is not None and record_format(document) == ENVELOPE_FORMAT and not _needs_blob(projection):
+            # Tests have their own seals: the blob was only fetched in case tests were in it.
+            document = {k: v for k, v in document.items() if k != ENVELOPE_FIELD}
+        record = open_record(document, master_key=master_key)
+    record.pop(BLIND_INDEX_FIELD, None)
+    record.pop(VERSION_FIELD, None)
+    if projection is not None:
+        record = {k: v for k, v in record.items() if k in projection or k == '_id'}
+    return record
+
+
+class LazyRecord(Mapping):
+    '''
+    Read-only view of an encrypted patient document, decrypting fields on first access
+    and memoizing them; for handlers that only read a few fields.
+    Per-leaf documents decrypt field by field. Envelope documents open the sealed blob once,
+    on the first access to a field in it, and tests one at a time (see find_test).
+    Iterating (dict(record), serializing) decrypts everything: use materialize().
+    '''
+
+    def __init__(self, document: dict, master_key: bytes):
+        self._document = document
+        self._master_key = master_key
+        self._format = record_format(document)
+        self._fields = {}
+        self._blob = None
+        self._tests = None
+
+    def _open_blob(self) -> dict:
+        if self._blob is None:
+            if self._format == SINGLE_BLOB_ENVELOPE_FORMAT:
+                # Tests are inside the blob: open_record already splits them out.
+                self._blob = open_record(self._document, master_key=self._master_key)
+            else:
+                self._blob = open_record({k: v for k, v in self._document.items() if k != 'test_results'},
+                                         master_key=self._master_key)
+        return self._blob
+
+    def _stored_keys(self) -> List[str]:
+        keys = [k for k in self._document if k not in (BLIND_INDEX_FIELD, VERSION_FIELD)]
+        if self._format == LEAF_FORMAT:
+            return keys
+        return [k for k in keys if k not in (FORMAT_FIELD, ENVELOPE_FIELD)] + \
+               [k for k in self._open_blob() if k not in self._document]
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._fields:
+            return self._fields[key]
+        if key in (BLIND_INDEX_FIELD, VERSION_FIELD):
+            raise KeyError(key)
+        if key == 'test_results' and self._format != SINGLE_BLOB_ENVELOPE_FORMAT:
+            if 'test_results' not in self._document:
+                raise KeyError(key)
+            value = [t for _, t in self.tests()]
+        elif key in DO_NOT_ENCRYPT or key == '_id':
+            value = self._document[key]
+        elif self._format == LEAF_FORMAT:
+            value = decrypt_object(self._document[key], master_key=self._master_key)
+        else:
+            value = self._open_blob()[key]
+        self._fields[key] = value
+        return value
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._stored_keys())
+
+    def __len__(self) -> int:
+        return len(self._stored_keys())
+
+    def tests(self) -> List[Tuple[Any, dict]]:
+        '''
+        (slot, test) pairs, as CipherContext.open_tests.
+        '''
+        if self._tests is None:
+            if self._format == ENVELOPE_FORMAT:
+                self._tests = [(t[TEST_SLOT_FIELD], open_test(t, master_key=self._master_key))
+                               for t in self._document.get('test_results', [])]
+            elif self._format == LEAF_FORMAT:
+                self._tests = list(enumerate(decrypt_object(self._document.get('test_results') or [],
+                                                            master_key=self._master_key)))
+            else:
+                self._tests = list(enumerate(self._open_blob().get('test_results') or []))
+        return self._tests
+
+    def find_test(self, test_id: str) -> Tuple[Any, Optional[dict]]:
+        '''
+        (slot, test) of the test with this test_id, or (None, None).
+        Envelope records find it by its test_token, and only decrypt that one test.
+        '''
+        if self._format == ENVELOPE_FORMAT and self._tests is None:
+            token = test_id_token(test_id, master_key=self._master_key)
+            for t in self._document.get('test_results', []):
+                if token and t.get(TEST_TOKEN_FIELD) == token:
+                    return t[TEST_SLOT_FIELD], open_test(t, master_key=self._master_key)
+            return None, None
+        for slot, t in self.tests():
+            if t.get('test_id') == test_id:
+                return slot, t
+        return None, None
+
+    def materialize(self) -> dict:
+        return {k: self[k] for k in self}
+
+
+def is_valid_key(key_data: str) -> bool:
+    '''
+    The key's digest is compared to KEY_HASH in constant time. Digests aren't cached:
+    a cache keyed on raw keys would keep every key tried in memory.
+    '''
     key_hash = hash_string(key_data)
-    return target == key_hash
+    return hmac.compare_digest(key_hash.encode('utf8'), settings.KEY_HASH.encode('utf8'))
+
+
+def decrypt_records(documents: List[dict], master_key: bytes, projection: List[str] = None) -> List[dict]:
+    '''
+    Module-level so it can be shipped to a worker process.
+    '''
+    return [decrypt_record(d, master_key=master_key, projection=projection) for d in documents]
+
+
+async def validate_key(key_data: str):
+    return is_valid_key(key_data)
+
+
+class CipherContext:
+    '''
+    Validated key material for a single request: the master key is decoded once,
+    then reused for every record the request touches (ciphers are cached by get_fernet).
+    '''
+
+    def __init__(self, key_data: str):
+        self.key_data = key_data
+        self.master_key = decode_base64_string(key_data)
+
+    def encrypt_record(self, record: dict, record_format: int = None) -> dict:
+        return encrypt_record(record, master_key=self.master_key, record_format=record_format)
+
+    def decrypt_record(self, document: dict, projection: List[str] = None) -> dict:
+        return decrypt_record(document, master_key=self.master_key, projection=projection)
+
+    def seal_test(self, test: dict, slot: str = None) -> dict:
+        return seal_test(test, master_key=self.master_key, slot=slot)
+
+    def open_tests(self, document: dict) -> List[Tuple[Any, dict]]:
+        return open_tests(document, master_key=self.master_key)
+
+    def lazy_record(self, document: dict) -> LazyRecord:
+        return LazyRecord(document, master_key=self.master_key)
+
+    def test_id_token(self, test_id: str) -> Optional[str]:
+        return test_id_token(test_id, master_key=self.master_key)
+
+
+async def decrypt_multiple_patients(patients: list, cipher: CipherContext, projection: List[str] = None):
+    '''
+    Small lists are decrypted inline. Larger ones are split into chunks and decrypted
+    on the process pool, so the event loop keeps serving other requests meanwhile.
+    projection: only return these record fields (the projection the patients were fetched with).
+    '''
+    if len(patients) <= settings.BULK_DECRYPT_INLINE_MAX:
+        return [cipher.decrypt_record(patient, projection=projection) for patient in patients]
+    return await map_chunks(decrypt_records, patients, settings.BULK_DECRYPT_CHUNK_SIZE,
+                            cipher.master_key, projection)
+
+
+def get_cipher_context(key_data: str) -> Optional[CipherContext]:
+    '''
+    Returns a CipherContext if key_data is the master key, else None.
+    '''
+    if key_data and is_valid_key(key_data):
+        return CipherContext(key_data)
+    return None
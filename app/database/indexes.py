@@ -0,0 +1,87 @@
+import logging
+from typing import Dict, List
+
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure, PyMongoError
+
+from app.core.config import settings
+from app.database.blind_index import BLIND_INDEX_FIELD, BLIND_INDEX_FIELDS, DATE_BUCKET_FIELDS, VERSION_KEY
+from app.database.crypto import TEST_TOKEN_FIELD
+from app.database.uploads import UPLOADED_AT_FIELD
+
+'''
+Index registry: every index the data layer relies on, per collection.
+Applied at startup (create_index is a no-op for indexes that already exist).
+'''
+logger = logging.getLogger(__name__)
+
+PATIENT_INDEXES: List[IndexModel] = [
+    IndexModel([('pid_hash', ASCENDING)], name='pid_hash_unique', unique=True),
+    IndexModel([('base_email_hash', ASCENDING)], name='base_email_hash'),
+    IndexModel([('fishery_id', ASCENDING)], name='fishery_id'),
+    IndexModel([(f'test_results.{TEST_TOKEN_FIELD}', ASCENDING)], name='test_token'),
+] + [
+    IndexModel([(f'{BLIND_INDEX_FIELD}.{field}', ASCENDING)], name=f'{BLIND_INDEX_FIELD}_{field}')
+    for field in list(BLIND_INDEX_FIELDS) + list(DATE_BUCKET_FIELDS)
+] + [
+    # Token lookups are OR'ed with a version check (blind_index.NOT_INDEXED); an $or only
+    # uses indexes if every branch has one.
+    IndexModel([(f'{BLIND_INDEX_FIELD}.{VERSION_KEY}', ASCENDING)], name=f'{BLIND_INDEX_FIELD}_version'),
+]
+
+UPLOAD_INDEXES: List[IndexModel] = [
+    # TTL: Mongo deletes ledger entries this long after they were uploaded.
+    IndexModel([(UPLOADED_AT_FIELD, ASCENDING)], name='uploaded_at_ttl',
+               expireAfterSeconds=settings.UPLOAD_LEDGER_TTL_DAYS * 24 * 3600),
+    # A deleted patient's entries are forgotten (app.database.uploads.forget_uploads).
+    IndexModel([('pid_hash', ASCENDING)], name='pid_hash'),
+]
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    'patients': PATIENT_INDEXES,
+    'uploads': UPLOAD_INDEXES,
+}
+
+
+async def ensure_indexes(database) -> Dict[str, List[str]]:
+    '''
+    Creates every registered index that doesn't exist yet.
+    Failures (e.g. duplicate pid_hashes blocking the unique index, or no reachable server)
+    are logged, not raised, so the app still starts; check GET /api/admin/indexes.
+    '''
+    created = {}
+    for collection_name, indexes in INDEXES.items():
+        collection = database.get_collection(collection_name)
+        created[collection_name] = []
+        for index in indexes:
+            try:
+                created[collection_name] += await collection.create_indexes([index])
+            except OperationFailure as e:
+                logger.warning('Could not create index %s on %s: %s', index.document['name'], collection_name, e)
+            except PyMongoError as e:
+                # Connection problems: every other index would fail the same way, after its own timeout.
+                logger.warning('Could not create indexes: %s', e)
+                return created
+    return created
+
+
+async def index_report(database) -> Dict[str, dict]:
+    '''
+    Compares registered indexes against the ones present in the database.
+    '''
+    report = {}
+    for collection_name, indexes in INDEXES.items():
+        present = await database.get_collection(collection_name).index_information()
+        expected = {index.document['name']: index.document for index in indexes}
+        mismatched = [name for name, doc in expected.items()
+                      if name in present
+                      and (list(present[name]['key']) != list(doc['key'].items())
+                           or present[name].get('unique', False) != doc.get('unique', False)
+                           or present[name].get('expireAfterSeconds') != doc.get('expireAfterSeconds'))]
+        report[collection_name] = {
+            'ok': all(name in present for name in expected) and not mismatched,
+            'missing': [name for name in expected if name not in present],
+            'mismatched': mismatched,
+            'unregistered': [name for name in present if name not in expected and name != '_id_'],
+        }
+    return report
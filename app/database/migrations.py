@@ -0,0 +1,52 @@
+import logging
+
+from app.core.types import Json
+from app.database.blind_index import BLIND_INDEX_FIELD, BLIND_INDEX_VERSION, VERSION_KEY
+from app.database.crypto import (
+    CipherContext,
+    FORMAT_FIELD,
+    ENVELOPE_FORMAT,
+    VERSION_FIELD
+)
+from app.database.patient import get_patient_collection, document_version
+
+logger = logging.getLogger(__name__)
+
+# Documents not yet in the current storage format: per-leaf encrypted, or without current blind index tokens.
+OUTDATED_PATIENTS_QUERY = {'$or': [{FORMAT_FIELD: {'$ne': ENVELOPE_FORMAT}},
+                                   {f'{BLIND_INDEX_FIELD}.{VERSION_KEY}': {'$ne': BLIND_INDEX_VERSION}}]}
+
+
+def has_invalid_leaf(object_data: Json) -> bool:
+    if isinstance(object_data, dict):
+        return any(has_invalid_leaf(v) for v in object_data.values())
+    if isinstance(object_data, list):
+        return any(has_invalid_leaf(i) for i in object_data)
+    return object_data == 'INVALID KEY'
+
+
+async def migrate_patients(cipher: CipherContext) -> dict:
+    '''
+    Bring every patient document up to the current storage format: envelope
+    encrypted, with blind index tokens.
+    Documents that don't decrypt cleanly under the cipher's key are left untouched.
+    Safe to re-run: up to date documents are skipped.
+    '''
+    _, _, collection = await get_patient_collection()
+    report = {'migrated': 0, 'skipped': 0}
+    async for document in collection.find(OUTDATED_PATIENTS_QUERY):
+        record = cipher.decrypt_record(document)
+        if has_invalid_leaf(record):
+            report['skipped'] += 1
+            continue
+        migrated = cipher.encrypt_record(record, record_format=ENVELOPE_FORMAT)
+        version = document_version(document)
+        migrated[VERSION_FIELD] = version + 1
+        # Only replace if nobody wrote to this document in the meantime.
+        result = await collection.replace_one({'_id': document['_id'], VERSION_FIELD: version or None}, migrated)
+        if result.modified_count:
+            report['migrated'] += 1
+        else:
+            report['skipped'] += 1
+    logger.info('Patient migration finished: %s', report)
+    return report
@@ -1,15 +1,37 @@
-from typing import Union
-from app.database.crypto import hash_string
+from typing import Union, AsyncIterator, Awaitable, Callable, List, Any, Optional, Tuple
+from pymongo import ReturnDocument, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from app.database.crypto import (
+    hash_string,
+    record_format,
+    LEAF_FORMAT,
+    DO_NOT_ENCRYPT,
+    TEST_SLOT_FIELD,
+    VERSION_FIELD,
+    storage_projection
+)
+from app.database.blind_index import all_of, blind_index_query, BLIND_INDEX_FIELD
 from app.core.config import settings
-from app.routes.common import decrypt_patient_data
+from app.database.client import get_mongo_client
 
 
 async def get_patient_collection():
-    from app.main import MONGO_CLIENT
-    database = MONGO_CLIENT.get_database(settings.MONGO_DATABASE)
+    client = get_mongo_client()
+    database = client.get_database(settings.MONGO_DATABASE)
     collection = database.get_collection("patients")
 
-    return MONGO_CLIENT, database, collection
+    return client, database, collection
+
+
+class WriteConflict(Exception):
+    '''
+    A patient kept being modified concurrently for all of mutate_patient's retries.
+    '''
+    pass
+
+
+def _find_projection(projection: List[str] = None) -> Union[None, List[str]]:
+    return storage_projection(projection) if projection is not None else None
 
 
 def patient_helper(patient_data: dict) -> dict:
@@ -17,88 +39,269 @@ def patient_helper(patient_data: dict) -> dict:
     return patient_data
 
 
-async def ensure_pid_unique(patient_data: dict):
+async def ensure_pid_unique(patient_data: dict, pid_exists: bool = None):
     '''
     Make sure pid_hash isn't already in db
     If so:
-        append ints to the end of pid until pid_hash is unique.
+        append a suffix (pid_1, pid_2, ...) handed out by an atomic per-pid counter.
+    Callers that already looked the pid up can pass pid_exists to save the round trip.
     '''
+    from app.database.counters import next_sequence_after
 
     pid = patient_data['patient_id']
-
-    increment = 0
     pid_hash = hash_string(pid)
-    pid_exists = bool(await retrieve_patient(pid_hash))
-    pid_altered = False
-    while pid_exists:
-        pid_altered = True
-        increment += 1
-        incremented_pid = f'{pid}_{increment}'
-        pid = incremented_pid
-        pid_hash = hash_string(pid)
+    if pid_exists is None:
         pid_exists = bool(await retrieve_patient(pid_hash))
-    return pid, pid_hash, pid_altered
+    if not pid_exists:
+        return pid, pid_hash, False
+
+    async def taken_suffixes():
+        # Suffixes older patients took before counters were introduced: probed once per pid.
+        taken = 0
+        while await retrieve_patient(hash_string(f'{pid}_{taken + 1}')):
+            taken += 1
+        return taken
+
+    increment = await next_sequence_after(f'pid:{pid_hash}', taken_suffixes)
+    pid = f'{pid}_{increment}'
+    return pid, hash_string(pid), True
 
 
+def document_version(document: dict) -> int:
+    # Documents written before versioning count as version 0.
+    return document.get(VERSION_FIELD) or 0
+
+
+def _versioned(pid_hash: str, version: int) -> dict:
+    '''
+    Filter matching the patient only if it is still at the given version.
+    '''
+    return {'pid_hash': pid_hash, VERSION_FIELD: version if version else None}
+
 
 async def add_patient(patient_data: dict) -> dict:
     _, _, collection = await get_patient_collection()
+    patient_data[VERSION_FIELD] = 1
     patient = await collection.insert_one(patient_data)
-    new_patient = await collection.find_one({'_id': patient.inserted_id})
+    # The inserted document is exactly what we sent; no need to read it back.
+    new_patient = dict(patient_data, _id=patient.inserted_id)
     return patient_helper(new_patient)
 
 
-async def retrieve_patients(query={}):
+async def retrieve_patients(query={}, projection: List[str] = None):
+    '''
+    projection: record fields to fetch (see storage_projection); all of them if None.
+    '''
     _, _, collection = await get_patient_collection()
     patients = []
-    async for patient in collection.find(query):
+    async for patient in collection.find(query, projection=_find_projection(projection)):
         patients.append(patient_helper(patient))
     return patients
 
 
+async def iterate_patients(query={}, batch_size: int = None) -> AsyncIterator[List[dict]]:
+    '''
+    Yields patients in lists of batch_size (settings.PATIENT_STREAM_BATCH_SIZE by default),
+    so only one batch is held in memory at a time.
+    '''
+    batch_size = batch_size or settings.PATIENT_STREAM_BATCH_SIZE
+    _, _, collection = await get_patient_collection()
+    batch = []
+    async for patient in collection.find(query, batch_size=batch_size):
+        batch.append(patient_helper(patient))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 async def retrieve_patient(pid_hash: str) -> Union[dict, None]:
     _, _, collection = await get_patient_collection()
-    try:
-        patient = await collection.find_one({'pid_hash': pid_hash})
+    patient = await collection.find_one({'pid_hash': pid_hash})
+    if patient:
         return patient_helper(patient)
-    except:
-        cursor = collection.find({'pid_hash': pid_hash})
-        patients = await cursor.to_list(length=1)
-        if len(patients) > 0:
-            return patient_helper(patients[0])
     return None
 
 
-async def update_patient(pid_hash: str, data: dict) -> Union[bool, dict]:
+def _patient_update(data: dict, version: int) -> Tuple[bool, dict]:
+    '''
+    (is_replacement, replacement or update) writing data over a patient at version, and bumping it.
+    '''
+    # Remove _id since it should never be updated.
+    if '_id' in data:
+        _ = data.pop('_id')
+    if record_format(data) != LEAF_FORMAT:
+        # A sealed record is always whole; replace so no stale per-leaf fields survive.
+        data[VERSION_FIELD] = version + 1
+        return True, data
+    data.pop(VERSION_FIELD, None)
+    return False, {'$set': data, '$inc': {VERSION_FIELD: 1}}
+
+
+async def update_patient(pid_hash: str, data: dict, version: int) -> Union[bool, dict]:
+    '''
+    Compare-and-swap: updates the patient in a single round trip, only if it is still at
+    version (the version data was derived from), and bumps its version.
+    Returns the updated document, or False if no patient has this pid_hash at that version.
+    '''
     _, _, collection = await get_patient_collection()
     if len(data) < 1:
         return False
-    patient = await collection.find_one({'pid_hash': pid_hash})
-
-    if patient:
-        # Remove _id since it should never be updated.
-        if '_id' in data:
-            _ = data.pop('_id')
-        updated_patient = await collection.update_one(
-            {'pid_hash': pid_hash}, {'$set': data}
+    is_replacement, update = _patient_update(data, version)
+    if is_replacement:
+        updated_patient = await collection.find_one_and_replace(
+            _versioned(pid_hash, version), update, return_document=ReturnDocument.AFTER
         )
-        if updated_patient:
-            return updated_patient.raw_result
-        return False
+    else:
+        updated_patient = await collection.find_one_and_update(
+            _versioned(pid_hash, version), update, return_document=ReturnDocument.AFTER
+        )
+    if updated_patient:
+        return patient_helper(updated_patient)
+    return False
+
+
+def update_patient_operation(pid_hash: str, data: dict, version: int) -> Union[ReplaceOne, UpdateOne]:
+    '''
+    update_patient, as an operation for bulk_write_patients.
+    '''
+    is_replacement, update = _patient_update(data, version)
+    if is_replacement:
+        return ReplaceOne(_versioned(pid_hash, version), update)
+    return UpdateOne(_versioned(pid_hash, version), update)
+
+
+def _add_tokens(tokens: dict) -> dict:
+    return {'$addToSet': {f'{BLIND_INDEX_FIELD}.{k}': {'$each': v} for k, v in tokens.items()}} if tokens else {}
+
 
+def _push_tests(sealed_tests: List[dict], tokens: dict = None) -> dict:
+    return {'$push': {'test_results': {'$each': sealed_tests}},
+            '$inc': {VERSION_FIELD: 1},
+            **_add_tokens(tokens)}
 
-async def delete_patient(pid_hash: str):
+
+async def push_test_result(pid_hash: str, version: int, sealed_test: dict, tokens: dict = None) -> bool:
+    '''
+    Appends one sealed test (envelope records only), and adds its blind index tokens.
+    Compare-and-swap on version, like update_patient.
+    '''
     _, _, collection = await get_patient_collection()
-    patient = await collection.find_one({'pid_hash': pid_hash})
-    if patient:
-        await collection.delete_one({'pid_hash': pid_hash})
-        return True
+    updated = await collection.update_one(_versioned(pid_hash, version), _push_tests([sealed_test], tokens))
+    return updated.matched_count > 0
+
+
+def push_tests_operation(pid_hash: str, version: int, sealed_tests: List[dict], tokens: dict = None) -> UpdateOne:
+    '''
+    push_test_result for several tests at once, as an operation for bulk_write_patients.
+    '''
+    return UpdateOne(_versioned(pid_hash, version), _push_tests(sealed_tests, tokens))
+
+
+def set_tests_operation(pid_hash: str, version: int, sealed_tests: List[dict], tokens: dict = None) -> UpdateOne:
+    '''
+    Replaces a patient's sealed tests (envelope records only) with sealed_tests, as an operation for
+    bulk_write_patients: several tests can change in one write. sealed_tests must be the patient's
+    tests at version, with the changed ones resealed in their slots; the version check makes that safe.
+    '''
+    return UpdateOne(_versioned(pid_hash, version), {'$set': {'test_results': sealed_tests},
+                                                     '$inc': {VERSION_FIELD: 1},
+                                                     **_add_tokens(tokens)})
+
+
+async def set_test_result(pid_hash: str, version: int, sealed_test: dict, tokens: dict = None) -> bool:
+    '''
+    Replaces the sealed test with the same slot (envelope records only), and adds its blind index tokens.
+    Tokens of the replaced test are kept: the blind index is a pre-filter, exact filtering happens after decryption.
+    Compare-and-swap on version, like update_patient.
+    '''
+    _, _, collection = await get_patient_collection()
+    updated = await collection.update_one({**_versioned(pid_hash, version),
+                                           f'test_results.{TEST_SLOT_FIELD}': sealed_test[TEST_SLOT_FIELD]},
+                                          {'$set': {'test_results.$': sealed_test},
+                                           '$inc': {VERSION_FIELD: 1},
+                                           **_add_tokens(tokens)})
+    return updated.matched_count > 0
+
+
+async def mutate_patient(pid_hash: str,
+                         mutation: Callable[[dict], Awaitable[Any]],
+                         retries: int = None) -> Any:
+    '''
+    Optimistic concurrency: reads the patient and runs mutation(document), which does its own
+    versioned write(s) (update_patient, push_test_result, ...) and returns a result.
+    If mutation returns False (its write lost a race with another writer), the patient is read
+    again and mutation re-run, up to retries (settings.PATIENT_WRITE_RETRIES) more times.
+    Returns mutation's result, or None if the patient doesn't exist.
+    Raises WriteConflict when out of retries.
+    '''
+    retries = settings.PATIENT_WRITE_RETRIES if retries is None else retries
+    for _ in range(retries + 1):
+        document = await retrieve_patient(pid_hash)
+        if not document:
+            return None
+        result = await mutation(document)
+        if result is not False:
+            return result
+    raise WriteConflict(pid_hash)
+
+
+async def add_patients(patients: List[dict]) -> List[Optional[str]]:
+    '''
+    Inserts many patients in one (unordered) round trip: a failing insert doesn't stop the others.
+    Returns, per patient, None if it was inserted, else the error message.
+    '''
+    _, _, collection = await get_patient_collection()
+    for patient_data in patients:
+        patient_data[VERSION_FIELD] = 1
+    errors = [None] * len(patients)
+    if not patients:
+        return errors
+    try:
+        await collection.insert_many(patients, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get('writeErrors', []):
+            errors[error['index']] = error.get('errmsg', 'Insert failed.')
+    return errors
+
+
+async def bulk_write_patients(operations: list) -> int:
+    '''
+    Runs versioned patient operations (update_patient_operation, push_tests_operation)
+    in one unordered round trip. Returns how many matched: the others lost a race, or failed.
+    '''
+    if not operations:
+        return 0
+    _, _, collection = await get_patient_collection()
+    try:
+        result = await collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # Writes that failed count as unmatched: callers retry them one patient at a time.
+        return e.details.get('nMatched', 0)
+    return result.matched_count
+
+
+async def delete_patient(pid_hash: str) -> bool:
+    _, _, collection = await get_patient_collection()
+    deleted = await collection.delete_one({'pid_hash': pid_hash})
+    return deleted.deleted_count > 0
+
+
+def patient_query(query: dict, master_key: bytes) -> dict:
+    '''
+    Translates an equality query on patient fields into what Mongo can evaluate:
+    DO_NOT_ENCRYPT fields as is, blind-indexed encrypted fields as token lookups.
+    Any other field can only be filtered after decryption.
+    '''
+    return all_of({k: v for k, v in query.items() if k in DO_NOT_ENCRYPT},
+                  blind_index_query(query, master_key=master_key))
 
 
-async def query_db(query: dict) -> Union[None, list]:
+async def query_db(query: dict, projection: List[str] = None) -> Union[None, list]:
     _, _, collection = await get_patient_collection()
     patients = []
-    async for patient in collection.find(query):
+    async for patient in collection.find(query, projection=_find_projection(projection)):
         patients.append(patient_helper(patient))
     if patients:
         return patients
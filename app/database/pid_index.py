@@ -0,0 +1,70 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Set
+
+from bson import ObjectId
+
+from app.core.config import settings
+from app.database.crypto import CipherContext, decrypt_multiple_patients
+from app.database.patient import retrieve_patients
+from app.utils.text.fuzzy_pid import FuzzyPIDIndex
+
+'''
+This worker's FuzzyPIDIndex of every patient's PID, for matching OCR'd PIDs without decrypting
+the collection per scanned result. It is built on first use (decrypting only the patient_id
+of each patient), then kept current incrementally: each get_pid_index only decrypts patients
+inserted since the last one (by the time in their _id), wherever they were added from.
+Patients deleted through this worker are discarded; candidates are looked up by pid_hash
+before use anyway, so a PID deleted elsewhere is only an extra candidate.
+'''
+# ObjectId times come from the inserting client's clock: look back a little further for clock skew.
+SYNC_MARGIN = timedelta(seconds=60)
+
+_index = FuzzyPIDIndex()
+_pid_hashes: Set[str] = set()
+_synced_at: Optional[datetime] = None
+_sync_lock: Optional[asyncio.Lock] = None
+
+
+async def _load_patients(query: dict, cipher: CipherContext) -> List[dict]:
+    patients = await retrieve_patients(query, projection=['pid_hash', 'patient_id'])
+    new = [p for p in patients if p['pid_hash'] not in _pid_hashes]
+    return await decrypt_multiple_patients(new, cipher=cipher, projection=['pid_hash', 'patient_id'])
+
+
+async def get_pid_index(cipher: CipherContext) -> FuzzyPIDIndex:
+    global _synced_at, _sync_lock
+    if _sync_lock is None:
+        _sync_lock = asyncio.Lock()
+    async with _sync_lock:
+        started_at = datetime.now(timezone.utc)
+        query = {'_id': {'$gte': ObjectId.from_datetime(_synced_at - SYNC_MARGIN)}} if _synced_at else {}
+        for patient in await _load_patients(query, cipher):
+            _index.add(patient['patient_id'])
+            _pid_hashes.add(patient['pid_hash'])
+        _synced_at = started_at
+    return _index
+
+
+def forget_pid(patient_id: str, pid_hash: str):
+    _index.discard(patient_id)
+    _pid_hashes.discard(pid_hash)
+
+
+def reset_pid_index():
+    '''
+    Drops the index; the next get_pid_index rebuilds it from scratch.
+    '''
+    global _index, _pid_hashes, _synced_at
+    _index, _pid_hashes, _synced_at = FuzzyPIDIndex(), set(), None
+
+
+def pid_candidates(index: FuzzyPIDIndex, patient_id: str) -> List[dict]:
+    '''
+    Known PIDs closest to an OCR'd one (within the settings.PID_MATCH_* limits), cheapest first:
+    [{'patient_id', 'cost'}]. A cost of 0 is an exact match.
+    '''
+    return [{'patient_id': pid, 'cost': cost}
+            for pid, cost in index.candidates(patient_id, limit=settings.PID_MATCH_CANDIDATES,
+                                              max_cost=settings.PID_MATCH_MAX_COST,
+                                              max_edits=settings.PID_MATCH_MAX_EDITS)]
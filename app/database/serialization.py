@@ -0,0 +1,251 @@
+'''
+Compact, typed binary encoding for the values stored in patient records.
+
+Supports str, int, float, bool, None, bytes, datetime and (nested) dict/list.
+Scalars are encoded with one-byte type tags (values start with FORMAT_TAG).
+Dicts and lists (whole records) start with OPCODE_TAG, followed by a minimal pickle opcode
+stream written here: no globals, and only strings that repeat are memoized. That decodes with
+the C unpickler, far faster than walking tags in Python, at about the size of the tagged encoding.
+Anything else is a legacy dill pickle (pickles always start with the 0x80 PROTO opcode),
+so old ciphertexts still decode. Values containing any other type fall back to dill as a whole
+(dicts and lists holding datetimes to the tagged encoding first).
+'''
+import pickle
+import struct
+from collections import Counter
+from datetime import datetime
+from typing import Any, Tuple
+
+import dill
+
+FORMAT_TAG = b'\x01'
+OPCODE_TAG = b'\x02'
+
+_NONE = 0x4e  # N
+_TRUE = 0x54  # T
+_FALSE = 0x46  # F
+_INT = 0x69  # i
+_FLOAT = 0x66  # f
+_STR = 0x73  # s
+_BYTES = 0x62  # b
+_DATETIME = 0x64  # d
+_LIST = 0x6c  # l
+_DICT = 0x6d  # m
+_REF = 0x72  # r: back-reference to an earlier string (dict keys repeat a lot)
+
+_DOUBLE = struct.Struct('>d')
+
+
+class UnsupportedType(TypeError):
+    pass
+
+
+def _write_uint(n: int, out: bytearray):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_uint(data: bytes, pos: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _write_sized(tag: int, raw: bytes, out: bytearray):
+    out.append(tag)
+    _write_uint(len(raw), out)
+    out += raw
+
+
+def _encode(value: Any, out: bytearray, strings: dict):
+    # Exact type checks: subclasses (defaultdict, enums, ...) need pickle to round trip.
+    t = type(value)
+    if t is str:
+        ref = strings.get(value)
+        if ref is None:
+            strings[value] = len(strings)
+            _write_sized(_STR, value.encode('utf8'), out)
+        else:
+            out.append(_REF)
+            _write_uint(ref, out)
+    elif value is None:
+        out.append(_NONE)
+    elif t is bool:
+        out.append(_TRUE if value else _FALSE)
+    elif t is int:
+        out.append(_INT)
+        # zigzag, so small negative numbers stay small
+        _write_uint(value << 1 if value >= 0 else ((-value) << 1) - 1, out)
+    elif t is float:
+        out.append(_FLOAT)
+        out += _DOUBLE.pack(value)
+    elif t is dict:
+        out.append(_DICT)
+        _write_uint(len(value), out)
+        for k, v in value.items():
+            _encode(k, out, strings)
+            _encode(v, out, strings)
+    elif t is list:
+        out.append(_LIST)
+        _write_uint(len(value), out)
+        for i in value:
+            _encode(i, out, strings)
+    elif t is datetime:
+        _write_sized(_DATETIME, value.isoformat().encode('ascii'), out)
+    elif t is bytes:
+        _write_sized(_BYTES, value, out)
+    else:
+        raise UnsupportedType(t)
+
+
+def _decode(data: bytes, pos: int, strings: list) -> Tuple[Any, int]:
+    tag = data[pos]
+    pos += 1
+    if tag in _NO_PAYLOAD:
+        return _NO_PAYLOAD[tag], pos
+    if tag == _FLOAT:
+        return _DOUBLE.unpack_from(data, pos)[0], pos + _DOUBLE.size
+    # Every other tag is followed by a varint (length, count, ref or int);
+    # it almost always fits in one byte, so read that case inline.
+    n = data[pos]
+    if n < 0x80:
+        pos += 1
+    else:
+        n, pos = _read_uint(data, pos)
+    if tag == _STR:
+        value = data[pos:pos + n].decode('utf8')
+        strings.append(value)
+        return value, pos + n
+    if tag == _REF:
+        return strings[n], pos
+    if tag == _DICT:
+        d = {}
+        for _ in range(n):
+            k, pos = _decode(data, pos, strings)
+            d[k], pos = _decode(data, pos, strings)
+        return d, pos
+    if tag == _LIST:
+        l = []
+        for _ in range(n):
+            i, pos = _decode(data, pos, strings)
+            l.append(i)
+        return l, pos
+    if tag == _INT:
+        return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+    if tag == _DATETIME:
+        return datetime.fromisoformat(data[pos:pos + n].decode('ascii')), pos + n
+    if tag == _BYTES:
+        return bytes(data[pos:pos + n]), pos + n
+    raise ValueError(f'Unknown type tag {tag!r} at position {pos - 1}.')
+
+
+_NO_PAYLOAD = {_NONE: None, _TRUE: True, _FALSE: False}
+
+
+def _count_strings(value: Any, counts: Counter):
+    t = type(value)
+    if t is str:
+        counts[value] += 1
+    elif t is dict:
+        for k, v in value.items():
+            _count_strings(k, counts)
+            _count_strings(v, counts)
+    elif t is list:
+        for i in value:
+            _count_strings(i, counts)
+
+
+def _write_opcodes(value: Any, out: bytearray, repeated: set, memo: dict):
+    # Pickle opcodes (see pickletools), protocol 4 and below.
+    t = type(value)
+    if t is str:
+        ref = memo.get(value)
+        if ref is not None:
+            out += b'h' + bytes((ref,)) if ref < 0x100 else b'j' + struct.pack('<I', ref)  # BINGET / LONG_BINGET
+            return
+        raw = value.encode('utf8', 'surrogatepass')
+        # SHORT_BINUNICODE / BINUNICODE
+        out += b'\x8c' + bytes((len(raw),)) if len(raw) < 0x100 else b'X' + struct.pack('<I', len(raw))
+        out += raw
+        if value in repeated:
+            memo[value] = len(memo)
+            out += b'\x94'  # MEMOIZE
+    elif value is None:
+        out += b'N'
+    elif t is bool:
+        out += b'\x88' if value else b'\x89'  # NEWTRUE / NEWFALSE
+    elif t is dict:
+        out += b'}'  # EMPTY_DICT
+        if value:
+            out += b'('  # MARK
+            for k, v in value.items():
+                _write_opcodes(k, out, repeated, memo)
+                _write_opcodes(v, out, repeated, memo)
+            out += b'u'  # SETITEMS
+    elif t is list:
+        out += b']'  # EMPTY_LIST
+        if value:
+            out += b'('
+            for i in value:
+                _write_opcodes(i, out, repeated, memo)
+            out += b'e'  # APPENDS
+    elif t is int:
+        if 0 <= value < 0x10000:
+            out += b'K' + bytes((value,)) if value < 0x100 else b'M' + struct.pack('<H', value)  # BININT1 / 2
+        elif -0x80000000 <= value < 0x80000000:
+            out += b'J' + struct.pack('<i', value)  # BININT
+        else:
+            raw = value.to_bytes(value.bit_length() // 8 + 1, 'little', signed=True)
+            out += b'\x8a' + bytes((len(raw),)) if len(raw) < 0x100 else b'\x8b' + struct.pack('<I', len(raw))  # LONG1 / 4
+            out += raw
+    elif t is float:
+        out += b'G' + _DOUBLE.pack(value)  # BINFLOAT
+    elif t is bytes:
+        out += b'C' + bytes((len(value),)) if len(value) < 0x100 else b'B' + struct.pack('<I', len(value))  # SHORT_BINBYTES / BINBYTES
+        out += value
+    else:
+        raise UnsupportedType(t)
+
+
+def _dumps_opcodes(value: Any) -> bytes:
+    counts = Counter()
+    _count_strings(value, counts)
+    out = bytearray(OPCODE_TAG)
+    _write_opcodes(value, out, {s for s, n in counts.items() if n > 1}, {})
+    out += b'.'  # STOP
+    return bytes(out)
+
+
+def dumps(value: Any) -> bytes:
+    t = type(value)
+    if t is dict or t is list:
+        try:
+            return _dumps_opcodes(value)
+        except UnsupportedType:
+            pass
+    out = bytearray(FORMAT_TAG)
+    try:
+        _encode(value, out, {})
+    except UnsupportedType:
+        return dill.dumps(value)
+    return bytes(out)
+
+
+def loads(data: bytes) -> Any:
+    tag = data[:1]
+    if tag == OPCODE_TAG:
+        # Only ever written by _dumps_opcodes (no globals); ciphertexts are authenticated before this.
+        return pickle.loads(memoryview(data)[1:])
+    if tag == FORMAT_TAG:
+        value, _ = _decode(data, 1, [])
+        return value
+    # Legacy value, pickled with dill.
+    return dill.loads(data)
@@ -0,0 +1,93 @@
+import hashlib
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from app.database.patient import get_patient_collection
+
+'''
+Upload ledger: one document per uploaded file in the "uploads" collection, keyed by a hash
+of the file's bytes, with the outcome of processing it. A repeat upload of the same file is
+answered from the ledger, without parsing, decrypting or alerting again.
+Entries expire after settings.UPLOAD_LEDGER_TTL_DAYS (TTL index, see app.database.indexes).
+Outcomes never hold plaintext patient data: only a status, a message and the pid_hash.
+Only outcomes worth replaying are recorded: a file that failed (invalid, unparseable, failed) is
+processed again when it is uploaded again. A patient's entries are forgotten when they are deleted.
+'''
+UPLOADED_AT_FIELD = 'uploaded_at'
+LEDGER_STATUSES = ('added', 'test_added', 'duplicate')
+
+
+def upload_key(file_bytes: bytes, kind: str) -> str:
+    return f'{kind}:{hashlib.sha256(file_bytes).hexdigest()}'
+
+
+def _ledger_entry(status: str, message: str, pid_hash: str = None) -> dict:
+    return {'status': status, 'message': message, 'pid_hash': pid_hash,
+            UPLOADED_AT_FIELD: datetime.now(timezone.utc)}
+
+
+async def get_upload_collection():
+    _, database, _ = await get_patient_collection()
+    return database.get_collection('uploads')
+
+
+async def find_uploads(keys: List[str]) -> Dict[str, dict]:
+    '''
+    Ledger entries of the keys that were uploaded before, by key.
+    '''
+    if not keys:
+        return {}
+    collection = await get_upload_collection()
+    return {entry['_id']: entry async for entry in collection.find({'_id': {'$in': list(keys)}})}
+
+
+async def find_upload(key: str) -> Optional[dict]:
+    collection = await get_upload_collection()
+    return await collection.find_one({'_id': key})
+
+
+async def record_upload(key: str, status: str, message: str, pid_hash: str = None):
+    '''
+    Records the outcome of a file's first upload; an existing entry (a concurrent upload won) is kept.
+    Statuses other than LEDGER_STATUSES aren't recorded.
+    '''
+    if status not in LEDGER_STATUSES:
+        return
+    collection = await get_upload_collection()
+    await collection.update_one({'_id': key}, {'$setOnInsert': _ledger_entry(status, message, pid_hash)},
+                                upsert=True)
+
+
+async def record_uploads(outcomes: List[Tuple[str, str, str, Optional[str]]]):
+    '''
+    record_upload for many (key, status, message, pid_hash) in one round trip.
+    '''
+    outcomes = [outcome for outcome in outcomes if outcome[1] in LEDGER_STATUSES]
+    if not outcomes:
+        return
+    collection = await get_upload_collection()
+    await collection.bulk_write([UpdateOne({'_id': key}, {'$setOnInsert': _ledger_entry(status, message, pid_hash)},
+                                           upsert=True)
+                                 for key, status, message, pid_hash in outcomes], ordered=False)
+
+
+async def forget_uploads(pid_hash: str) -> int:
+    '''
+    Deletes the ledger entries of a patient's uploads, so uploading their files again adds them again.
+    Returns how many.
+    '''
+    collection = await get_upload_collection()
+    deleted = await collection.delete_many({'pid_hash': pid_hash})
+    return deleted.deleted_count
+
+
+async def purge_uploads(before: datetime = None) -> int:
+    '''
+    Deletes ledger entries uploaded before a (UTC) datetime, or all of them. Returns how many.
+    '''
+    collection = await get_upload_collection()
+    query = {UPLOADED_AT_FIELD: {'$lt': before}} if before else {}
+    deleted = await collection.delete_many(query)
+    return deleted.deleted_count
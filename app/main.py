@@ -4,8 +4,6 @@ from app.models.patient.patient import ErrorResponseModel
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
-import pymongo
 
 from app.core.config import settings
 
@@ -15,6 +13,10 @@ from app.routes.results import router as ResultsRouter
 from app.routes.validation import router as ValidationRouter
 from app.routes.cue import router as CueRouter
 from app.routes.exports import router as ExportsRouter
+from app.routes.admin import router as AdminRouter
+from app.database.indexes import ensure_indexes
+from app.database.client import open_mongo_client, close_mongo_client, get_database
+from app.utils.workers import shutdown_process_pool
 
 
 def get_application():
@@ -33,14 +35,33 @@ def get_application():
 
 app = get_application()
 
-MONGO_CLIENT = AsyncIOMotorClient(settings.MONGO_URI)
-
 app.include_router(PatientRouter, tags=["Patient"], prefix="/api/patients")
 app.include_router(UploadRouter, tags=["Uploader"], prefix="/api/uploader")
 app.include_router(ResultsRouter, tags=["Results"], prefix="/api/results")
 app.include_router(ValidationRouter, tags=["Validation"], prefix="/api/validation")
 app.include_router(CueRouter, tags=["Cue"], prefix='/api/cue')
 app.include_router(ExportsRouter, tags=["Exports"], prefix='/api/exports')
+app.include_router(AdminRouter, tags=["Admin"], prefix='/api/admin')
+
+
+@app.on_event('startup')
+def connect_mongo():
+    open_mongo_client()
+
+
+@app.on_event('startup')
+async def create_indexes():
+    await ensure_indexes(get_database())
+
+
+@app.on_event('shutdown')
+def shutdown_workers():
+    shutdown_process_pool()
+
+
+@app.on_event('shutdown')
+def disconnect_mongo():
+    close_mongo_client()
 
 
 @app.get("/", tags=["Root"])
@@ -1,13 +1,13 @@
 from pydantic import BaseModel, Field, validator
 from typing import Optional, Union
 from datetime import datetime, timedelta
-from dateparser import parse
 from faker import Faker
 import random
 import json
 
 from app.models.patient.test_results import Test
 from app.models.patient.patient import RandomPatient, PatientSchema
+from app.utils.datetimes import parse_date
 
 CSV_TO_API_FIELD = {
     'Date Completed': 'completedAt',
@@ -40,7 +40,7 @@ class FakeCue:
         self.testType = 'NP-Nasopharyngeal swab'
         self.sendingApplication = 'cue'
         self.notes = 'THIS IS A FAKE RESULT FOR A FAKE PATIENT.'
-        random_test = parse(random.choice(fake_patient.test_results)['lab_slip_collection_datetime'])
+        random_test = parse_date(random.choice(fake_patient.test_results)['lab_slip_collection_datetime'])
         self.completedAt = (random_test + timedelta(days=1)).isoformat()
 
     def json(self):
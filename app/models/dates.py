@@ -1,7 +1,6 @@
 from pydantic import BaseModel, Field, validator, root_validator
 from typing import Optional, Union
 from datetime import datetime, timedelta
-from dateparser import parse
 from faker import Faker
 import random
 import json
@@ -18,8 +17,9 @@ class DateRange(BaseModel):
     def ensure_all_are_datetime(cls, values):
         formatted_values = dict()
         for k,v in values.items():
-            assert to_dt(v) is not None
-            formatted_values[k] = to_dt(v)
+            dt = to_dt(v)
+            assert dt is not None
+            formatted_values[k] = dt
         return formatted_values
 
     @root_validator
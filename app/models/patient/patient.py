@@ -5,7 +5,6 @@ from pydantic.fields import ModelField
 import random
 from faker import Faker
 import json
-from dateparser import parse
 import regex as re
 
 from app.database.crypto import hash_string
@@ -14,6 +13,7 @@ from app.models.patient.test_results import Test, FakeTest
 from app.models.patient.address import Address, FakeAddress
 from app.core.globals import NAME_TO_CODE, FISHERY_NAMES, TRUE_ANALOGS
 from app.utils.sms import alert_sms
+from app.utils.datetimes import parse_date
 
 import asyncio
 
@@ -67,7 +67,7 @@ class RandomPatient:
         return json.loads(json.dumps(vars(self)))
 
     def iso_to_date_triple(self, iso: str, prefix: str):
-        dt: datetime.datetime = parse(iso)
+        dt: datetime.datetime = parse_date(iso)
         m = dt.month
         d = dt.day
         y = dt.year
@@ -93,7 +93,7 @@ class RandomPatient:
 
     def fake_cue(self):
         fake = Faker()
-        slip_datetime = parse(self.test_results[0]['lab_slip_collection_datetime'])
+        slip_datetime = parse_date(self.test_results[0]['lab_slip_collection_datetime'])
         return {'Member Name': self.full_name(),
                 'Date Completed': (
                         slip_datetime + datetime.timedelta(minutes=random.randint(200, 2000))).isoformat(),
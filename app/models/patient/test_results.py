@@ -1,4 +1,3 @@
-import dateparser
 import datetime
 import pytz
 from typing import Optional, Union
@@ -65,13 +64,9 @@ class Test(BaseModel):
 
     @validator(*DATETIME_FIELDS)
     def to_iso(cls, v):
-        try:
-            if v:
-                aware_dt = arrow.get(v).astimezone(pytz.utc)
-                iso_format = aware_dt.isoformat()
-                return iso_format
-        except:
-            return None
+        # ISO-8601 only (naive is UTC); anything else is dropped.
+        aware_dt = to_dt(v, fuzzy=False) if v else None
+        return aware_dt.isoformat() if aware_dt else None
 
     positive: Optional[str]  # 'Whether patient tested positive.
 
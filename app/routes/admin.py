@@ -0,0 +1,55 @@
+from datetime import datetime
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Query
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from app.database.crypto import CipherContext
+from app.database.indexes import index_report
+from app.database.client import get_database, POOL_STATS
+from app.database.uploads import purge_uploads
+from app.models.patient.patient import ResponseModel, ErrorResponseModel
+from app.routes.common import cipher_from_query
+
+router = APIRouter()
+
+
+@router.get('/indexes', response_description='Index verification report.')
+async def get_index_report(cipher: Optional[CipherContext] = Depends(cipher_from_query),
+                           database: AsyncIOMotorDatabase = Depends(get_database)):
+    '''
+    Reports, per collection, registered indexes that are missing or differ from
+    the registry (app.database.indexes), and indexes present but not registered.
+    '''
+    if cipher:
+        report = await index_report(database)
+        return ResponseModel(report, 'Index report generated.')
+    else:
+        return ErrorResponseModel(error='Invalid Master Key', code=400, message='Your key was invalid.')
+
+
+@router.get('/pool', response_description='Mongo connection pool statistics.')
+async def get_pool_stats(cipher: Optional[CipherContext] = Depends(cipher_from_query)):
+    '''
+    Connection pool counters for this worker process: open and checked out connections,
+    requests waiting for one, and checkout waits (mean / max, since startup).
+    A growing wait with checked_out at max_pool_size means the pool is too small.
+    '''
+    if cipher:
+        return ResponseModel(POOL_STATS.snapshot(), 'Pool statistics retrieved.')
+    else:
+        return ErrorResponseModel(error='Invalid Master Key', code=400, message='Your key was invalid.')
+
+
+@router.delete('/uploads', response_description='Upload ledger purged.')
+async def purge_upload_ledger(before: Optional[datetime] = Query(None),
+                              cipher: Optional[CipherContext] = Depends(cipher_from_query)):
+    '''
+    Forgets uploaded files (all of them, or those uploaded before a UTC datetime),
+    so uploading them again processes them again.
+    '''
+    if cipher:
+        deleted = await purge_uploads(before)
+        return ResponseModel({'deleted': deleted}, f'{deleted} uploads purged from the ledger.')
+    else:
+        return ErrorResponseModel(error='Invalid Master Key', code=400, message='Your key was invalid.')
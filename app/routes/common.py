@@ -1,23 +1,107 @@
-import hashlib
-from tqdm import tqdm
-from app.database.crypto import decode_base64_string, encrypt_object, decrypt_object
+from typing import Any, Dict, List, Optional
 
+from fastapi import Query
+
+from app.database.blind_index import tokens_for_test
+from app.database.crypto import (CipherContext, get_cipher_context, record_format, ENVELOPE_FORMAT,
+                                 TEST_SLOT_FIELD)
+from app.database.patient import (push_test_result, set_test_result, update_patient, push_tests_operation,
+                                  set_tests_operation, update_patient_operation, document_version)
+from app.models.crypto import MasterKeyString
+
+
+async def cipher_from_body(master_key_string: MasterKeyString) -> Optional[CipherContext]:
+    '''
+    Validates the master key sent in the request body once per request.
+    Returns None if the key is invalid.
+    NOTE: no Body(...) default on purpose - FastAPI would share (and embed) that one
+    FieldInfo across every route, breaking routes where the key is the only body field.
+    '''
+    return get_cipher_context(master_key_string.key_data)
+
+
+async def cipher_from_query(master_key_string: str = Query("")) -> Optional[CipherContext]:
+    '''
+    Same as cipher_from_body, for endpoints taking the master key as a query param
+    (e.g. GETs and file uploads, where Body(...) and File(...) aren't compatible).
+    '''
+    return get_cipher_context(master_key_string)
 
 
 def encrypt_patient_data(patient_data: dict,
-                         key_data: str):
-    master_key = decode_base64_string(key_data)
-    encrypted_patient_data = encrypt_object(patient_data, master_key=master_key)
+                         cipher: CipherContext):
+    encrypted_patient_data = cipher.encrypt_record(patient_data)
     return encrypted_patient_data
 
 
 def decrypt_patient_data(encrypted_patient_data: dict,
-                         key_data: str):
-    master_key = decode_base64_string(key_data)
-    decrypted_patient_data = decrypt_object(object_data=encrypted_patient_data,
-                                            master_key=master_key)
+                         cipher: CipherContext):
+    decrypted_patient_data = cipher.decrypt_record(encrypted_patient_data)
     return decrypted_patient_data
 
 
-def decrypt_multiple_patients(patients: list, key_data: str):
-    return [decrypt_patient_data(patient, key_data) for patient in patients]
+async def write_test_result(patient_enc: dict, slot, test: dict, cipher: CipherContext) -> bool:
+    '''
+    Writes a single test of a patient: slot is one returned by cipher.open_tests, or None to append.
+    Envelope records only $push / $set the one sealed test. Other formats are re-encrypted
+    as a whole (and the slot is the test's index).
+    The write only applies if the patient is still at the version of patient_enc;
+    returns False otherwise (see mutate_patient).
+    '''
+    pid_hash = patient_enc['pid_hash']
+    version = document_version(patient_enc)
+    if record_format(patient_enc) == ENVELOPE_FORMAT:
+        tokens = tokens_for_test(test, master_key=cipher.master_key)
+        if slot is None:
+            return await push_test_result(pid_hash, version, cipher.seal_test(test), tokens)
+        return await set_test_result(pid_hash, version, cipher.seal_test(test, slot=slot), tokens)
+
+    patient_data = decrypt_patient_data(patient_enc, cipher=cipher)
+    tests = patient_data.get('test_results') or []
+    if slot is None:
+        tests.append(test)
+    else:
+        tests[slot] = test
+    patient_data['test_results'] = tests
+    return bool(await update_patient(pid_hash, encrypt_patient_data(patient_data, cipher=cipher), version))
+
+
+def append_tests_operation(patient_enc: dict, tests: List[dict], cipher: CipherContext):
+    '''
+    A versioned bulk write operation appending tests to a patient (see write_test_result).
+    '''
+    pid_hash = patient_enc['pid_hash']
+    version = document_version(patient_enc)
+    if record_format(patient_enc) == ENVELOPE_FORMAT:
+        tokens = {}
+        for test in tests:
+            for k, v in tokens_for_test(test, master_key=cipher.master_key).items():
+                tokens.setdefault(k, []).extend(v)
+        return push_tests_operation(pid_hash, version, [cipher.seal_test(t) for t in tests], tokens)
+
+    patient_data = decrypt_patient_data(patient_enc, cipher=cipher)
+    patient_data['test_results'] = (patient_data.get('test_results') or []) + tests
+    return update_patient_operation(pid_hash, encrypt_patient_data(patient_data, cipher=cipher), version)
+
+
+def update_tests_operation(patient_enc: dict, tests: Dict[Any, dict], cipher: CipherContext):
+    '''
+    A versioned bulk write operation replacing tests of a patient, by slot (see write_test_result).
+    Envelope records only reseal the changed tests.
+    '''
+    pid_hash = patient_enc['pid_hash']
+    version = document_version(patient_enc)
+    if record_format(patient_enc) == ENVELOPE_FORMAT:
+        tokens = {}
+        for test in tests.values():
+            for k, v in tokens_for_test(test, master_key=cipher.master_key).items():
+                tokens.setdefault(k, []).extend(v)
+        sealed_tests = [cipher.seal_test(tests[t[TEST_SLOT_FIELD]], slot=t[TEST_SLOT_FIELD])
+                        if t[TEST_SLOT_FIELD] in tests else t
+                        for t in patient_enc.get('test_results', [])]
+        return set_tests_operation(pid_hash, version, sealed_tests, tokens)
+
+    patient_data = decrypt_patient_data(patient_enc, cipher=cipher)
+    patient_data['test_results'] = [tests.get(slot, test)
+                                    for slot, test in enumerate(patient_data.get('test_results') or [])]
+    return update_patient_operation(pid_hash, encrypt_patient_data(patient_data, cipher=cipher), version)
@@ -1,4 +1,5 @@
 import base64
+from typing import Optional
 
 import pandas as pd
 from app.models.crypto import MasterKeyString
@@ -8,10 +9,13 @@ from fastapi.security.api_key import APIKeyQuery, APIKeyHeader, APIKey
 from starlette.status import HTTP_403_FORBIDDEN
 
 from app.core.security import KEY_HASHES
-from app.database.crypto import hash_string
+from app.database.crypto import hash_string, get_cipher_context, CipherContext
 from app.models.cue import CueResult
-from app.routes.patient import get_patients, insert_test_result
-from app.utils.csvs.cue_uploads import to_excel_bytes
+from app.routes.common import cipher_from_query
+from app.routes.patient import insert_test_result
+from app.database.patient import retrieve_patients
+from app.models.patient.patient import ErrorResponseModel
+from app.utils.csvs.cue_uploads import to_excel_bytes, PATIENT_EXPORT_PROJECTION
 
 router = APIRouter()
 
@@ -44,22 +48,27 @@ async def validate_api_key(
 
 
 @router.post('/reconcile')
-async def reconcile_missing_cue_data(master_key_string: str,
-                                     # Must be a query param because Body(...) and File(...) aren't compatible.
-                                     file: UploadFile = File(...)):
-    fbytes = await file.read()
-    cue_df = pd.read_excel(fbytes)
-    pats = await get_patients(master_key_string)
-    pats = pats['data'][0]
-    not_in_cue = []
-    for p in pats:
-        if p['patient_id'] not in cue_df['id'].values:
-            not_in_cue.append(p)
+async def reconcile_missing_cue_data(file: UploadFile = File(...),
+                                     # Key must be a query param because Body(...) and File(...) aren't compatible.
+                                     cipher: Optional[CipherContext] = Depends(cipher_from_query)):
+    if cipher:
+        fbytes = await file.read()
+        cue_df = pd.read_excel(fbytes)
+        # Only patient_id and the exported fields are fetched, and the exported
+        # fields are only decrypted for patients missing from CUE.
+        pats_enc = await retrieve_patients(projection=PATIENT_EXPORT_PROJECTION)
+        pats = [cipher.lazy_record(p) for p in pats_enc]
+        not_in_cue = []
+        for p in pats:
+            if p['patient_id'] not in cue_df['id'].values:
+                not_in_cue.append(p)
 
-    if len(not_in_cue) > 0:
-        out_bytes = to_excel_bytes(not_in_cue)
-        encoded = base64.b64encode(out_bytes)
-        return encoded
+        if len(not_in_cue) > 0:
+            out_bytes = to_excel_bytes(not_in_cue)
+            encoded = base64.b64encode(out_bytes)
+            return encoded
+    else:
+        return ErrorResponseModel(error='Invalid Master Key', code=400, message='Your key was invalid.')
 
 
 @router.post('/test_result')
@@ -70,7 +79,7 @@ async def handle_cue_test_result(api_key: APIKey = Depends(validate_api_key),
     res = await insert_test_result(
         patient_id=cue_data.patient_id,
         test_result=as_test,
-        master_key_string=MasterKeyString(key_data=str(api_key))
+        cipher=get_cipher_context(str(api_key))
     )
 
     return res
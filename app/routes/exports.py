@@ -4,16 +4,19 @@ import base64
 from typing import List, Optional
 
 import pandas as pd
-from fastapi import APIRouter, Body
+from fastapi import APIRouter, Body, Depends
 
 from app.core.globals import CAMAI_TO_AK_EXPORT_FIELDS, AK_EXPORT_DEFAULTS, AK_EXPORT_COLUMNS
 from app.core.types import Json
-from app.database.crypto import validate_key, DO_NOT_ENCRYPT
-from app.database.patient import retrieve_patients
-from app.routes.common import decrypt_multiple_patients
+from app.database.crypto import CipherContext, DO_NOT_ENCRYPT, decrypt_multiple_patients
+from app.database.patient import retrieve_patients, patient_query
+from app.database.blind_index import all_of, date_range_query
+from app.routes.common import cipher_from_body
 from app.models.crypto import MasterKeyString
 from app.models.patient.patient import ErrorResponseModel
 from app.models.dates import DateRange
+from app.models.patient.address import Address
+from app.models.patient.test_results import Test
 from app.utils.csvs.cue_uploads import to_excel_bytes, df_to_bytes
 from app.utils.datetimes import to_dt
 
@@ -21,9 +24,8 @@ router = APIRouter()
 
 
 @router.post('/gen_cue_excel')
-async def generate_cue_excel_from_pats(pats: List[Json] = Body(...), master_key_string: MasterKeyString = Body(...)):
-    valid = await validate_key(master_key_string.key_data)
-    if valid:
+async def generate_cue_excel_from_pats(pats: List[Json] = Body(...), cipher: Optional[CipherContext] = Depends(cipher_from_body)):
+    if cipher:
         out_bytes = to_excel_bytes(pats)
         encoded = base64.b64encode(out_bytes)
         return {'excel_bytes_base_64': encoded}
@@ -48,23 +50,53 @@ def flatten_pat(p):
     return flattened_records
 
 
+# Report columns that are derived from other patient fields.
+DERIVED_REPORT_COLUMNS = {'phone': ['local_phone', 'cell_phone', 'home_phone'],
+                          'ethnicity': ['race_ethnicity']}
+
+
+def report_projection(columns: List[str]) -> List[str]:
+    '''
+    The top level patient fields needed to build flattened (flatten_pat) rows with these columns.
+    '''
+    # flatten_pat always unpacks these two; their own fields become columns.
+    fields = {'physical_address', 'test_results'}
+    for c in columns:
+        if c in DERIVED_REPORT_COLUMNS:
+            fields.update(DERIVED_REPORT_COLUMNS[c])
+        elif c not in Address.__fields__ and c not in Test.__fields__:
+            fields.add(c)
+    return sorted(fields)
+
+
+AK_REPORT_PROJECTION = report_projection(list(CAMAI_TO_AK_EXPORT_FIELDS.keys()) + ['ethnicity'])
+
+
 @router.post('/gen_ak_state_report')
 async def generate_ak_state_report(
         query: dict = Body(None, description='Queries to filter the results, if any. Must be equivalence based.'),
         date_range: Optional[DateRange] = Body(None, description="Start and end date as iso strings (UTC encoded)"),
-        master_key_string: MasterKeyString = Body(...)):
-    valid = await validate_key(master_key_string.key_data)
-    if valid:
+        cipher: Optional[CipherContext] = Depends(cipher_from_body)):
+    if cipher:
         mongo_query = {}
         df_query = {}
         if query:
-            # Include un-encrypted fields in patient search to speed things up.
-            mongo_query = {k: v for k, v in query.items() if k in DO_NOT_ENCRYPT}
-            # Other encrypted fields must be filtered after the fact (from the df)
+            # Push un-encrypted and blind-indexed fields down to Mongo to speed things up.
+            mongo_query = patient_query(query, master_key=cipher.master_key)
+            # Encrypted fields must (also) be filtered after the fact (from the df):
+            # blind index matches are per patient, the df has one row per test.
             df_query = {k: v for k, v in query.items() if k not in DO_NOT_ENCRYPT}
-
-        pats_enc = await retrieve_patients(query=mongo_query)
-        pats = decrypt_multiple_patients(pats_enc, key_data=master_key_string.key_data)
+        if date_range:
+            # Only fetch patients with a test collected on one of the days in range (if the range is short enough).
+            mongo_query = all_of(mongo_query, date_range_query('collection_day',
+                                                               date_range.start_datetime,
+                                                               date_range.end_datetime,
+                                                               master_key=cipher.master_key))
+
+        # Only fetch and decrypt what the report (and the df filters) use.
+        projection = sorted(set(AK_REPORT_PROJECTION) | set(report_projection(list(df_query.keys()))))
+        pats_enc = await retrieve_patients(query=mongo_query, projection=projection)
+        pats = await decrypt_multiple_patients(pats_enc, cipher=cipher, projection=projection)
         records = []
         for p in pats:
             records += flatten_pat(p)
@@ -76,7 +108,7 @@ async def generate_ak_state_report(
             df = df.query(query_string)
 
         # Filter dates!
-        # Do that here.
+        # Exact filtering; the date bucket lookup above only works in whole days.
         #####
         if date_range:
             df = df[df.lab_slip_collection_datetime.apply(to_dt).between(date_range.start_datetime, date_range.end_datetime)]
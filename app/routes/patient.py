@@ -1,8 +1,11 @@
+import json
 import numpy as np
 import pytz
-from typing import Optional, List, Tuple
+from typing import Any, Optional, List, Tuple
 
-from fastapi import APIRouter, Body, UploadFile, File
+from fastapi import APIRouter, Body, UploadFile, File, BackgroundTasks, Depends, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from datetime import timedelta, datetime
 import arrow
 
@@ -10,19 +13,26 @@ from app.database.patient import (
     add_patient,
     retrieve_patient,
     retrieve_patients,
+    iterate_patients,
     delete_patient,
     update_patient,
+    mutate_patient,
+    document_version,
+    WriteConflict,
     query_db, ensure_pid_unique
 )
 
 from app.database.crypto import (
     hash_string,
-    decode_base64_string,
-    encrypt_object,
-    decrypt_object,
-    validate_key
+    CipherContext,
+    LazyRecord,
+    decrypt_multiple_patients
 )
 
+from app.database.migrations import migrate_patients
+from app.database.pid_index import forget_pid
+from app.database.uploads import forget_uploads
+
 from app.models.crypto import MasterKeyString
 
 from app.models.patient.patient import (
@@ -34,9 +44,11 @@ from app.models.patient.patient import (
 
 from app.models.patient.test_results import Test
 from app.routes.common import (
+    cipher_from_body,
+    cipher_from_query,
     encrypt_patient_data,
     decrypt_patient_data,
-    decrypt_multiple_patients
+    write_test_result
 )
 
 from app.core.types import Json
@@ -46,10 +58,9 @@ router = APIRouter()
 
 @router.post('/', response_description='Patient data added to the DB!')
 async def add_patient_data(patient: PatientSchema = Body(...),
-                           master_key_string: MasterKeyString = Body(...)
+                           cipher: Optional[CipherContext] = Depends(cipher_from_body)
                            ):
-    valid = await validate_key(master_key_string.key_data)
-    if valid:
+    if cipher:
         patient_data = patient.dict()
         # Make sure a pid_hash is included for searchability!
         patient_id, pid_hash, pid_altered = await ensure_pid_unique(patient_data)
@@ -58,7 +69,7 @@ async def add_patient_data(patient: PatientSchema = Body(...),
         patient_data['pid_hash'] = pid_hash
 
         encrypted_patient = encrypt_patient_data(patient_data=patient_data,
-                                                 key_data=master_key_string.key_data)
+                                                 cipher=cipher)
 
         _ = await add_patient(encrypted_patient)
         return ResponseModel(data=[{'patient_data': patient_data,
@@ -71,27 +82,46 @@ async def add_patient_data(patient: PatientSchema = Body(...),
 
 @router.get('', response_description='Patients retrieved!')
 @router.get('/', response_description='Patients retrieved!')
-async def get_patients(master_key_string: str = ""):
-    valid = await validate_key(master_key_string)
-    if valid:
-        encrypted_patients = await retrieve_patients()
+async def get_patients(cipher: Optional[CipherContext] = Depends(cipher_from_query),
+                       projection: Optional[List[str]] = Query(None, description='Only return these (top level) fields.')):
+    if cipher:
+        encrypted_patients = await retrieve_patients(projection=projection)
         if encrypted_patients:
-            patients = decrypt_multiple_patients(patients=encrypted_patients,
-                                                 key_data=master_key_string)
+            patients = await decrypt_multiple_patients(patients=encrypted_patients,
+                                                       cipher=cipher,
+                                                       projection=projection)
             return ResponseModel(patients, 'Patient data retrieved successfully')
         return ResponseModel(None, 'Empty list returned.')
     else:
         return ErrorResponseModel(error='Invalid Master Key', code=400, message='Your key was invalid.')
 
 
+@router.get('/stream', response_description='Patients streamed as newline-delimited JSON!')
+async def stream_patients(batch_size: Optional[int] = Query(None, ge=1),
+                          cipher: Optional[CipherContext] = Depends(cipher_from_query)):
+    '''
+    Same data as GET /api/patients, as one JSON patient per line (application/x-ndjson).
+    Patients are read, decrypted and sent batch_size at a time, so memory is bounded by
+    the batch size and clients can start rendering as soon as the first batch arrives.
+    '''
+    if cipher:
+        async def patient_lines():
+            async for batch in iterate_patients(batch_size=batch_size):
+                patients = await decrypt_multiple_patients(patients=batch, cipher=cipher)
+                yield ''.join(json.dumps(jsonable_encoder(p)) + '\n' for p in patients)
+
+        return StreamingResponse(patient_lines(), media_type='application/x-ndjson')
+    else:
+        return ErrorResponseModel(error='Invalid Master Key', code=400, message='Your key was invalid.')
+
+
 @router.get('/{patient_id}', response_description='Patient data retrieved')
-async def get_patient(patient_id, master_key_string: str = ""):
-    valid = await validate_key(master_key_string)
-    if valid:
+async def get_patient(patient_id, cipher: Optional[CipherContext] = Depends(cipher_from_query)):
+    if cipher:
         pid_hash = hash_string(patient_id)
         patient = await retrieve_patient(pid_hash)
         if patient:
-            patient_decrypted = decrypt_patient_data(encrypted_patient_data=patient, key_data=master_key_string)
+            patient_decrypted = decrypt_patient_data(encrypted_patient_data=patient, cipher=cipher)
             return ResponseModel(patient_decrypted, 'Patient data retrieved sucessfully')
         return ErrorResponseModel('An error occurred', 404, f'Patient does not exist.')
     else:
@@ -101,23 +131,28 @@ async def get_patient(patient_id, master_key_string: str = ""):
 @router.put('/{patient_id}')
 async def update_patient_data(patient_id: str,
                               req: PatientSchema = Body(...),
-                              master_key_string: MasterKeyString = Body(...)):
-    valid = await validate_key(master_key_string.key_data)
-    if valid:
+                              cipher: Optional[CipherContext] = Depends(cipher_from_body)):
+    if cipher:
         pid_hash = hash_string(patient_id)
-        patient_enc = await retrieve_patient(pid_hash)
-        patient_data = decrypt_patient_data(encrypted_patient_data=patient_enc,
-                                            key_data=master_key_string.key_data)
-        update_data = req.dict()
-        for k in update_data:
-            patient_data[k] = update_data[k]
 
-        # Re-validate the updated data
-        validated_updated = PatientSchema(**patient_data)
+        async def apply_update(patient_enc):
+            patient_data = decrypt_patient_data(encrypted_patient_data=patient_enc,
+                                                cipher=cipher)
+            update_data = req.dict()
+            for k in update_data:
+                patient_data[k] = update_data[k]
 
-        updated_patient_enc = encrypt_patient_data(validated_updated.dict(), key_data=master_key_string.key_data)
+            # Re-validate the updated data
+            validated_updated = PatientSchema(**patient_data)
 
-        updated_patient = await update_patient(pid_hash, updated_patient_enc)
+            updated_patient_enc = encrypt_patient_data(validated_updated.dict(), cipher=cipher)
+
+            return await update_patient(pid_hash, updated_patient_enc, document_version(patient_enc))
+
+        try:
+            updated_patient = await mutate_patient(pid_hash, apply_update)
+        except WriteConflict:
+            return write_conflict_error(patient_id)
         if updated_patient:
             return ResponseModel(
                 f"Patient with PID: {patient_id} update was successful",
@@ -130,6 +165,12 @@ async def update_patient_data(patient_id: str,
         )
 
 
+def write_conflict_error(patient_id: str):
+    return ErrorResponseModel(error='Write conflict',
+                              code=409,
+                              message=f'Patient with PID {patient_id} is being modified concurrently; please retry.')
+
+
 def handle_incomplete_tests(incomplete_tests, new_test):
     new_test_dt = arrow.get(new_test['test_performed_datetime']).astimezone(pytz.utc)
     best_match = None
@@ -155,66 +196,49 @@ def handle_incomplete_tests(incomplete_tests, new_test):
 
 @router.put("/{patient_id}/test_result")
 async def insert_test_result(patient_id: str,
-                             master_key_string: MasterKeyString = Body(...),
+                             cipher: Optional[CipherContext] = Depends(cipher_from_body),
                              test_result: Test = Body(...)):
-    valid = await validate_key(master_key_string.key_data)
-    if valid:
+    if cipher:
         pid_hash = hash_string(patient_id.upper())
 
-        patient_enc = await retrieve_patient(pid_hash)
-
-        if not patient_enc:
-            return ErrorResponseModel(error='Patient not found.',
-                                      code=400,
-                                      message=f'Patient with PID {patient_id} not found in our database.')
-
-        patient_data = decrypt_patient_data(encrypted_patient_data=patient_enc,
-                                            key_data=master_key_string.key_data)
+        new_test_dict = test_result.dict()
+        if not new_test_dict['test_reported_datetime']:
+            new_test_dict['test_reported_datetime'] = datetime.now().isoformat()
 
-        # Find incomplete (e.g. lab slip data only) test results.
-        patient_tests = patient_data['test_results']
+        async def add_result(patient_enc):
+            # Only the tests are needed (and decrypted); slots identify them for the write.
+            patient_tests = cipher.open_tests(patient_enc)
+
+            # Make sure this test hasn't already been logged
+            for _, pt in patient_tests:
+                if test_result.test_id == pt['test_id']:
+                    return ErrorResponseModel(
+                        error='This test result already uploaded!',
+                        code=400,
+                        message=f'Test with test_id {test_result.test_id} already exists in our system.'
+                    )
 
-        # Make sure this test hasn't already been logged
-        for pt in patient_tests:
-            if test_result.test_id == pt['test_id']:
-                return ErrorResponseModel(
-                    error='This test result already uploaded!',
-                    code=400,
-                    message=f'Test with test_id {test_result.test_id} already exists in our system.'
-                )
+            # Find incomplete (e.g. lab slip data only) test results.
+            incomplete_tests = [(slot, t) for slot, t in patient_tests if not t.get('test_id')]
+            if not incomplete_tests or len(incomplete_tests) < 1:
+                return ErrorResponseModel(error='No Corresponding Lab Slip', code=400,
+                                          message=f'There are no incomplete tests for this patient (PID: {patient_id}). Likely you need to upload their Lab Order Form PDF first.')
 
-        incomplete_tests = [(test_idx, t) for test_idx, t in enumerate(patient_tests) if not t.get('test_id')]
-        if not incomplete_tests or len(incomplete_tests) < 1:
-            return ErrorResponseModel(error='No Corresponding Lab Slip', code=400,
-                                      message=f'There are no incomplete tests for this patient (PID: {patient_id}). Likely you need to upload their Lab Order Form PDF first.')
+            test_slot, test_to_update = handle_incomplete_tests(incomplete_tests, new_test_dict)
+            if test_slot is not None and isinstance(test_to_update, dict):
+                for k in ['test_id', 'test_performed_datetime', 'test_reported_datetime', 'positive']:
+                    test_to_update[k] = new_test_dict[k]
 
-        new_test_dict = test_result.dict()
-        if not new_test_dict['test_reported_datetime']:
-            new_test_dict['test_reported_datetime'] = datetime.now().isoformat()
-        test_idx, test_to_update = handle_incomplete_tests(incomplete_tests, new_test_dict)
-        if isinstance(test_idx, int) and isinstance(test_to_update, dict):
-            for k in ['test_id', 'test_performed_datetime', 'test_reported_datetime', 'positive']:
-                test_to_update[k] = new_test_dict[k]
-            patient_tests[test_idx] = test_to_update
-            patient_data['test_results'] = patient_tests
-            patient_enc = encrypt_patient_data(patient_data, key_data=master_key_string.key_data)
-
-            updated_patient = await update_patient(pid_hash, patient_enc)
-            if updated_patient:
-                return ResponseModel(
+                # False (the patient changed since it was read) makes mutate_patient retry.
+                updated = await write_test_result(patient_enc, test_slot, test_to_update, cipher=cipher)
+                return updated and ResponseModel(
                     f"Patient with PID: {patient_id} update was successful",
                     "Patient updated successfully", )
             else:
                 return ErrorResponseModel(
-                    error='Unable to update patient',
+                    error='Not able to add result to patient tests',
                     code=400,
-                    message=f'Unable to update patient with PID {patient_id}'
-                )
-        else:
-            return ErrorResponseModel(
-                error='Not able to add result to patient tests',
-                code=400,
-                message=f'''
+                    message=f'''
 Patient with PID {patient_id} had incomplete tests,
 but the result you are trying to upload could 
 not be matched with any of them. Likely this 
@@ -222,23 +246,35 @@ is due to 1) a missing lab slip upload, or
 2) a missing lab_slip_completed_datetime field in 
 a test that was already uploaded. Please check 
 your patient records on the results page.'''.strip().replace('\n', ' ')
-            )
+                )
+
+        try:
+            response = await mutate_patient(pid_hash, add_result)
+        except WriteConflict:
+            return write_conflict_error(patient_id)
+        if response is None:
+            return ErrorResponseModel(error='Patient not found.',
+                                      code=400,
+                                      message=f'Patient with PID {patient_id} not found in our database.')
+        return response
 
     else:
         return ErrorResponseModel(error='Invalid Master Key', code=400, message='Your key was invalid.')
 
 
-def get_test_by_id(tests: List[Json], test_id: str) -> Tuple[int, Json]:
-    for i, t in enumerate(tests):
-        if t['test_id'] == test_id:
-            return i, t
+def get_test_by_id(patient: LazyRecord, test_id: str) -> Tuple[Any, Json]:
+    '''
+    (slot, test) of the patient's test with this test_id, or (None, None).
+    Only decrypts what it has to (just the matching test, for envelope records).
+    '''
+    return patient.find_test(test_id)
 
 
 @router.put("/{patient_id}/test_result/{test_id}")
 async def update_test_result(
         patient_id: str,
         test_id: str,
-        master_key_string: MasterKeyString = Body(...),
+        cipher: Optional[CipherContext] = Depends(cipher_from_body),
         test_result_updates: Json = Body(...)
 ):
 
@@ -249,35 +285,21 @@ async def update_test_result(
             message = f"Submitted test has no Test ID (patient_id {patient_id}); please make sure to upload CUE results first!"
         )
 
-    valid = await validate_key(master_key_string.key_data)
-    if valid:
+    if cipher:
         pid_hash = hash_string(patient_id)
-        patient = await retrieve_patient(pid_hash)
-        if patient:
-            patient_decrypted = decrypt_patient_data(encrypted_patient_data=patient,
-                                                     key_data=master_key_string.key_data)
-            test_idx, test_to_update = get_test_by_id(patient_decrypted['test_results'], test_id)
+
+        async def apply_updates(patient):
+            test_slot, test_to_update = get_test_by_id(cipher.lazy_record(patient), test_id)
             if test_to_update:
                 # For every key in the update, update in the old test.
                 for k, v in test_result_updates.items():
                     test_to_update[k] = v
-                # Update the test at the correct index
-                patient_decrypted['test_results'][test_idx] = test_to_update
-                # Encrypt the updated patient
-                updated_patient_enc = encrypt_patient_data(patient_decrypted,
-                                                           key_data=master_key_string.key_data)
-
-                # Update the encrypted data in Mongo
-                updated_patient = await update_patient(pid_hash, updated_patient_enc)
-                if updated_patient:
-                    return ResponseModel(
-                        f"Patient with PID: {patient_id}, TID: {test_id} update was successful",
-                        "Patient updated successfully",
-                    )
-                return ErrorResponseModel(
-                    error="Update error",
-                    code=404,
-                    message=f"There was an error updating the test data for PID: {patient_id}, TID: {test_id}.",
+
+                # Write only this test back to Mongo (False makes mutate_patient retry).
+                updated = await write_test_result(patient, test_slot, test_to_update, cipher=cipher)
+                return updated and ResponseModel(
+                    f"Patient with PID: {patient_id}, TID: {test_id} update was successful",
+                    "Patient updated successfully",
                 )
 
             else:
@@ -287,18 +309,23 @@ async def update_test_result(
                     message=f'Test with Test ID {test_id} not found for patient with PID {patient_id}.'
                 )
 
+        try:
+            return await mutate_patient(pid_hash, apply_updates)
+        except WriteConflict:
+            return write_conflict_error(patient_id)
 
     else:
         return ErrorResponseModel(error='Invalid Master Key', code=400, message='Your key was invalid.')
 
 
 @router.delete('/{patient_id}', response_description="Patient data deleted from the database")
-async def delete_patient_data(patient_id: str, master_key_string: MasterKeyString = Body(...)):
-    valid = await validate_key(master_key_string.key_data)
-    if valid:
+async def delete_patient_data(patient_id: str, cipher: Optional[CipherContext] = Depends(cipher_from_body)):
+    if cipher:
         pid_hash = hash_string(patient_id)
         deleted_patient = await delete_patient(pid_hash)
         if deleted_patient:
+            forget_pid(patient_id, pid_hash)
+            await forget_uploads(pid_hash)
             return ResponseModel(
                 f"Patient with ID: {patient_id} removed", "Patient deleted successfully"
             )
@@ -312,13 +339,14 @@ async def delete_patient_data(patient_id: str, master_key_string: MasterKeyStrin
 @router.post('/query', response_description='MongoDB query performed on patient database!')
 async def do_db_query(query: dict = Body(...),
                       decrypt: bool = Body(...),
-                      master_key_string: MasterKeyString = Body(...)):
-    valid = await validate_key(master_key_string.key_data)
-    if valid:
-        query_result = await query_db(query)
+                      projection: Optional[List[str]] = Body(None, description='Only return these (top level) fields.'),
+                      cipher: Optional[CipherContext] = Depends(cipher_from_body)):
+    if cipher:
+        query_result = await query_db(query, projection=projection)
         if query_result:
             if decrypt:
-                decrypted_query_result = decrypt_multiple_patients(query_result, key_data=master_key_string.key_data)
+                decrypted_query_result = await decrypt_multiple_patients(query_result, cipher=cipher,
+                                                                         projection=projection)
                 return decrypted_query_result
             else:
                 return query_result
@@ -328,3 +356,18 @@ async def do_db_query(query: dict = Body(...),
             )
     else:
         return ErrorResponseModel(error='Invalid Master Key', code=400, message='Your key was invalid.')
+
+
+@router.post('/migrate_encryption', response_description='Patient storage migration started.')
+async def migrate_encryption(background_tasks: BackgroundTasks,
+                             cipher: Optional[CipherContext] = Depends(cipher_from_body)):
+    '''
+    Re-encrypt every outdated patient document (legacy per-leaf encryption,
+    or missing blind index tokens) in the current storage format.
+    Runs in the background; the response returns as soon as the migration is scheduled.
+    '''
+    if cipher:
+        background_tasks.add_task(migrate_patients, cipher)
+        return ResponseModel(None, 'Patient storage migration started.')
+    else:
+        return ErrorResponseModel(error='Invalid Master Key', code=400, message='Your key was invalid.')
@@ -1,26 +1,40 @@
 import base64
+import io
+import zipfile
 
 from app.models.crypto import MasterKeyString
-from fastapi import APIRouter, File, UploadFile, Body
-from typing import List
+from fastapi import APIRouter, File, UploadFile, Body, Depends
+from starlette import datastructures
+from typing import Any, Dict, List, Optional, Tuple, Union
 from collections import defaultdict
 
 from app.core.types import Json
 
 from app.models.patient.patient import ErrorResponseModel, ResponseModel
 
-from app.database.crypto import validate_key, hash_string
-from app.database.patient import (update_patient, add_patient, retrieve_patient, ensure_pid_unique)
+from app.database.crypto import CipherContext, hash_string, TEST_TOKEN_FIELD
+from app.database.uploads import upload_key, find_upload, find_uploads, record_upload, record_uploads
+from app.database.pid_index import get_pid_index, pid_candidates
+from app.core.config import settings
+from app.database.patient import (add_patient, add_patients, retrieve_patients, bulk_write_patients,
+                                  ensure_pid_unique, mutate_patient, WriteConflict)
 
 from app.routes.common import (
+    cipher_from_query,
     encrypt_patient_data,
-    decrypt_patient_data,
+    write_test_result,
+    append_tests_operation,
+    update_tests_operation,
 )
+from app.routes.patient import handle_incomplete_tests
+from app.models.patient.test_results import Test
 
-from app.utils.pdfs.pdf_extractor import process_lab_file
-from app.utils.images.image_processing import process_image_pdf_to_txt
-from app.utils.text.result_text_parsing import scrape_patient_data
+from app.utils.pdfs.pdf_extractor import process_lab_file, lab_slip_db_checks, parse_lab_slips
+from app.utils.pdfs.cepheid import parse_cepheid_report
+from app.utils.images.image_processing import ocr_pdf
+from app.utils.text.result_text_parsing import scrape_patient_data, find_labelled_pid
 from app.utils.sms import alert_sms
+from app.utils.workers import map_chunks, run_document_job, DocumentJobError, InvalidDocument
 
 from app.utils.csvs.cue_uploads import PATIENT_EXPORT_FIELDS, CUE_IMPORT_FIELDS, get_csv_data_from_pat, to_excel_bytes
 
@@ -30,17 +44,197 @@ FILE_TYPES_AND_PROCESS_MODES = {'lab': ['pdf'],
                                 'results': ['pdf', 'ocr', 'cepheid']}
 
 
-async def search_for_existing_patient(extracted_data):
-    retrieved = await retrieve_patient(pid_hash=hash_string(extracted_data['patient_id']))
-    return retrieved
+class BatchTooLarge(InvalidDocument):
+    error = 'Batch too large'
+
+
+def expand_uploads(uploads: List[Tuple[str, bytes]]) -> List[Tuple[str, bytes]]:
+    '''
+    (name, bytes) of every lab slip: uploaded PDFs as is, and the PDFs inside uploaded zip archives.
+    Raises BatchTooLarge if there are more than settings.BATCH_UPLOAD_MAX_FILES files or
+    settings.BATCH_UPLOAD_MAX_BYTES bytes, checked against the archives' listings before anything is unzipped,
+    and InvalidDocument if an archive is corrupt.
+    '''
+    listed = []
+    try:
+        for name, data in uploads:
+            if zipfile.is_zipfile(io.BytesIO(data)):
+                archive = zipfile.ZipFile(io.BytesIO(data))
+                members = [member for member in archive.infolist()
+                           if not member.is_dir() and not member.filename.startswith('__MACOSX/')
+                           and member.filename.lower().endswith('.pdf')]
+                listed += [(f'{name}/{member.filename}', archive, member, member.file_size) for member in members]
+            else:
+                listed.append((name, None, data, len(data)))
+        if len(listed) > settings.BATCH_UPLOAD_MAX_FILES:
+            raise BatchTooLarge(f'{len(listed)} lab slips uploaded; at most {settings.BATCH_UPLOAD_MAX_FILES} '
+                                f'are allowed per batch.')
+        size = sum(file_size for _, _, _, file_size in listed)
+        if size > settings.BATCH_UPLOAD_MAX_BYTES:
+            raise BatchTooLarge(f'{size} bytes of lab slips uploaded (unzipped); at most '
+                                f'{settings.BATCH_UPLOAD_MAX_BYTES} are allowed per batch.')
+        # Reading a member never returns more than its listed file_size.
+        return [(name, archive.read(data) if archive else data) for name, archive, data, _ in listed]
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, NotImplementedError, EOFError) as e:
+        raise InvalidDocument(f'A zip archive could not be read ({e}).')
+
+
+def repeat_upload_message(entry: dict) -> str:
+    return f"This file was already uploaded ({entry['uploaded_at']:%Y-%m-%d %H:%M} UTC): {entry['message']}"
+
+
+def repeat_upload_response(entry: dict) -> dict:
+    '''
+    The answer to a lab slip uploaded before, from its ledger entry: the same error as any
+    duplicate slip, whatever the first upload did.
+    '''
+    return ErrorResponseModel(error='Unable to update patient', code=400, message=repeat_upload_message(entry))
+
+
+def lab_slip_tests(patient_enc: dict, cipher: CipherContext) -> set:
+    return {t.get('lab_slip_collection_datetime') for _, t in cipher.open_tests(patient_enc)}
+
+
+async def write_lab_slips(slips_by_pid: Dict[str, List[Tuple[dict, dict]]], cipher: CipherContext):
+    '''
+    Writes parsed lab slips, grouped by PID as (manifest entry, patient data) pairs,
+    and fills in each slip's manifest entry.
+    Existing patients are read in one query and updated in one bulk_write;
+    new patients (all of their slips' tests in one record) are inserted in one insert_many.
+    '''
+    pids = {hash_string(pid): pid for pid in slips_by_pid}
+    existing = {p['pid_hash']: p for p in await retrieve_patients({'pid_hash': {'$in': list(pids)}})}
+
+    new_patients, new_entries = [], []
+    operations, updates = [], []
+    for pid_hash, pid in pids.items():
+        patient_enc = existing.get(pid_hash)
+        # Skip slips already in the db, or repeated within the batch.
+        known = lab_slip_tests(patient_enc, cipher) if patient_enc else set()
+        fresh = []
+        for entry, slip in slips_by_pid[pid]:
+            test_dt = slip['test_results'][0]['lab_slip_collection_datetime']
+            if test_dt in known:
+                entry.update(status='duplicate', message=f'This lab slip was already uploaded (tested at {test_dt}).')
+            else:
+                known.add(test_dt)
+                fresh.append((entry, slip))
+        if not fresh:
+            continue
+        tests = [slip['test_results'][0] for _, slip in fresh]
+        entries = [entry for entry, _ in fresh]
+        if patient_enc:
+            operations.append(append_tests_operation(patient_enc, tests, cipher))
+            updates.append((pid_hash, tests, entries))
+        else:
+            patient_data = dict(fresh[0][1], test_results=tests)
+            patient_data['patient_id'], patient_data['pid_hash'], _ = await ensure_pid_unique(patient_data,
+                                                                                             pid_exists=False)
+            await lab_slip_db_checks(patient_data)
+            patient_data = {k: v for k, v in patient_data.items() if v is not None}
+            new_patients.append(encrypt_patient_data(patient_data=patient_data, cipher=cipher))
+            new_entries.append(entries)
+
+    errors = await add_patients(new_patients)
+    for entries, error in zip(new_entries, errors):
+        for entry in entries:
+            if error:
+                entry.update(status='failed', message=f'Unable to add patient ({error}); please upload this file again.')
+            else:
+                entry.update(status='added', message='Patient added to database.')
+
+    if await bulk_write_patients(operations) < len(operations):
+        # Some patients changed since they were read: redo them one at a time.
+        # Tests the bulk write did add are found as already there, so this is safe to repeat.
+        for pid_hash, tests, entries in updates:
+            async def append_missing(patient_enc, tests=tests):
+                known = lab_slip_tests(patient_enc, cipher)
+                missing = [t for t in tests if t['lab_slip_collection_datetime'] not in known]
+                if not missing:
+                    return True
+                return await bulk_write_patients([append_tests_operation(patient_enc, missing, cipher)]) > 0
+
+            try:
+                await mutate_patient(pid_hash, append_missing)
+            except WriteConflict:
+                for entry in entries:
+                    entry.update(status='failed', message='Patient is being modified concurrently; please upload this file again.')
+    for _, _, entries in updates:
+        for entry in entries:
+            if not entry['status']:
+                entry.update(status='test_added', message='Test data added to existing patient.')
+
+
+@router.post('/lab/batch', response_description='Lab slips processed!')
+async def process_lab_batch(files: List[UploadFile] = File(...),
+                            # Key must be a query param because Body(...) and File(...) aren't compatible.
+                            cipher: Optional[CipherContext] = Depends(cipher_from_query),
+                            ):
+    '''
+    Many lab slip PDFs, and/or zip archives of them, in one request.
+    Slips are parsed concurrently on the process pool, grouped by PID and written with bulk operations.
+    Files already in the upload ledger are reported as duplicates without being parsed.
+    Returns a manifest with, per file: its status (added, test_added, duplicate, invalid,
+    unparseable or failed), PID and a message. Failures are alerted in a single SMS.
+    '''
+    if cipher:
+        try:
+            uploads = expand_uploads([(f.filename, await f.read()) for f in files])
+        except DocumentJobError as e:
+            return ErrorResponseModel(error=e.error, code=e.code, message=str(e))
+
+        manifest = [{'file': name, 'status': None, 'pid': None, 'message': None} for name, _ in uploads]
+        # Files uploaded before are answered from the upload ledger, and not parsed again.
+        keys = [upload_key(data, 'lab') for _, data in uploads]
+        previous_uploads = await find_uploads(keys)
+        for entry, key in zip(manifest, keys):
+            if key in previous_uploads:
+                entry.update(status='duplicate', message=repeat_upload_message(previous_uploads[key]))
+        new_uploads = [(entry, key, data) for entry, key, (_, data) in zip(manifest, keys, uploads)
+                       if key not in previous_uploads]
+
+        # A batch waits for document pool slots as long as it takes, with a timeout per chunk.
+        async def parse_chunk(fn, files):
+            return await run_document_job(fn, files, timeout=settings.DOCUMENT_JOB_TIMEOUT_S * len(files),
+                                          admission_timeout=None)
+
+        try:
+            parsed = await map_chunks(parse_lab_slips, [data for _, _, data in new_uploads],
+                                      settings.BATCH_UPLOAD_CHUNK_SIZE, runner=parse_chunk)
+        except DocumentJobError as e:
+            return ErrorResponseModel(error=e.error, code=e.code, message=str(e))
+
+        slips_by_pid = defaultdict(list)
+        for (entry, _, _), result in zip(new_uploads, parsed):
+            if 'patient' in result:
+                entry['pid'] = result['patient']['patient_id']
+                slips_by_pid[entry['pid']].append((entry, result['patient']))
+            elif result['error'] == 'invalid':
+                entry.update(status='invalid', message='Missing fields: ' + ', '.join(result['missing']))
+            else:
+                entry.update(status='unparseable', message='Could not be parsed by PDFExtractor.')
+
+        await write_lab_slips(slips_by_pid, cipher)
+        # Failures aren't recorded in the ledger (see LEDGER_STATUSES), so uploading them again retries them.
+        await record_uploads([(key, entry['status'], entry['message'], entry['pid'] and hash_string(entry['pid']))
+                              for entry, key, _ in new_uploads])
+
+        failed = [entry for entry in manifest if entry['status'] in ('invalid', 'unparseable', 'failed')]
+        if failed:
+            msg = f'{len(failed)} of {len(manifest)} lab slips in a batch upload failed:\n'
+            msg += '\n'.join([f"{entry['file']}: {entry['status']}" for entry in failed])
+            await alert_sms(body=msg)
+        return ResponseModel(data=manifest, message=f'{len(manifest)} lab slips processed, {len(failed)} failed.')
+    else:
+        return ErrorResponseModel(error='Invalid Master Key', code=400, message='Your key was invalid.')
 
 
 @router.post('/{file_type}/{process_mode}', response_description='Patient data added to the DB!')
 async def process_pdf(file_type: str,
                       process_mode: str,
-                      master_key_string: str,
-                      # Must be a query param because Body(...) and File(...) aren't compatible.
                       file: UploadFile = File(...),
+                      # Key must be a query param because Body(...) and File(...) aren't compatible.
+                      cipher: Optional[CipherContext] = Depends(cipher_from_query),
                       ):
     type_and_mode_okay = (file_type.lower() in FILE_TYPES_AND_PROCESS_MODES) and (
             process_mode.lower() in FILE_TYPES_AND_PROCESS_MODES[file_type])
@@ -52,22 +246,35 @@ async def process_pdf(file_type: str,
             f' All valid modes: {FILE_TYPES_AND_PROCESS_MODES}'
         )
 
-    valid = await validate_key(master_key_string)
-    if valid:
+    if cipher:
         if file_type == 'results':
             '''
             For results, the only uploads should be scanned AK State results - this should only need OCR.
             CUE data is sent via API endpoint and extracted on the frontend.
             '''
-            extracted_data = process_results_file(file, process_mode)
-            return extracted_data
+            try:
+                extracted_data = await process_results_file(file, process_mode, cipher)
+            except DocumentJobError as e:
+                return ErrorResponseModel(error=e.error, code=e.code, message=str(e))
+            return ResponseModel(data=extracted_data, message=f'{len(extracted_data or [])} result pages read.')
 
             # TODO: update EXISTING test data populated from lab slip.
 
 
 
         elif file_type == 'lab':
-            extracted_data = await process_lab_file(file, process_mode)
+            # A file uploaded before is answered from the upload ledger: no parsing, decryption or alerts.
+            ledger_key = upload_key(await file.read(), 'lab')
+            await file.seek(0)
+            previous_upload = await find_upload(ledger_key)
+            if previous_upload:
+                return repeat_upload_response(previous_upload)
+
+            # Email aliasing (lab_slip_db_checks) only matters for new patients; done below.
+            try:
+                extracted_data = await process_lab_file(file, process_mode, do_checks=False)
+            except DocumentJobError as e:
+                return ErrorResponseModel(error=e.error, code=e.code, message=str(e))
             if extracted_data:  # do not add a patient if no data was found
 
                 # DO NOT CHANGE THE ORDER OF THESE WITHOUT TELLING CECELIA
@@ -88,12 +295,10 @@ async def process_pdf(file_type: str,
                         csv_data.append(None)
                         csv_data_json[json_field] = None
 
-                # Check to see if patient exists!
-                patient_enc = await search_for_existing_patient(extracted_data)
-                if patient_enc:
+                async def add_lab_test(patient_enc):
                     # Update with new test data (incomplete) if patient already exists (e.g. this is test #2)
-                    patient = decrypt_patient_data(encrypted_patient_data=patient_enc,
-                                                   key_data=master_key_string)
+                    # Fields are decrypted as they are read: a repeat upload only opens the tests (and patient_id).
+                    patient = cipher.lazy_record(patient_enc)
 
                     '''
                     Check all extant test data in patient
@@ -107,34 +312,48 @@ async def process_pdf(file_type: str,
                         if test_dt == new_test_dt:
                             dt_match_found = True
                     if not dt_match_found:
-                        patient['test_results'].append(new_incomplete_test_data)
-                        updated_patient_enc = encrypt_patient_data(patient_data=patient,
-                                                                   key_data=master_key_string)
-
-                        patient_updated = await update_patient(pid_hash=patient['pid_hash'], data=updated_patient_enc)
-
-                        if patient_updated:
-                            return ResponseModel(data={'csv_data': csv_data,
-                                                       'patient_json': patient},
-                                                 message=f"Patient with pid {extracted_data['patient_id']} had test data successfully added!")
-                        else:
-
-                            return ErrorResponseModel(
-                                error='Unable to update patient',
-                                code=400,
-                                message=f"Unable to update patient with PID {extracted_data['patient_id']}"
-                            )
+                        # Only the new test is sealed and appended; the rest of the record is untouched.
+                        # False (the patient changed since it was read) makes mutate_patient retry.
+                        patient_updated = await write_test_result(patient_enc, None, new_incomplete_test_data,
+                                                                  cipher=cipher)
+                        if not patient_updated:
+                            return False
+                        await record_upload(ledger_key, 'test_added', 'Test data added to existing patient.',
+                                            patient_enc['pid_hash'])
+                        patient_json = patient.materialize()
+                        patient_json['test_results'] = patient['test_results'] + [new_incomplete_test_data]
+
+                        return ResponseModel(
+                            data={'csv_data': csv_data,
+                                  'patient_json': patient_json},
+                            message=f"Patient with pid {extracted_data['patient_id']} had test data successfully added!")
                     else:
+                        await record_upload(ledger_key, 'duplicate', f'This lab slip was already uploaded (tested at {new_test_dt}).',
+                                            patient_enc['pid_hash'])
                         return ErrorResponseModel(
                             error='Unable to update patient',
                             code=400,
                             message=f"This lab slip was already uploaded (patient {patient['patient_id']}, tested at {new_test_dt})."
                         )
+
+                # Check to see if patient exists! (None if not.)
+                try:
+                    existing_patient_response = await mutate_patient(hash_string(extracted_data['patient_id']),
+                                                                     add_lab_test)
+                except WriteConflict:
+                    return ErrorResponseModel(
+                        error='Unable to update patient',
+                        code=409,
+                        message=f"Patient with PID {extracted_data['patient_id']} is being modified concurrently; please retry."
+                    )
+                if existing_patient_response is not None:
+                    return existing_patient_response
                 else:
                     # Create a new patient record
 
-                    # Ensure the PID is unique!
-                    patient_id, pid_hash, pid_altered = await ensure_pid_unique(extracted_data)
+                    # Ensure the PID is unique! (We just looked it up: it isn't in the db.)
+                    patient_id, pid_hash, pid_altered = await ensure_pid_unique(extracted_data, pid_exists=False)
+                    await lab_slip_db_checks(extracted_data)
                     extracted_data['patient_id'] = patient_id
                     extracted_data['pid_hash'] = pid_hash
 
@@ -142,11 +361,12 @@ async def process_pdf(file_type: str,
 
                     extracted_data = {k: v for k, v in extracted_data.items() if v is not None}
 
-                    patient_enc = encrypt_patient_data(patient_data=extracted_data, key_data=master_key_string)
+                    patient_enc = encrypt_patient_data(patient_data=extracted_data, cipher=cipher)
 
                     patient_added = await add_patient(patient_enc)
 
                     if patient_added:
+                        await record_upload(ledger_key, 'added', 'Patient added to database.', pid_hash)
                         return ResponseModel(data={'patient': extracted_data,
                                                    'pid_altered': pid_altered,
                                                    'pid': patient_id,
@@ -176,13 +396,140 @@ async def process_pdf(file_type: str,
 
 
 
-def process_results_file(file_bytes, process_mode):
+CEPHEID_RESULT_FIELDS = ['test_id', 'test_performed_datetime', 'test_reported_datetime', 'positive']
+
+CEPHEID_MESSAGES = {
+    'updated': 'Result added to the patient\'s test.',
+    'duplicate': 'This result was already uploaded.',
+    'no_lab_slip': 'The patient has no lab slip test this result could complete; upload their lab slip first.',
+    'unmatched': 'No patient or test matches this Sample ID.',
+    'unreadable': 'No Sample ID, Start Time or test result found on this page.',
+}
+
+
+def place_cepheid_result(tests: Dict[Any, dict], result: dict) -> Tuple[str, Any]:
+    '''
+    (status, slot) of a result among a patient's tests (by slot): the test with the same test_id,
+    if it has no result yet, or else the incomplete (lab slip only) test it is closest to.
+    '''
+    for slot, test in tests.items():
+        if test.get('test_id') == result['test_id']:
+            if test.get('test_performed_datetime') == result['test_performed_datetime']:
+                return 'duplicate', slot
+            if not test.get('positive'):
+                return 'updated', slot
+    incomplete = [(slot, test) for slot, test in tests.items() if not test.get('test_id')]
+    slot, _ = handle_incomplete_tests(incomplete, result)
+    return ('updated', slot) if slot is not None else ('no_lab_slip', None)
+
+
+def place_cepheid_results(patient_enc: dict, results: List[Tuple[dict, dict]], cipher: CipherContext) -> Dict[Any, dict]:
+    '''
+    Places (manifest entry, result) pairs of one patient, filling in their entries.
+    Returns the tests to write, by slot.
+    '''
+    tests = dict(cipher.open_tests(patient_enc))
+    changed = {}
+    for entry, result in results:
+        status, slot = place_cepheid_result(tests, result)
+        if status == 'updated':
+            tests[slot] = changed[slot] = dict(tests[slot], **result)
+        entry.update(status=status, message=CEPHEID_MESSAGES[status])
+    return changed
+
+
+async def write_cepheid_results(results: List[dict], cipher: CipherContext) -> List[dict]:
+    '''
+    Matches GeneXpert results (one per report page) to patients, and writes them with one bulk_write.
+    A Sample ID is either the test_id of a patient's test (looked up by its test_token: envelope records only)
+    or a patient's PID. All patients are read in one query.
+    Returns a manifest with, per page: its status (updated, duplicate, no_lab_slip, unmatched,
+    unreadable or failed), test_id and a message.
+    '''
+    manifest, readable = [], []
+    for result in results:
+        entry = {'page': result['page'], 'test_id': result['test_id'], 'status': None, 'message': None}
+        manifest.append(entry)
+        test = None
+        if result['test_id'] and result['test_performed_datetime']:
+            test = Test(**{k: result[k] for k in CEPHEID_RESULT_FIELDS}).dict(include=set(CEPHEID_RESULT_FIELDS))
+        # NO RESULT, ERROR, PRESUMPTIVE POS, ... are normalised to None: nothing to write.
+        if test and test['positive'] is not None:
+            readable.append((entry, test))
+        else:
+            entry.update(status='unreadable', message=CEPHEID_MESSAGES['unreadable'])
+    if not readable:
+        return manifest
+
+    tokens = {cipher.test_id_token(test['test_id']) for _, test in readable}
+    pid_hashes = {hash_string(test['test_id'].upper()) for _, test in readable}
+    patients = await retrieve_patients({'$or': [{f'test_results.{TEST_TOKEN_FIELD}': {'$in': list(tokens)}},
+                                                {'pid_hash': {'$in': list(pid_hashes)}}]})
+    by_pid_hash = {p['pid_hash']: p for p in patients}
+    by_token = {t.get(TEST_TOKEN_FIELD): p for p in patients for t in p.get('test_results') or []
+                if isinstance(t, dict) and t.get(TEST_TOKEN_FIELD)}
+
+    results_by_patient = defaultdict(list)
+    for entry, test in readable:
+        patient_enc = (by_token.get(cipher.test_id_token(test['test_id']))
+                       or by_pid_hash.get(hash_string(test['test_id'].upper())))
+        if patient_enc:
+            results_by_patient[patient_enc['pid_hash']].append((entry, test))
+        else:
+            entry.update(status='unmatched', message=CEPHEID_MESSAGES['unmatched'])
+
+    operations = []
+    for pid_hash, patient_results in results_by_patient.items():
+        changed = place_cepheid_results(by_pid_hash[pid_hash], patient_results, cipher)
+        if changed:
+            operations.append(update_tests_operation(by_pid_hash[pid_hash], changed, cipher))
+
+    if await bulk_write_patients(operations) < len(operations):
+        # Some patients changed since they were read: redo them one at a time.
+        # Results the bulk write did add are found as duplicates, so this is safe to repeat.
+        for pid_hash, patient_results in results_by_patient.items():
+            async def place_again(patient_enc, patient_results=patient_results):
+                changed = place_cepheid_results(patient_enc, patient_results, cipher)
+                if not changed:
+                    return True
+                return await bulk_write_patients([update_tests_operation(patient_enc, changed, cipher)]) > 0
+
+            try:
+                await mutate_patient(pid_hash, place_again)
+            except WriteConflict:
+                for entry, _ in patient_results:
+                    entry.update(status='failed', message='Patient is being modified concurrently; please upload this file again.')
+    return manifest
+
+
+async def process_results_file(file_bytes: Union[bytes, UploadFile], process_mode: str, cipher: CipherContext):
     '''
-    NOTE: Will need to check OCR extracted pid against extant patient pids - correct for translation noise.
+    OCR and report parsing run on the document pool; raises a DocumentJobError if it is busy or a job times out.
+    ocr: returns, per page, the scraped patient data (or an error), the OCR confidence, and the known
+    PIDs closest to the scraped one (pid_candidates, see app.database.pid_index) to correct OCR noise.
+    cepheid: writes the report's results, and returns the manifest of write_cepheid_results.
     '''
-    if process_mode == 'ocr':
-        txt = process_image_pdf_to_txt(file_bytes)
-        data = scrape_patient_data(txt)
-        return data
+    if isinstance(file_bytes, datastructures.UploadFile):
+        # Routes receive starlette's UploadFile: FastAPI's UploadFile only subclasses it.
+        file_bytes = await file_bytes.read()
+    if process_mode == 'cepheid':
+        results = await run_document_job(parse_cepheid_report, file_bytes)
+        return await write_cepheid_results(results, cipher)
+    elif process_mode == 'ocr':
+        # Uploads may hold several result slips, one per page. Digital pages are read from their
+        # text layer; scanned ones are OCR'd in parallel.
+        results = []
+        pages = await ocr_pdf(file_bytes, template=settings.RESULT_OCR_TEMPLATE or None)
+        pid_index = await get_pid_index(cipher)
+        for page in pages:
+            result = {'page': page['page'], 'source': page['source'], 'confidence': page['confidence']}
+            try:
+                result.update(scrape_patient_data(page['text']))
+            except (TypeError, ValueError):
+                result['error'] = 'No patient data found on this page.'
+            scraped_pid = result.get('patient_id') or find_labelled_pid(page['text'])
+            result['pid_candidates'] = pid_candidates(pid_index, scraped_pid) if scraped_pid else []
+            results.append(result)
+        return results
     else:
         pass
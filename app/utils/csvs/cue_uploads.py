@@ -8,6 +8,10 @@ from app.core.globals import CUE_IMPORT_FIELDS, PATIENT_EXPORT_FIELDS
 from app.core.types import Json
 
 
+# Top level patient fields to_row reads (fetch / decrypt only these for CUE exports).
+PATIENT_EXPORT_PROJECTION = sorted({k[0] if isinstance(k, list) else k for k in PATIENT_EXPORT_FIELDS})
+
+
 def get_csv_data_from_pat(pat: Json, key: Union[str, List[str]], omit: List[str] = []):
     if key in omit:
         return None
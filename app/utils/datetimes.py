@@ -1,23 +1,142 @@
+'''
+Date parsing for the whole app. Strict fast paths cover what we actually receive (ISO-8601 from the
+API and exports, M/D/YYYY from lab slips and reports); dateparser, which is slow and loads locale data,
+is only a last resort, restricted to English. Parsed strings are memoized, except relative dates
+('now', '2 days ago'), which depend on when they are parsed.
+'''
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Any, Optional
+
 import arrow
+import dateparser
 import pytz
-from dateparser import parse
+from arrow.parser import DateTimeParser, ParserError
 
-def to_dt(iso):
-    try:
-        #Try to convert using arrow
-        dt = arrow.get(iso).astimezone(pytz.utc)
-        return dt
-    except:
-        #Try to convert using dateparser
+DATE_CACHE_SIZE = 4096
+DATEPARSER_LANGUAGES = ['en']
+ABSOLUTE_PARSERS = {'PARSERS': ['timestamp', 'custom-formats', 'absolute-time', 'no-spaces-time']}
+RELATIVE_PARSERS = {'PARSERS': ['relative-time']}
+ISO_PARSER = DateTimeParser()
+
+ISO_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2})'
+                         r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:[.,](\d{1,6}))?)?)?'
+                         r'(Z|[+-]\d{2}(?::?\d{2})?)?')
+# M/D/YYYY (or M/D/YY), optionally with a time: 3/5/2021, 03/05/21 10:00:00, 3/5/2021 10:00 PM.
+MDY_PATTERN = re.compile(r'(\d{1,2})/(\d{1,2})/(\d{4}|\d{2})'
+                         r'(?:\s+(\d{1,2}):(\d{2})(?::(\d{2}))?(?:\s*([AaPp])\.?[Mm]\.?)?)?')
+
+
+def _utc_offset(tz: Optional[str]) -> Optional[timezone]:
+    if not tz:
+        return None
+    if tz == 'Z':
+        return timezone.utc
+    sign = -1 if tz[0] == '-' else 1
+    digits = tz[1:].replace(':', '')
+    return timezone(sign * timedelta(hours=int(digits[:2]), minutes=int(digits[2:] or 0)))
+
+
+def parse_iso(text: str) -> Optional[datetime]:
+    '''
+    An ISO-8601 date or datetime, naive unless it has an offset; None if text isn't ISO-8601.
+    Less common ISO forms (week dates, basic format, ...) go through arrow, which (unlike
+    dateparser) never guesses.
+    '''
+    return _parse_iso(text.strip())
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _parse_iso(text: str) -> Optional[datetime]:
+    match = ISO_PATTERN.fullmatch(text)
+    if match:
+        y, mo, d, h, mi, s, frac, tz = match.groups()
         try:
-            dt = parse(iso).astimezone(pytz.utc)
+            return datetime(int(y), int(mo), int(d), int(h or 0), int(mi or 0), int(s or 0),
+                            int((frac or '0').ljust(6, '0')), tzinfo=_utc_offset(tz))
+        except ValueError:
+            return None
+    if not text[:4].isdigit():
+        # ISO-8601 starts with the year: don't make arrow fail slowly on anything else.
+        return None
+    try:
+        return ISO_PARSER.parse_iso(text)
+    except (ParserError, ValueError):
+        return None
+
+
+def parse_mdy(text: str) -> Optional[datetime]:
+    '''
+    M/D/YYYY or M/D/YY (years before 69 are 20YY), with an optional H:MM[:SS] [AM|PM] time, as a naive datetime.
+    None if text isn't in that form, or isn't a valid month / day / time.
+    '''
+    match = MDY_PATTERN.fullmatch(text.strip())
+    if not match:
+        return None
+    mo, d, y, h, mi, s, meridiem = match.groups()
+    year = int(y) if len(y) == 4 else int(y) + (2000 if int(y) < 69 else 1900)
+    hour = int(h or 0)
+    if meridiem:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if meridiem in 'Pp' else 0)
+    try:
+        return datetime(year, int(mo), int(d), hour, int(mi or 0), int(s or 0))
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _parse_absolute(text: str) -> Optional[datetime]:
+    return parse_iso(text) or parse_mdy(text) or dateparser.parse(text, languages=DATEPARSER_LANGUAGES,
+                                                                  settings=ABSOLUTE_PARSERS)
+
+
+def parse_date(text: str) -> Optional[datetime]:
+    '''
+    Any date or datetime a person might write, naive unless it has an offset; None if it can't be parsed.
+    '''
+    if not isinstance(text, str) or not text.strip():
+        return None
+    text = text.strip()
+    return _parse_absolute(text) or dateparser.parse(text, languages=DATEPARSER_LANGUAGES, settings=RELATIVE_PARSERS)
+
+
+def make_date(month, day, year) -> Optional[datetime]:
+    '''
+    A date from its parts (as typed into a form: '3', '03', 'March', '21', '2021', ...), as a naive datetime.
+    '''
+    if all(str(part).strip().isdigit() for part in (month, day, year)):
+        dt = parse_mdy(f'{str(month).strip()}/{str(day).strip()}/{str(year).strip()}')
+        if dt:
             return dt
-        except:
+    return parse_date(f'{month} {day} {year}')
+
+
+def to_dt(iso: Any, fuzzy: bool = True) -> Optional[datetime]:
+    '''
+    A UTC datetime from a datetime or a date string; None if it can't be parsed.
+    Naive ISO-8601 strings and datetimes are UTC; other naive dates (only parsed if fuzzy) are local time.
+    '''
+    if isinstance(iso, str):
+        dt = parse_iso(iso)
+        if dt is not None:
+            return (dt if dt.tzinfo else dt.replace(tzinfo=pytz.utc)).astimezone(pytz.utc)
+        dt = parse_date(iso) if fuzzy else None
+        try:
+            return dt.astimezone(pytz.utc) if dt is not None else None
+        except (ValueError, OverflowError):
             return None
+    try:
+        return arrow.get(iso).astimezone(pytz.utc)
+    except Exception:
+        return None
+
 
 def to_timestamp(dt):
     try:
         ts = dt.timestamp()
         return ts
     except:
-        return None
\ No newline at end of file
+        return None
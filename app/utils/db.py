@@ -1,15 +1,25 @@
 from app.database.crypto import hash_string
-from app.database.patient import query_db
+from app.database.counters import next_sequence_after
+from app.database.patient import get_patient_collection
+from app.database.client import get_mongo_client
 from app.core.config import settings
 
 async def _get_client():
-    from app.main import MONGO_CLIENT
-    return MONGO_CLIENT
+    return get_mongo_client()
 
 async def check_email_address(email: str) -> str:
+    '''
+    Returns email, with a +N alias if other patients already share it.
+    N comes from an atomic per-email counter, so concurrent uploads never get the same alias.
+    '''
     this_email_hash = hash_string(email)
-    existing_email_matches = await query_db({'base_email_hash': this_email_hash})
-    n_matching = len(existing_email_matches) if existing_email_matches else 0
+
+    async def existing_patients():
+        # Patients older than the counter: counted once per email.
+        _, _, collection = await get_patient_collection()
+        return await collection.count_documents({'base_email_hash': this_email_hash})
+
+    n_matching = await next_sequence_after(f'email:{this_email_hash}', existing_patients) - 1
     extension = f'+{n_matching}' if n_matching > 0 else ''
     name, domain = email.split('@')
     incremented_email = f'{name}{extension}@{domain}'
@@ -1,27 +1,212 @@
+import asyncio
+from typing import List, Optional, Tuple
+
 import pdf2image
 import pytesseract
 from PIL import ImageEnhance
 
+try:
+    import pymupdf as fitz
+except ImportError:  # PyMuPDF < 1.24.3
+    import fitz
+
+from app.core.config import settings
+from app.utils.images.templates import Template, RESULT_TEMPLATES, FIELD_LABELS, tesseract_config, crop_box
+from app.utils.text.result_text_parsing import find_name, find_dob, find_patient_id, find_result
+from app.utils.workers import run_document_job, DocumentJobTimeout, InvalidDocument
+
 
 def pdf_to_image(file_bytes, dpi):
     pages = pdf2image.convert_from_bytes(file_bytes, dpi=dpi)
     return pages
 
 
+def open_pdf(file_bytes: bytes):
+    try:
+        return fitz.open(stream=file_bytes, filetype='pdf')
+    except RuntimeError:  # FileDataError (a RuntimeError; older PyMuPDF raise it bare): not a PDF, or empty.
+        raise InvalidDocument('The file is not a readable PDF.') from None
+
+
+def text_layer(page, probe: bool = True) -> Optional[str]:
+    text = page.get_text('text', sort=True) if probe else ''
+    usable = sum(c.isalnum() for c in text) >= settings.TEXT_LAYER_MIN_CHARS
+    return text if usable else None
+
+
+def page_text_layers(file_bytes: bytes, probe: bool = True) -> List[Optional[str]]:
+    '''
+    Per page, its embedded text (in reading order) if it has a usable text layer: at least
+    settings.TEXT_LAYER_MIN_CHARS letters and digits. None for image-only pages (and every page if not probe).
+    '''
+    with open_pdf(file_bytes) as doc:
+        return [text_layer(page, probe) for page in doc]
+
+
+def split_pages(file_bytes: bytes, probe: bool = True,
+                max_pages: int = None) -> List[Tuple[Optional[str], Optional[bytes]]]:
+    '''
+    Per page: (its text layer, None) if it has a usable one (see page_text_layers), else (None, the page
+    alone as a PDF), so each OCR job only ships the page it OCRs.
+    InvalidDocument if the file isn't a PDF, or has more than max_pages pages.
+    '''
+    with open_pdf(file_bytes) as doc:
+        if max_pages and len(doc) > max_pages:
+            raise InvalidDocument(f'The document has {len(doc)} pages; at most {max_pages} are read at once.')
+        pages = []
+        for number, page in enumerate(doc):
+            text = text_layer(page, probe)
+            if text is not None:
+                pages.append((text, None))
+                continue
+            with fitz.open() as single_page:
+                single_page.insert_pdf(doc, from_page=number, to_page=number)
+                pages.append((None, single_page.tobytes()))
+        return pages
+
+
+def page_job_limit() -> int:
+    slots = settings.DOCUMENT_MAX_JOBS or settings.DOCUMENT_POOL_WORKERS
+    return settings.DOCUMENT_MAX_PAGE_JOBS or max(1, slots // 2)
+
+
+def rasterize_page(file_bytes: bytes, page: int, dpi: int):
+    '''
+    Renders one (1-based) page, so pages are only rasterized when (and where) they are OCR'd.
+    '''
+    return pdf2image.convert_from_bytes(file_bytes, dpi=dpi, first_page=page, last_page=page)[0]
+
+
 def sharpen_image(image, factor):
     enhancer = ImageEnhance.Sharpness(image)
     enhanced_image = enhancer.enhance(factor)
     return enhanced_image
 
 
+def run_tesseract(fn, image, **kwargs):
+    '''
+    tesseract is killed if it runs past the document job timeout, instead of holding its worker,
+    and DocumentJobTimeout is raised (so the route answers 504, like any document job timeout).
+    '''
+    try:
+        return fn(image, timeout=settings.DOCUMENT_JOB_TIMEOUT_S, **kwargs)
+    except pytesseract.TesseractError:
+        raise
+    except RuntimeError:
+        # pytesseract's timeout: a bare RuntimeError (TesseractError is for tesseract failures).
+        raise DocumentJobTimeout('OCR took too long.') from None
+
+
 def image_to_text(image):
-    return pytesseract.image_to_string(image)
+    return run_tesseract(pytesseract.image_to_string, image)
+
+
+def image_to_text_and_confidence(image, config: str = '') -> Tuple[str, float]:
+    '''
+    One tesseract run for both the text (words joined per line, with a blank line between
+    paragraphs, like image_to_string) and the mean word confidence (0-100; 0 if no words were found).
+    '''
+    data = run_tesseract(pytesseract.image_to_data, image, config=config, output_type=pytesseract.Output.DICT)
+    lines, confidences = {}, []
+    for i, word in enumerate(data['text']):
+        confidence = float(data['conf'][i])
+        if confidence < 0 or not word.strip():
+            continue
+        lines.setdefault((data['block_num'][i], data['par_num'][i], data['line_num'][i]), []).append(word)
+        confidences.append(confidence)
+    text, paragraph = [], None
+    for (block, par, _), words in lines.items():
+        if paragraph and paragraph != (block, par):
+            text.append('')
+        paragraph = (block, par)
+        text.append(' '.join(words))
+    return '\n'.join(text), sum(confidences) / len(confidences) if confidences else 0.0
+
+
+def template_to_text_and_confidence(image, template: Template) -> Tuple[str, float]:
+    '''
+    OCRs only the template's regions, each with its own tesseract settings, and writes them as
+    labelled lines (NAME DOE, JANE / DOB 1/2/1990 / ...) that scrape_patient_data reads like a full page.
+    The confidence is the mean of the regions'.
+    '''
+    lines, confidences = [], []
+    for field, region in template.items():
+        crop = image.crop(crop_box(region, *image.size))
+        text, confidence = image_to_text_and_confidence(crop, config=tesseract_config(region))
+        lines.append(f'{FIELD_LABELS[field]} {text}')
+        if text:
+            confidences.append(confidence)
+    return '\n'.join(lines) + '\n', sum(confidences) / len(confidences) if confidences else 0.0
+
+
+def template_text_usable(text: str) -> bool:
+    '''
+    Whether every region read as its field should: a name, a date of birth, a PID matching them and a result.
+    One misplaced box is enough to distrust them all.
+    '''
+    text = text.upper()
+    try:
+        last, first = find_name(text)
+    except ValueError:
+        return False
+    return ((last, first) != ('', '') and bool(find_dob(text))
+            and bool(find_patient_id(text, first, last)) and find_result(text) is not None)
+
+
+def ocr_page(file_bytes: bytes, page: int, dpi: int = 300, enhancement_factor: int = 3,
+             template: str = None) -> dict:
+    '''
+    Rasterizes, sharpens and OCRs one (1-based) page. Module-level, so it can run on the process pool.
+    With a template (see app.utils.images.templates), only its regions are OCR'd; the whole page is
+    if any of them doesn't read as its field (see template_text_usable; e.g. the page has another layout).
+    '''
+    img = rasterize_page(file_bytes, page, dpi=dpi)
+    sharp_img = sharpen_image(img, factor=enhancement_factor)
+    if template:
+        text, confidence = template_to_text_and_confidence(sharp_img, RESULT_TEMPLATES[template])
+        if template_text_usable(text):
+            return {'page': page, 'text': text, 'confidence': confidence, 'template': template}
+    text, confidence = image_to_text_and_confidence(sharp_img)
+    return {'page': page, 'text': text, 'confidence': confidence, 'template': None}
+
+
+async def ocr_pdf(file_bytes: bytes, dpi: int = 300, enhancement_factor: int = 3,
+                  use_text_layer: bool = True, template: str = None) -> List[dict]:
+    '''
+    The text of every page of a PDF, in page order: [{'page', 'text', 'confidence', 'source', 'template'}].
+    Pages with a usable text layer (see page_text_layers) are read as is (source 'text', confidence None:
+    the layer may be a scanner's own invisible OCR, of unknown quality);
+    the others are OCR'd (source 'ocr', see ocr_page for template), one document pool job per page.
+    Splitting the pages is admitted like any document job (DocumentPoolBusy if the pool stays busy), and
+    InvalidDocument is raised for more than settings.RESULT_MAX_PAGES pages. Once the document is admitted,
+    its pages queue for slots as long as it takes, at most page_job_limit() of them at once.
+    If a page fails, pages not started yet are dropped; those already running finish (within the tesseract timeout).
+    '''
+    split = await run_document_job(split_pages, file_bytes, use_text_layer, settings.RESULT_MAX_PAGES)
+    pages = [{'page': page, 'text': text, 'confidence': None, 'source': 'text', 'template': None}
+             for page, (text, _) in enumerate(split, start=1)]
+    page_slots = asyncio.Semaphore(page_job_limit())
+
+    async def ocr(page: int, page_pdf: bytes) -> dict:
+        async with page_slots:
+            result = await run_document_job(ocr_page, page_pdf, 1, dpi, enhancement_factor, template,
+                                            admission_timeout=None)
+        return dict(result, page=page, source='ocr')
+
+    jobs = [asyncio.ensure_future(ocr(page, page_pdf))
+            for page, (_, page_pdf) in enumerate(split, start=1) if page_pdf is not None]
+    try:
+        ocr_pages = {p['page']: p for p in await asyncio.gather(*jobs)}
+    except Exception:
+        for job in jobs:
+            job.cancel()
+        raise
+    return [ocr_pages.get(p['page'], p) for p in pages]
 
 
 def process_image_pdf_to_txt(file_bytes: bytes, dpi: int = 300, enhancement_factor: int = 3):
+    '''
+    The text of every page, OCR'd one after the other (see ocr_pdf to OCR pages in parallel).
+    '''
     imgs = pdf_to_image(file_bytes, dpi=dpi)
-    assert len(imgs) == 1, 'Uploaded file is multipage - this is not expected.'
-    img = imgs[0]
-    sharp_img = sharpen_image(img, factor=enhancement_factor)
-    text = image_to_text(sharp_img)
-    return text
+    return '\n\f'.join(image_to_text(sharpen_image(img, factor=enhancement_factor)) for img in imgs)
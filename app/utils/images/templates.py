@@ -0,0 +1,45 @@
+'''
+Layout templates for result slips: per field, the region of the page it is printed in, and how to OCR it.
+OCR'ing only these regions, each as a single line restricted to the characters the field can hold,
+is faster and more accurate than a full page pass.
+
+Regions are (left, top, right, bottom) fractions of the page, so they don't depend on the scan's DPI.
+Templates are selected with settings.RESULT_OCR_TEMPLATE.
+'''
+import string
+from typing import Dict
+
+Template = Dict[str, dict]
+
+# Tesseract page segmentation mode: treat the image as a single text line.
+PSM_SINGLE_LINE = 7
+
+AK_STATE_RESULT: Template = {
+    'name': {'box': (0.05, 0.17, 0.65, 0.22), 'psm': PSM_SINGLE_LINE,
+             'whitelist': string.ascii_uppercase + ',-'},
+    'dob': {'box': (0.65, 0.17, 0.95, 0.22), 'psm': PSM_SINGLE_LINE,
+            'whitelist': string.digits + '/'},
+    'patient_id': {'box': (0.05, 0.22, 0.65, 0.27), 'psm': PSM_SINGLE_LINE,
+                   'whitelist': string.ascii_uppercase + string.digits},
+    'result': {'box': (0.05, 0.45, 0.95, 0.52), 'psm': PSM_SINGLE_LINE,
+               'whitelist': string.ascii_uppercase + '-'},
+}
+
+RESULT_TEMPLATES: Dict[str, Template] = {
+    'ak_state': AK_STATE_RESULT,
+}
+
+# Labels the region texts are written under, so scrape_patient_data reads them like a full page.
+FIELD_LABELS = {'name': 'NAME', 'dob': 'DOB', 'patient_id': 'PID', 'result': 'RESULT'}
+
+
+def tesseract_config(region: dict) -> str:
+    config = f"--psm {region['psm']}"
+    if region.get('whitelist'):
+        config += f" -c tessedit_char_whitelist={region['whitelist']}"
+    return config
+
+
+def crop_box(region: dict, width: int, height: int) -> tuple:
+    left, top, right, bottom = region['box']
+    return round(left * width), round(top * height), round(right * width), round(bottom * height)
@@ -1,45 +1,70 @@
-from tika import parser  # pip install tika
+from typing import Iterator, List
+
 import regex as re
 from datetime import datetime
-from dateparser import parse
+
+try:
+    import pymupdf as fitz
+except ImportError:  # PyMuPDF < 1.24.3
+    import fitz
+
+from app.utils.datetimes import parse_date
+
+# The value may be on the label's line, or (depending on how the text was laid out) the next one.
+SAMPLE_ID_PATTERN = re.compile(r'Sample ID:[ \t]*\n?[ \t]*(\S.*)')
+POSITIVITY_PATTERN = re.compile(r'Test Result:[ \t]*\n?[ \t]*SARS-CoV-2[ \t]+(\S.*)')
+START_TIME_PATTERN = re.compile(r'Start Time:[ \t]*\n?[ \t]*(\S.*)')
+PAGE_HEADER_PATTERN = re.compile(r'GeneXpert®.*Page \d* of \d*')
 
 
 def split_pages(content: str):
-    return [i.strip() for i in re.split(r'GeneXpert®.*Page \d* of \d*', content.strip())]
+    return [i.strip() for i in PAGE_HEADER_PATTERN.split(content.strip())]
 
 
 def get_sample_id(page):
-    match = re.search(r'Sample ID: (.*)', page)
+    match = SAMPLE_ID_PATTERN.search(page)
     if match:
-        return match.group(1)
+        return match.group(1).strip()
 
 
 def get_positivity(page):
-    match = re.search(r'Test Result: SARS-CoV-2 (.*)', page)
+    match = POSITIVITY_PATTERN.search(page)
     if match:
-        return match.group(1)
+        return match.group(1).strip()
 
 
 def get_start_time(page):
-    match = re.search(r'Start Time: (.*)', page)
+    match = START_TIME_PATTERN.search(page)
     if match:
-        dt = parse(match.group(1)).isoformat()
-        return dt
+        dt = parse_date(match.group(1).strip())
+        return dt.isoformat() if dt else None
 
 
 class CepheidParser:
-    def __init__(self, file_buffer):
-        self.raw = parser.from_buffer(file_buffer)
-
-    def extract_results(self):
-        pages = split_pages(self.raw['content'])
-        results = []
-        for page in pages:
-            result_data = {'test_id': get_sample_id(page),
-                           'test_performed_datetime': get_start_time(page),
-                           'test_reported_datetime': datetime.now().isoformat(),
-                           'positive': get_positivity(page)
-                           }
-            results.append(result_data)
-        return results
+    '''
+    Reads GeneXpert reports from the PDF's text layer, one page at a time:
+    no Tika server, and only one page's text is held at once.
+    '''
+    def __init__(self, file_buffer: bytes):
+        self.file_buffer = file_buffer
+
+    def iter_results(self) -> Iterator[dict]:
+        with fitz.open(stream=self.file_buffer, filetype='pdf') as doc:
+            for page_number, page in enumerate(doc, start=1):
+                text = page.get_text()
+                yield {'page': page_number,
+                       'test_id': get_sample_id(text),
+                       'test_performed_datetime': get_start_time(text),
+                       'test_reported_datetime': datetime.now().isoformat(),
+                       'positive': get_positivity(text)
+                       }
+
+    def extract_results(self) -> List[dict]:
+        return list(self.iter_results())
+
 
+def parse_cepheid_report(file_bytes: bytes) -> List[dict]:
+    '''
+    Module-level, so it can run on the process pool.
+    '''
+    return CepheidParser(file_bytes).extract_results()
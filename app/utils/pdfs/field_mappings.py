@@ -1,5 +1,6 @@
 from datetime import datetime
-from dateparser import parse
+
+from app.utils.datetimes import make_date
 
 # ONLY MAP FIELDS THAT AREN'T IDENTICAL!
 KNOWN_OLD_LAB_SLIP_FIELD_MAPPINGS = {'Result': 'positive',
@@ -26,13 +27,5 @@ address_pdf_to_schema = {
 }
 
 
-def make_date(month, day, year):
-    try:
-        parsed = parse(f'{month} {day} {year}')
-        return parsed
-    except:
-        return
-
-
 def make_test_datetime(month, day, year, time):
     return {'lab_slip_collection_datetime': None}
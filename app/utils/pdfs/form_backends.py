@@ -0,0 +1,75 @@
+'''
+Form field readers for PDFExtractor, selected with settings.PDF_FORM_BACKEND.
+Each reads a PDF (a binary stream) and returns its form fields in the shape of
+PyPDF2's getFields(): {field name: {'/V': value}}, where a field without a value has no '/V',
+and checkbox / radio button values are names ('/Yes', '/Off').
+'''
+from typing import Any, BinaryIO, Callable, Dict, Tuple
+
+import PyPDF2 as pypdf
+
+try:
+    import pymupdf as fitz
+except ImportError:  # PyMuPDF < 1.24.3
+    import fitz
+
+FormFields = Dict[str, dict]
+
+
+def pypdf2_fields(stream: BinaryIO) -> FormFields:
+    '''
+    getFields() walks the whole document object tree: slow on large forms.
+    '''
+    return pypdf.PdfFileReader(stream).getFields() or {}
+
+
+def _field_value(doc, xref: int) -> Tuple[str, Any]:
+    '''
+    (name, /V) of the field a widget annotation belongs to, read from the raw objects: the field is
+    the widget itself or, for a widget without a /T, its nearest /Parent with one.
+    Like PyPDF2, names are partial (the field's own /T) and /V isn't inherited.
+    '''
+    while True:
+        kind, name = doc.xref_get_key(xref, 'T')
+        if kind == 'string':
+            break
+        kind, parent = doc.xref_get_key(xref, 'Parent')
+        if kind != 'xref':
+            raise ValueError('Widget without a field name')
+        xref = int(parent.split()[0])
+    kind, value = doc.xref_get_key(xref, 'V')
+    if kind in ('string', 'name'):
+        return name, value
+    if kind == 'null':
+        return name, None
+    raise ValueError(f'Unsupported field value type {kind}')
+
+
+def pymupdf_fields(stream: BinaryIO) -> FormFields:
+    '''
+    Reads only the pages' widget annotations (and their parent fields), key by key,
+    without building the whole object tree.
+    '''
+    fields = {}
+    with fitz.open(stream=stream.read(), filetype='pdf') as doc:
+        for page in doc:
+            for xref, annot_type, _ in page.annot_xrefs():
+                if annot_type != fitz.PDF_ANNOT_WIDGET:
+                    continue
+                try:
+                    name, value = _field_value(doc, xref)
+                except ValueError:
+                    # e.g. an indirect or array value: let PyMuPDF work it out.
+                    widget = page.load_widget(xref)
+                    name, value = widget.field_name, widget.field_value
+                if name in fields and not value:
+                    # Several widgets of one field (e.g. radio buttons) all carry the field's value.
+                    continue
+                fields[name] = {'/V': value} if value else {}
+    return fields
+
+
+FORM_BACKENDS: Dict[str, Callable[[BinaryIO], FormFields]] = {
+    'pypdf2': pypdf2_fields,
+    'pymupdf': pymupdf_fields,
+}
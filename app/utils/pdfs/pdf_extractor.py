@@ -1,6 +1,5 @@
 import pathlib
-from typing import Iterable, Dict, Any, Union
-import PyPDF2 as pypdf
+from typing import Iterable, Dict, Any, List, Union
 import io
 
 from starlette.datastructures import UploadFile
@@ -10,12 +9,15 @@ from app.utils.sms import alert_sms
 from app.utils.db import check_email_address
 from app.utils.pdfs.field_mappings import (make_date, patient_pdf_to_schema,
                                            address_pdf_to_schema, KNOWN_OLD_LAB_SLIP_FIELD_MAPPINGS)
+from app.utils.pdfs.form_backends import FORM_BACKENDS
 from app.utils.pdfs.extractor_utils import handle_missing_fishery_name, handle_phone_number
+from app.core.config import settings
 from app.core.globals import NAME_TO_CODE, CODE_TO_NAME
 from app.models.patient.patient import PatientSchema
 from app.models.patient.test_results import Test
 from app.models.patient.address import Address
 from app.database.crypto import hash_string
+from app.utils.workers import run_document_job
 
 
 def apply_field_map(d, fmap):
@@ -23,22 +25,24 @@ def apply_field_map(d, fmap):
 
 
 class PDFExtractor:
-    def __init__(self, pdf_file: Union[UploadFile, bytes, str, pathlib.Path]):
+    def __init__(self, pdf_file: Union[UploadFile, bytes, str, pathlib.Path], backend: str = None):
+        '''
+        backend: how form fields are read (see form_backends); settings.PDF_FORM_BACKEND by default.
+        '''
         if isinstance(pdf_file, UploadFile):
             self.name = pdf_file.filename
-            self.pdf = pypdf.PdfFileReader(pdf_file)
+            stream = pdf_file.file
         elif isinstance(pdf_file, bytes):
-            iostream = io.BytesIO(pdf_file)
-            iostream.seek(0)
-            self.pdf = pypdf.PdfFileReader(iostream)
+            stream = io.BytesIO(pdf_file)
         elif isinstance(pdf_file, (str, pathlib.Path)):
             self.name = pathlib.Path(pdf_file).name
-            self.pdf = pypdf.PdfFileReader(open(pdf_file, 'rb'))
+            stream = io.BytesIO(pathlib.Path(pdf_file).read_bytes())
         else:
             raise ValueError(
                 f'pdf_file is the wrong type (provided {type(pdf_file)}; expected Union[bytes, str, pathlib.Path])')
+        read_fields = FORM_BACKENDS[backend or settings.PDF_FORM_BACKEND]
         # map fields to standard extractor fields
-        self.fields = apply_field_map(self.pdf.getFields(), KNOWN_OLD_LAB_SLIP_FIELD_MAPPINGS)
+        self.fields = apply_field_map(read_fields(stream), KNOWN_OLD_LAB_SLIP_FIELD_MAPPINGS)
 
     def __getitem__(self, key):
         return self.fields.get(key, {None: None})
@@ -142,38 +146,71 @@ async def lab_slip_db_checks(extracted_data):
         return extracted_data
 
 
+def parse_lab_slip(file_bytes: bytes) -> dict:
+    '''
+    Parses and validates one lab slip PDF; no db checks, no alerts.
+    Module-level and free of IO, so it can run on the process pool.
+    Returns {'patient': validated patient data}, or {'error': 'unparseable'},
+    or {'error': 'invalid', 'missing': [...]}.
+    '''
+    try:
+        e = PDFExtractor(file_bytes)
+        patient_data = e.extract_patient()
+        address_data = e.extract_address()
+        patient_data['physical_address'] = address_data
+        test_data = e.extract_test()
+        patient_data['test_results'] = test_data
+    except:
+        return {'error': 'unparseable'}
+    try:
+        return {'patient': PatientSchema(**patient_data).dict()}
+    except ValidationError as e:
+        return {'error': 'invalid', 'missing': [f"{err['type']}: {err['loc'][0]}" for err in e.errors()]}
+
+
+def parse_lab_slips(files: List[bytes]) -> List[dict]:
+    '''
+    parse_lab_slip for a chunk of files (one process pool job). A file that breaks
+    validation in unexpected ways is reported as unparseable instead of failing the chunk.
+    '''
+    parsed = []
+    for file_bytes in files:
+        try:
+            parsed.append(parse_lab_slip(file_bytes))
+        except Exception:
+            parsed.append({'error': 'unparseable'})
+    return parsed
+
+
 async def process_lab_file(file_bytes: Union[bytes, str, UploadFile],
                            process_mode: str,
                            do_checks: bool = True) -> Union[dict, None]:
+    '''
+    Raises a DocumentJobError (app.utils.workers) if the document pool is busy or parsing times out.
+    '''
     file_name = None
     if isinstance(file_bytes, UploadFile):
         file_name = file_bytes.filename
         file_bytes = await file_bytes.read()
     if process_mode == 'pdf':
-        try:
-            e = PDFExtractor(file_bytes)
-            patient_data = e.extract_patient()
-            address_data = e.extract_address()
-            patient_data['physical_address'] = address_data
-            test_data = e.extract_test()
-            patient_data['test_results'] = test_data
-        except:
+        # Parsing is CPU-bound: keep it off the event loop.
+        parsed = await run_document_job(parse_lab_slip, file_bytes)
+        if parsed.get('error') == 'unparseable':
             msg = f'File {file_name if file_name else ""} could not be parsed by PDFExtractor.'
             await alert_sms(body=msg)
             return {'NOT_IMPLEMENTED': 'NO'}
-        try:
-            validated = PatientSchema(**patient_data).dict()
-            if do_checks:
-                checked = await lab_slip_db_checks(validated)
-                return checked
-            return validated
-        except ValidationError as e:
+        if parsed.get('error') == 'invalid':
             msg = f'File {file_name if file_name else ""} had missing fields:'
-            missing = '\n'.join([f"{err['type']}: {err['loc'][0]}" for err in e.errors()])
+            missing = '\n'.join(parsed['missing'])
             msg += '\n' + missing
             await alert_sms(body=msg)
+            return None
 
-        return None
+        validated = parsed['patient']
+        if do_checks:
+            checked = await lab_slip_db_checks(validated)
+            return checked
+        return validated
 
     else:
         # If OCR ever implemented for Lab forms, implement this.
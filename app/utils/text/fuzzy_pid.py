@@ -0,0 +1,120 @@
+'''
+Approximate matching of OCR'd patient IDs against known ones.
+
+OCR mostly confuses look-alike characters (0/O, 1/I, 5/S, ...), so the edit distance used to rank
+candidates makes those substitutions cheap. Candidates are found with a trigram index over the
+PIDs' canonical form (every look-alike mapped to one character), so a misread character
+doesn't hide the PID from the index.
+'''
+from typing import Dict, Iterable, List, Set, Tuple
+
+# Characters OCR confuses with each other; each maps to the group's first character.
+CONFUSABLE_GROUPS = ['0OQD', '1IL', '2Z', '5S', '6G', '8B']
+CANONICAL = {c: group[0] for group in CONFUSABLE_GROUPS for c in group}
+
+CONFUSION_COST = 0.5
+EDIT_COST = 1.0
+
+
+def normalize_pid(pid: str) -> str:
+    return ''.join(c for c in pid.upper() if c.isalnum())
+
+
+def canonical_pid(pid: str) -> str:
+    return ''.join(CANONICAL.get(c, c) for c in normalize_pid(pid))
+
+
+def trigrams(s: str) -> Set[str]:
+    padded = f'^{s}$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def ocr_edit_distance(a: str, b: str, max_cost: float = None) -> float:
+    '''
+    Levenshtein distance where substituting look-alike characters costs CONFUSION_COST instead of EDIT_COST.
+    With max_cost, gives up (returning infinity) as soon as the distance is known to exceed it,
+    and only fills the band of the table within max_cost insertions or deletions of the diagonal.
+    '''
+    inf = float('inf')
+    band = int(max_cost // EDIT_COST) if max_cost is not None else max(len(a), len(b))
+    if abs(len(a) - len(b)) > band:
+        return inf
+    previous = [j * EDIT_COST if j <= band else inf for j in range(len(b) + 1)]
+    for i, ca in enumerate(a, start=1):
+        current = [i * EDIT_COST if i <= band else inf] + [inf] * len(b)
+        for j in range(max(1, i - band), min(len(b), i + band) + 1):
+            cb = b[j - 1]
+            if ca == cb:
+                substitution = 0.0
+            elif CANONICAL.get(ca, ca) == CANONICAL.get(cb, cb):
+                substitution = CONFUSION_COST
+            else:
+                substitution = EDIT_COST
+            current[j] = min(previous[j] + EDIT_COST, current[j - 1] + EDIT_COST, previous[j - 1] + substitution)
+        if max_cost is not None and min(current) > max_cost:
+            return inf
+        previous = current
+    return previous[-1]
+
+
+class FuzzyPIDIndex:
+    '''
+    In-memory index of known PIDs; add and discard keep it up to date without a rebuild.
+    '''
+
+    def __init__(self, pids: Iterable[str] = ()):
+        self._by_canonical: Dict[str, Set[str]] = {}
+        self._postings: Dict[str, Set[str]] = {}
+        for pid in pids:
+            self.add(pid)
+
+    def __len__(self):
+        return sum(len(pids) for pids in self._by_canonical.values())
+
+    def __contains__(self, pid: str):
+        return pid in self._by_canonical.get(canonical_pid(pid), ())
+
+    def add(self, pid: str):
+        canonical = canonical_pid(pid)
+        if canonical not in self._by_canonical:
+            self._by_canonical[canonical] = set()
+            for gram in trigrams(canonical):
+                self._postings.setdefault(gram, set()).add(canonical)
+        self._by_canonical[canonical].add(pid)
+
+    def discard(self, pid: str):
+        canonical = canonical_pid(pid)
+        pids = self._by_canonical.get(canonical)
+        if pids is None:
+            return
+        pids.discard(pid)
+        if not pids:
+            del self._by_canonical[canonical]
+            for gram in trigrams(canonical):
+                self._postings[gram].discard(canonical)
+                if not self._postings[gram]:
+                    del self._postings[gram]
+
+    def candidates(self, pid: str, limit: int = 5, max_cost: float = 2.0,
+                   max_edits: int = 1) -> List[Tuple[str, float]]:
+        '''
+        Known PIDs within max_cost (ocr_edit_distance) of pid, as (pid, cost), cheapest first.
+        Only PIDs at most max_edits edits other than look-alike substitutions away are considered:
+        each one allowed makes the trigram filter much less selective.
+        Case, spaces and punctuation are ignored, but the PIDs are returned as they were added.
+        '''
+        query, canonical = normalize_pid(pid), canonical_pid(pid)
+        if not query:
+            return []
+        # Look-alike substitutions don't change the canonical form, and every other edit changes at most
+        # three of its trigrams: PIDs within max_edits share at least min_shared of them, so at least one
+        # of the (len(grams) - min_shared + 1) rarest. Only those posting lists are read.
+        postings = sorted((self._postings.get(gram, frozenset()) for gram in trigrams(canonical)), key=len)
+        max_edits = min(max_edits, int(max_cost // EDIT_COST))
+        min_shared = max(len(postings) - 3 * max_edits, 1)
+        shortlist = set().union(*postings[:len(postings) - min_shared + 1])
+        scored = [(known, ocr_edit_distance(query, normalize_pid(known), max_cost))
+                  for c in shortlist
+                  if abs(len(c) - len(canonical)) <= max_cost and sum(c in p for p in postings) >= min_shared
+                  for known in self._by_canonical[c]]
+        return sorted([s for s in scored if s[1] <= max_cost], key=lambda s: (s[1], s[0]))[:limit]
@@ -32,6 +32,20 @@ def find_patient_id(text, first, last):
     return matches[0]
 
 
+def find_labelled_pid(text):
+    # The PID as printed after its label, however OCR garbled it (find_patient_id needs it to be well formed).
+    match = re.search(r'PID\s+(\S+)', text.upper())
+    if match:
+        return match.group(1)
+    return ""
+
+
+def find_result(text):
+    match = re.search(r'RESULT\s+(NOT\s+DETECTED|NEGATIVE|DETECTED|POSITIVE)', text)
+    if match:
+        return 'negative' if match.group(1) == 'NEGATIVE' or match.group(1).startswith('NOT') else 'positive'
+
+
 def scrape_patient_data(text):
     #UPPERCASE for ease of search.
     text = text.upper()
@@ -43,5 +57,6 @@ def scrape_patient_data(text):
     return {
         'name': f'{first} {last}',
         'patient_id': patient_id,
-        'positivity': 'positive'
+        # None if no result could be read: never guess one.
+        'positivity': find_result(text)
     }
\ No newline at end of file
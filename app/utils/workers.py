@@ -0,0 +1,151 @@
+import asyncio
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, List, Optional, Sequence
+
+from app.core.config import settings
+
+_PROCESS_POOL: Optional[ProcessPoolExecutor] = None
+# Separate pool (and admission slots) for document work (PDF parsing, OCR),
+# so long OCR jobs never hold up bulk decryption and vice versa.
+_DOCUMENT_POOL: Optional[ProcessPoolExecutor] = None
+_DOCUMENT_SLOTS: Optional[asyncio.Semaphore] = None
+
+
+class DocumentJobError(Exception):
+    error = 'Document processing failed'
+    code = 500
+
+
+class InvalidDocument(DocumentJobError):
+    error = 'Invalid document'
+    code = 400
+
+
+class DocumentPoolBusy(DocumentJobError):
+    error = 'Server busy'
+    code = 503
+
+
+class DocumentJobTimeout(DocumentJobError):
+    error = 'Processing timed out'
+    code = 504
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    '''
+    Shared pool for CPU-bound work that must not run on the event loop.
+    Created on first use; sized by settings.PROCESS_POOL_WORKERS (0 = one per CPU).
+    '''
+    global _PROCESS_POOL
+    if _PROCESS_POOL is None:
+        _PROCESS_POOL = ProcessPoolExecutor(max_workers=settings.PROCESS_POOL_WORKERS or None)
+    return _PROCESS_POOL
+
+
+def get_document_pool() -> ProcessPoolExecutor:
+    '''
+    Pool for PDF parsing and OCR, sized by settings.DOCUMENT_POOL_WORKERS. Created on first use.
+    '''
+    global _DOCUMENT_POOL
+    if _DOCUMENT_POOL is None:
+        _DOCUMENT_POOL = ProcessPoolExecutor(max_workers=settings.DOCUMENT_POOL_WORKERS)
+    return _DOCUMENT_POOL
+
+
+def _recycle_document_pool(pool: ProcessPoolExecutor):
+    '''
+    Kills the workers of a document pool with a hung job, so their slots come back
+    (the pool's jobs fail with BrokenProcessPool). The next job gets a new pool.
+    '''
+    global _DOCUMENT_POOL
+    if _DOCUMENT_POOL is not pool:
+        # Already recycled, by another job that timed out on it.
+        return
+    _DOCUMENT_POOL = None
+    # ProcessPoolExecutor can't cancel running work: its worker processes have to go.
+    for process in list((pool._processes or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False)
+
+
+def _document_slots() -> asyncio.Semaphore:
+    global _DOCUMENT_SLOTS
+    if _DOCUMENT_SLOTS is None:
+        _DOCUMENT_SLOTS = asyncio.Semaphore(settings.DOCUMENT_MAX_JOBS or settings.DOCUMENT_POOL_WORKERS)
+    return _DOCUMENT_SLOTS
+
+
+def shutdown_process_pool():
+    '''
+    Shuts down both process pools.
+    '''
+    global _PROCESS_POOL, _DOCUMENT_POOL, _DOCUMENT_SLOTS
+    if _PROCESS_POOL is not None:
+        _PROCESS_POOL.shutdown(wait=True)
+        _PROCESS_POOL = None
+    if _DOCUMENT_POOL is not None:
+        _DOCUMENT_POOL.shutdown(wait=True)
+        _DOCUMENT_POOL = None
+    _DOCUMENT_SLOTS = None
+
+
+def chunk(items: Sequence, size: int) -> List[Sequence]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+async def run_in_process_pool(fn: Callable, *args):
+    '''
+    fn and args must be picklable (module-level functions, plain data).
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), functools.partial(fn, *args))
+
+
+async def run_document_job(fn: Callable, *args, timeout: float = None, admission_timeout: float = -1):
+    '''
+    Runs fn(*args) on the document pool; like run_in_process_pool, fn and args must be picklable.
+    Admission control: at most settings.DOCUMENT_MAX_JOBS jobs (0 = one per worker) are admitted at once.
+    Others wait up to admission_timeout seconds (settings.DOCUMENT_ADMISSION_TIMEOUT_S by default,
+    None = as long as it takes) for a slot, then DocumentPoolBusy is raised.
+    DocumentJobTimeout is raised if the job takes longer than timeout (settings.DOCUMENT_JOB_TIMEOUT_S).
+    The pool is then recycled: a hung worker would otherwise keep its slot forever. Other jobs
+    running on that pool fail with a DocumentJobError.
+    '''
+    if admission_timeout == -1:
+        admission_timeout = settings.DOCUMENT_ADMISSION_TIMEOUT_S
+    slots = _document_slots()
+    try:
+        await asyncio.wait_for(slots.acquire(), timeout=admission_timeout)
+    except asyncio.TimeoutError:
+        raise DocumentPoolBusy('Too many documents are being processed; please try again shortly.')
+
+    def job_done(f: asyncio.Future):
+        slots.release()
+        if not f.cancelled():
+            # Retrieve it, so jobs nobody waits for anymore don't log 'exception was never retrieved'.
+            f.exception()
+
+    loop = asyncio.get_running_loop()
+    pool = get_document_pool()
+    job = loop.run_in_executor(pool, functools.partial(fn, *args))
+    job.add_done_callback(job_done)
+    try:
+        # shield: giving up waiting must not release the slot while the worker is still busy.
+        return await asyncio.wait_for(asyncio.shield(job), timeout=timeout or settings.DOCUMENT_JOB_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        _recycle_document_pool(pool)
+        raise DocumentJobTimeout('The document took too long to process.')
+    except BrokenProcessPool:
+        raise DocumentJobError('Document processing was interrupted; please try again.')
+
+
+async def map_chunks(fn: Callable, items: Sequence, chunk_size: int, *args,
+                     runner: Callable = run_in_process_pool) -> list:
+    '''
+    Runs fn(chunk, *args) for every chunk of items on the process pool (through runner), and
+    returns the concatenated results in the original order.
+    '''
+    results = await asyncio.gather(*[runner(fn, c, *args) for c in chunk(items, chunk_size)])
+    return [i for r in results for i in r]
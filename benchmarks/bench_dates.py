@@ -0,0 +1,98 @@
+'''
+Benchmark: date parsing through app.utils.datetimes (strict fast paths, memoized, dateparser as
+a last resort) vs. the dateparser / arrow calls it replaced, on the inputs we actually parse:
+lab slip date triples (make_date), ISO-8601 strings (to_dt in exports, Test.to_iso during
+validation) and GeneXpert start times (get_start_time). Also checks both give the same dates.
+Each input is distinct, so "cold" measures the fast paths alone; "warm" parses them again, from the memo.
+
+Run from the repo root:
+    python -m benchmarks.bench_dates
+'''
+import random
+import timeit
+from datetime import datetime, timedelta
+
+import arrow
+import dateparser
+import pytz
+
+from app.utils import datetimes
+
+N_DATES = 2000
+
+
+def old_make_date(month, day, year):
+    try:
+        return dateparser.parse(f'{month} {day} {year}')
+    except Exception:
+        return None
+
+
+def old_to_dt(iso):
+    try:
+        return arrow.get(iso).astimezone(pytz.utc)
+    except Exception:
+        try:
+            return dateparser.parse(iso).astimezone(pytz.utc)
+        except Exception:
+            return None
+
+
+def old_to_iso(v):
+    try:
+        if v:
+            return arrow.get(v).astimezone(pytz.utc).isoformat()
+    except Exception:
+        return None
+
+
+def new_to_iso(v):
+    dt = datetimes.to_dt(v, fuzzy=False) if v else None
+    return dt.isoformat() if dt else None
+
+
+def random_datetimes(n):
+    start = datetime(1940, 1, 1)
+    return [start + timedelta(seconds=random.randrange(80 * 365 * 86400)) for _ in range(n)]
+
+
+def workloads():
+    dts = random_datetimes(N_DATES)
+    triples = [(str(dt.month), str(dt.day), str(dt.year)) for dt in dts]
+    isos = [dt.isoformat() for dt in dts]
+    start_times = [dt.strftime('%m/%d/%y %H:%M:%S') for dt in dts]
+    return {
+        'make_date': (lambda: [old_make_date(*t) for t in triples],
+                      lambda: [datetimes.make_date(*t) for t in triples]),
+        'to_dt (ISO)': (lambda: [old_to_dt(s) for s in isos],
+                        lambda: [datetimes.to_dt(s) for s in isos]),
+        'Test.to_iso': (lambda: [old_to_iso(s) for s in isos],
+                        lambda: [new_to_iso(s) for s in isos]),
+        'start time': (lambda: [dateparser.parse(s) for s in start_times],
+                       lambda: [datetimes.parse_date(s) for s in start_times]),
+    }
+
+
+def clear_caches():
+    datetimes._parse_iso.cache_clear()
+    datetimes._parse_absolute.cache_clear()
+
+
+def main():
+    random.seed(0)
+    print(f'{N_DATES} dates per workload')
+    for name, (old, new) in workloads().items():
+        clear_caches()
+        assert old() == new(), f'{name}: results differ'
+        clear_caches()
+        old_t = timeit.timeit(old, number=1)
+        cold_t = timeit.timeit(new, number=1)
+        warm_t = timeit.timeit(new, number=1)
+        print(f'\n{name}')
+        print(f'  current   {1e6 * old_t / N_DATES:9.1f} us / date')
+        print(f'  cold      {1e6 * cold_t / N_DATES:9.1f} us / date  ({old_t / cold_t:.0f}x)')
+        print(f'  warm      {1e6 * warm_t / N_DATES:9.1f} us / date  ({old_t / warm_t:.0f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+'''
+Benchmark: reading lab slip form fields with PyPDF2 vs. PyMuPDF (app.utils.pdfs.form_backends),
+on fillable PDFs generated from RandomPatient.to_form_fields, padded with extra fields
+to mimic large forms. Also checks both backends extract the same data.
+
+Run from the repo root:
+    python -m benchmarks.bench_pdf_extractor
+'''
+import timeit
+
+from app.utils.pdfs.pdf_extractor import PDFExtractor
+from tests.helpers.lab_forms import random_lab_form_pdf
+
+N_FORMS = 50
+EXTRA_FIELDS = [0, 100, 500]
+REPEATS = 5
+BACKENDS = ['pypdf2', 'pymupdf']
+
+
+def extract_all(pdf: bytes, backend: str):
+    e = PDFExtractor(pdf, backend=backend)
+    return e.extract_patient(), e.extract_address(), e.extract_test()
+
+
+def best_of(fn):
+    return min(timeit.repeat(fn, number=1, repeat=REPEATS))
+
+
+def main():
+    print(f'{N_FORMS} lab slips per form size, best of {REPEATS}')
+    for n_extra in EXTRA_FIELDS:
+        pdfs = [random_lab_form_pdf(n_extra_fields=n_extra) for _ in range(N_FORMS)]
+        extracted = {b: [extract_all(pdf, b) for pdf in pdfs] for b in BACKENDS}
+        assert all(extracted[b] == extracted[BACKENDS[0]] for b in BACKENDS), 'backends disagree'
+
+        times = {b: best_of(lambda: [extract_all(pdf, b) for pdf in pdfs]) for b in BACKENDS}
+        print(f'\n+{n_extra} fields')
+        for b, t in times.items():
+            print(f'  {b:<10}{t:.4f} s  ({1000 * t / N_FORMS:.2f} ms / slip)')
+        print(f'  speedup   {times["pypdf2"] / times["pymupdf"]:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+Benchmark: matching OCR'd patient IDs against known ones with the fuzzy PID index
+(app.utils.text.fuzzy_pid), vs. scoring every known PID, with the default limits (cost 2, one edit other than look-alikes). PIDs have the RandomPatient format
+(2-digit fishery code, initials, date of birth); queries are known PIDs with OCR-like noise:
+look-alike substitutions (0/O, 1/I, ...) and, for some, one arbitrary substitution.
+
+Run from the repo root:
+    python -m benchmarks.bench_pid_index
+'''
+import random
+import string
+import timeit
+from datetime import date, timedelta
+
+from app.utils.text.fuzzy_pid import FuzzyPIDIndex, CONFUSABLE_GROUPS, ocr_edit_distance
+
+N_PIDS = [1000, 10000, 50000]
+N_QUERIES = 200
+SCAN_QUERIES = 10
+LOOK_ALIKES = {c: group.replace(c, '') for group in CONFUSABLE_GROUPS for c in group}
+
+
+def random_pid() -> str:
+    dob = date(1940, 1, 1) + timedelta(days=random.randrange(60 * 365))
+    fishery = str(random.randrange(1, 100)).zfill(2)
+    return fishery + ''.join(random.choices(string.ascii_uppercase, k=2)) + dob.strftime('%m%d%Y')
+
+
+def ocr_noise(pid: str) -> str:
+    chars = list(pid)
+    for i, c in enumerate(chars):
+        if c in LOOK_ALIKES and random.random() < 0.15:
+            chars[i] = random.choice(LOOK_ALIKES[c])
+    if random.random() < 0.3:
+        chars[random.randrange(len(chars))] = random.choice(string.ascii_uppercase + string.digits)
+    return ''.join(chars)
+
+
+def scan(pids, query, limit=5, max_cost=2.0):
+    scored = [(pid, ocr_edit_distance(query, pid, max_cost)) for pid in pids]
+    return sorted([s for s in scored if s[1] <= max_cost], key=lambda s: (s[1], s[0]))[:limit]
+
+
+def main():
+    random.seed(0)
+    print(f'{N_QUERIES} noisy queries per index size')
+    for n in N_PIDS:
+        pids = list({random_pid() for _ in range(n)})
+        build = timeit.timeit(lambda: FuzzyPIDIndex(pids), number=1)
+        index = FuzzyPIDIndex(pids)
+        truths = random.sample(pids, N_QUERIES)
+        queries = [ocr_noise(pid) for pid in truths]
+
+        lookup = timeit.timeit(lambda: [index.candidates(q) for q in queries], number=1) / N_QUERIES
+        found = [index.candidates(q) for q in queries]
+        top1 = sum(bool(f) and f[0][0] == t for f, t in zip(found, truths)) / N_QUERIES
+        anywhere = sum(t in [pid for pid, _ in f] for f, t in zip(found, truths)) / N_QUERIES
+        # Within 1.5, no PID is more than one edit (other than look-alikes) away: the index must find all of them.
+        assert all(index.candidates(q, max_cost=1.5) == scan(pids, q, max_cost=1.5)
+                   for q in queries[:SCAN_QUERIES]), 'index and scan disagree'
+        full_scan = timeit.timeit(lambda: [scan(pids, q) for q in queries[:SCAN_QUERIES]], number=1) / SCAN_QUERIES
+
+        print(f'\n{len(pids)} PIDs (index built in {build:.2f} s)')
+        print(f'  index     {1000 * lookup:.3f} ms / lookup')
+        print(f'  scan      {1000 * full_scan:.3f} ms / lookup')
+        print(f'  top-1 {100 * top1:.1f}%, in candidates {100 * anywhere:.1f}%')
+
+
+if __name__ == '__main__':
+    main()
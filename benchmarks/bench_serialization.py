@@ -0,0 +1,68 @@
+'''
+Micro-benchmark: dill pickling vs. the compact typed encoding (app.database.serialization),
+on RandomPatient data, for both per-leaf and envelope encryption.
+
+Run from the repo root:
+    python -m benchmarks.bench_serialization
+'''
+import timeit
+
+import dill
+from cryptography.fernet import Fernet
+
+from app.database import serialization
+from app.models.patient.patient import RandomPatient
+
+N_PATIENTS = 200
+REPEATS = 5
+
+
+def leaves(obj):
+    if isinstance(obj, dict):
+        for v in obj.values():
+            yield from leaves(v)
+    elif isinstance(obj, list):
+        for i in obj:
+            yield from leaves(i)
+    elif obj:
+        yield obj
+
+
+def best_of(fn):
+    return min(timeit.repeat(fn, number=1, repeat=REPEATS))
+
+
+def bench(name, dumps, loads, patients, fernet):
+    all_leaves = [leaf for p in patients for leaf in leaves(p)]
+
+    leaf_blobs = [fernet.encrypt(dumps(leaf)) for leaf in all_leaves]
+    record_blobs = [fernet.encrypt(dumps(p)) for p in patients]
+
+    results = {
+        'leaf encrypt (s)': best_of(lambda: [fernet.encrypt(dumps(leaf)) for leaf in all_leaves]),
+        'leaf decrypt (s)': best_of(lambda: [loads(fernet.decrypt(b)) for b in leaf_blobs]),
+        'record encrypt (s)': best_of(lambda: [fernet.encrypt(dumps(p)) for p in patients]),
+        'record decrypt (s)': best_of(lambda: [loads(fernet.decrypt(b)) for b in record_blobs]),
+        'leaf plaintext bytes': sum(len(dumps(leaf)) for leaf in all_leaves),
+        'leaf ciphertext bytes': sum(len(b) for b in leaf_blobs),
+        'record ciphertext bytes': sum(len(b) for b in record_blobs),
+    }
+    print(f'\n{name}')
+    for k, v in results.items():
+        print(f'  {k:<26}{v:.4f}' if isinstance(v, float) else f'  {k:<26}{v}')
+    return results
+
+
+def main():
+    patients = [RandomPatient(n_tests=3).json() for _ in range(N_PATIENTS)]
+    fernet = Fernet(Fernet.generate_key())
+    print(f'{N_PATIENTS} RandomPatients, best of {REPEATS}')
+    old = bench('dill', dill.dumps, dill.loads, patients, fernet)
+    new = bench('compact', serialization.dumps, serialization.loads, patients, fernet)
+    print('\nspeedup / size ratio (dill / compact)')
+    for k in old:
+        print(f'  {k:<26}{old[k] / new[k]:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+try:
+    import pymupdf as fitz
+except ImportError:  # PyMuPDF < 1.24.3
+    import fitz
+
+from app.core.globals import FISHERY_NAMES
+from app.models.patient.patient import RandomPatient
+
+
+def lab_form_pdf(fields: dict, n_extra_fields: int = 0) -> bytes:
+    '''
+    A fillable PDF with one form field per item of fields (e.g. RandomPatient.to_form_fields()):
+    fishery_name is a combo box, booleans are checkboxes, anything else a text field.
+    n_extra_fields empty text fields are added, to make the form larger.
+    '''
+    doc = fitz.open()
+    page, y = doc.new_page(), 20
+    items = list(fields.items()) + [(f'extra_{i}', None) for i in range(n_extra_fields)]
+    for name, value in items:
+        if y > page.rect.height - 40:
+            page, y = doc.new_page(), 20
+        widget = fitz.Widget()
+        widget.field_name = name
+        widget.rect = fitz.Rect(20, y, 400, y + 14)
+        if name == 'fishery_name':
+            widget.field_type = fitz.PDF_WIDGET_TYPE_COMBOBOX
+            widget.choice_values = FISHERY_NAMES
+        elif isinstance(value, bool):
+            widget.field_type = fitz.PDF_WIDGET_TYPE_CHECKBOX
+        else:
+            widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+        if value is not None:
+            widget.field_value = value if isinstance(value, bool) else str(value)
+        page.add_widget(widget)
+        y += 18
+    pdf = doc.tobytes()
+    doc.close()
+    return pdf
+
+
+def random_lab_form_pdf(n_extra_fields: int = 0) -> bytes:
+    return lab_form_pdf(RandomPatient(n_tests=1).to_form_fields(), n_extra_fields=n_extra_fields)
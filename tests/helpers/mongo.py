@@ -0,0 +1,25 @@
+import mongomock
+
+
+class AsyncCollection:
+    '''The motor collection methods tests need, over an in-memory mongomock collection.'''
+
+    def __init__(self, name: str = 'collection'):
+        self.collection = mongomock.MongoClient().db.get_collection(name)
+
+    async def find_one(self, *args, **kwargs):
+        return self.collection.find_one(*args, **kwargs)
+
+    async def find_one_and_update(self, *args, **kwargs):
+        return self.collection.find_one_and_update(*args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return self.collection.update_one(*args, **kwargs)
+
+    async def bulk_write(self, operations, ordered=True):
+        # mongomock's bulk_write doesn't follow newer pymongo operation classes: apply them one by one.
+        for op in operations:
+            self.collection.update_one(op._filter, op._doc, upsert=op._upsert)
+
+    async def delete_many(self, *args, **kwargs):
+        return self.collection.delete_many(*args, **kwargs)
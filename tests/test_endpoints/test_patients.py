@@ -67,3 +67,8 @@ def test_add_patient_with_redundant_pid(master_key_string):
 
     rm_pat(first_pat.patient_id, master_key_string)
     rm_pat(data['patient_id'], master_key_string)
+
+
+def test_stream_patients_BATCH_SIZE_AT_LEAST_ONE(master_key_string):
+    resp = client.get('/api/patients/stream', params={'batch_size': 0, 'master_key_string': master_key_string})
+    assert resp.status_code == 422
@@ -0,0 +1,73 @@
+from datetime import datetime, timezone
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.database.crypto import CipherContext
+from app.main import app
+from app.models.patient import patient as patient_models
+from app.routes import uploader
+from app.routes.common import cipher_from_query
+from app.utils.images.image_processing import fitz
+from app.utils.text.fuzzy_pid import FuzzyPIDIndex
+from app.utils.workers import shutdown_process_pool
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def keyed_client(master_key_string, monkeypatch):
+    async def no_known_pids(cipher):
+        return FuzzyPIDIndex()
+
+    app.dependency_overrides[cipher_from_query] = lambda: CipherContext(master_key_string)
+    monkeypatch.setattr(uploader, 'get_pid_index', no_known_pids)
+    yield client
+    app.dependency_overrides.clear()
+    shutdown_process_pool()
+
+
+def result_pdf(*pages) -> bytes:
+    doc = fitz.open()
+    for text in pages:
+        doc.new_page().insert_text((72, 72), text)
+    return doc.tobytes()
+
+
+def test_results_ocr_UPLOAD(keyed_client):
+    pdf = result_pdf('NAME DOE, JANE\nDOB 1/2/1990\nPID 33DOEJAN01021990\nRESULT NEGATIVE')
+    resp = keyed_client.post('/api/uploader/results/ocr', files={'file': ('results.pdf', pdf, 'application/pdf')})
+
+    assert resp.status_code == 200
+    [page] = resp.json()['data'][0]
+    assert page['source'] == 'text' and page['confidence'] is None
+    assert page['patient_id'] == '33DOEJAN01021990'
+    assert page['positivity'] == 'negative'
+
+
+def test_results_ocr_NOT_A_PDF(keyed_client, monkeypatch):
+    async def no_alert(**kwargs):
+        return True
+    monkeypatch.setattr(patient_models, 'alert_sms', no_alert)
+    resp = keyed_client.post('/api/uploader/results/ocr', files={'file': ('results.pdf', b'not a pdf', 'application/pdf')})
+
+    assert resp.status_code == 200
+    assert resp.json()['code'] == 400
+
+
+@pytest.mark.parametrize('status', ['added', 'test_added', 'duplicate'])
+def test_lab_pdf_REPEAT_UPLOAD(keyed_client, monkeypatch, status):
+    async def previous_upload(key):
+        return {'_id': key, 'status': status, 'message': 'From the ledger.', 'pid_hash': 'h1',
+                'uploaded_at': datetime(2021, 3, 5, tzinfo=timezone.utc)}
+
+    async def no_alert(**kwargs):
+        return True
+    monkeypatch.setattr(uploader, 'find_upload', previous_upload)
+    monkeypatch.setattr(patient_models, 'alert_sms', no_alert)
+    resp = keyed_client.post('/api/uploader/lab/pdf', files={'file': ('slip.pdf', b'%PDF-1.4', 'application/pdf')})
+
+    body = resp.json()
+    assert body['code'] == 400
+    assert body['error'] == 'Unable to update patient'
+    assert body['message'].endswith('From the ledger.')
@@ -0,0 +1,92 @@
+from app.database.blind_index import (
+    all_of,
+    blind_token,
+    blind_index_tokens,
+    blind_index_query,
+    date_range_query,
+    BLIND_INDEX_FIELD,
+    BLIND_INDEX_VERSION,
+    NOT_INDEXED,
+    VERSION_KEY
+)
+from app.database.patient import patient_query
+from app.utils.datetimes import to_dt
+from tests.helpers.mongo import AsyncCollection
+
+
+def test_tokens_are_deterministic_and_keyed(master_key):
+    assert blind_token('last_name', 'SMITH', master_key) == blind_token('last_name', 'SMITH', master_key)
+    assert blind_token('last_name', 'SMITH', master_key) != blind_token('last_name', 'SMYTH', master_key)
+    # Same value in another field gets another token.
+    assert blind_token('last_name', 'M', master_key) != blind_token('gender', 'M', master_key)
+    assert blind_token('last_name', 'SMITH', master_key) != blind_token('last_name', 'SMITH', b'another key')
+
+
+def test_record_tokens_match_query(master_key):
+    record = {'last_name': 'SMITH', 'gender': 'F', 'dob': None,
+              'physical_address': {'zip': '99501'},
+              'test_results': [{'positive': 'NEGATIVE'}, {'positive': 'POSITIVE'}, {'positive': None}]}
+    tokens = blind_index_tokens(record, master_key)
+    assert 'dob' not in tokens
+    assert len(tokens['positive']) == 2
+
+    query = blind_index_query({'zip': '99501', 'positive': 'POSITIVE', 'first_name': 'JO'}, master_key)
+    token_query, _ = query['$or']
+    assert query == {'$or': [{f'{BLIND_INDEX_FIELD}.zip': tokens['zip'],
+                              f'{BLIND_INDEX_FIELD}.positive': blind_token('positive', 'POSITIVE', master_key)},
+                             NOT_INDEXED]}
+    assert token_query[f'{BLIND_INDEX_FIELD}.positive'] in tokens['positive']
+    assert blind_index_query({'first_name': 'JO'}, master_key) == {}
+
+
+def test_patient_query_RETURNS_NOT_INDEXED(master_key):
+    record = {'last_name': 'SMITH', 'test_results': [{'positive': 'POSITIVE'}]}
+    collection = AsyncCollection().collection
+    collection.insert_many([
+        {'name': 'match', 'fishery_id': 'F1', BLIND_INDEX_FIELD: blind_index_tokens(record, master_key)},
+        {'name': 'other', 'fishery_id': 'F1',
+         BLIND_INDEX_FIELD: blind_index_tokens(dict(record, last_name='JONES'), master_key)},
+        {'name': 'unmigrated', 'fishery_id': 'F1'},
+        {'name': 'old version', 'fishery_id': 'F1',
+         BLIND_INDEX_FIELD: dict(blind_index_tokens(record, master_key), **{VERSION_KEY: BLIND_INDEX_VERSION - 1})},
+        {'name': 'other fishery', 'fishery_id': 'F2'},
+    ])
+    query = patient_query({'last_name': 'SMITH', 'fishery_id': 'F1'}, master_key)
+    assert sorted(d['name'] for d in collection.find(query)) == ['match', 'old version', 'unmigrated']
+
+
+def test_date_range_query_matches_day_buckets(master_key):
+    record = {'test_results': [{'lab_slip_collection_datetime': '2021-06-03T23:30:00-08:00'},
+                               {'lab_slip_collection_datetime': None}]}
+    tokens = blind_index_tokens(record, master_key)
+    # 23:30 AKDT is the next day in UTC.
+    assert tokens['collection_day'] == [blind_token('collection_day', '2021-06-04', master_key)]
+
+    in_range, not_indexed = date_range_query('collection_day', to_dt('2021-06-01'), to_dt('2021-06-07'),
+                                             master_key)['$or']
+    assert not_indexed == NOT_INDEXED
+    assert tokens['collection_day'][0] in in_range[f'{BLIND_INDEX_FIELD}.collection_day']['$in']
+    assert len(in_range[f'{BLIND_INDEX_FIELD}.collection_day']['$in']) == 7
+
+    out_of_range, _ = date_range_query('collection_day', to_dt('2021-05-01'), to_dt('2021-06-03'), master_key)['$or']
+    assert tokens['collection_day'][0] not in out_of_range[f'{BLIND_INDEX_FIELD}.collection_day']['$in']
+
+    # Ranges too long to enumerate aren't pushed down.
+    assert date_range_query('collection_day', to_dt('1000-01-01'), to_dt('2021-06-07'), master_key) == {}
+
+
+def test_date_range_query_RETURNS_NOT_INDEXED(master_key):
+    def record(collection_dt):
+        return {'last_name': 'SMITH', 'test_results': [{'lab_slip_collection_datetime': collection_dt}]}
+
+    collection = AsyncCollection().collection
+    collection.insert_many([
+        {'name': 'in range', BLIND_INDEX_FIELD: blind_index_tokens(record('2021-06-03T10:00:00'), master_key)},
+        {'name': 'out of range', BLIND_INDEX_FIELD: blind_index_tokens(record('2021-07-03T10:00:00'), master_key)},
+        {'name': 'unmigrated'},
+        {'name': 'old version', BLIND_INDEX_FIELD: {VERSION_KEY: BLIND_INDEX_VERSION - 1}},
+    ])
+    # Combined with a patient query, as in the state report.
+    query = all_of(patient_query({'last_name': 'SMITH'}, master_key),
+                   date_range_query('collection_day', to_dt('2021-06-01'), to_dt('2021-06-07'), master_key))
+    assert sorted(d['name'] for d in collection.find(query)) == ['in range', 'old version', 'unmigrated']
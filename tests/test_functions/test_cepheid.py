@@ -0,0 +1,39 @@
+import pytest
+
+from app.database.crypto import CipherContext
+from app.routes import uploader
+from app.utils.pdfs.cepheid import CepheidParser, fitz
+
+
+def cepheid_report(pages) -> bytes:
+    doc = fitz.open()
+    for i, text in enumerate(pages):
+        doc.new_page().insert_text((50, 72), f'GeneXpert® Dx System   Page {i + 1} of {len(pages)}\n{text}')
+    return doc.tobytes()
+
+
+def test_cepheid_parser_READS_EVERY_PAGE():
+    report = cepheid_report(['Sample ID: 33DOEJAN01021990\nTest Result: SARS-CoV-2 NEGATIVE\nStart Time: 03/05/21 10:00:00',
+                             'Sample ID:\nABC-123\nTest Result:\nSARS-CoV-2 POSITIVE\nStart Time:\n03/06/21 11:30:00',
+                             'Not a result page'])
+    results = CepheidParser(report).extract_results()
+
+    assert [r['page'] for r in results] == [1, 2, 3]
+    assert [r['test_id'] for r in results] == ['33DOEJAN01021990', 'ABC-123', None]
+    assert [r['positive'] for r in results] == ['NEGATIVE', 'POSITIVE', None]
+    assert [r['test_performed_datetime'] for r in results] == ['2021-03-05T10:00:00', '2021-03-06T11:30:00', None]
+
+
+@pytest.mark.asyncio
+async def test_write_cepheid_results_NO_RESULT_IS_UNREADABLE(master_key_string, monkeypatch):
+    async def no_patients(query):
+        return []
+
+    monkeypatch.setattr(uploader, 'retrieve_patients', no_patients)
+    results = [{'page': 1, 'test_id': '33DOEJAN01021990', 'test_performed_datetime': '2021-03-05T10:00:00',
+                'test_reported_datetime': None, 'positive': 'NEGATIVE'},
+               {'page': 2, 'test_id': '33DOEJAN01021990', 'test_performed_datetime': '2021-03-05T10:00:00',
+                'test_reported_datetime': None, 'positive': 'NO RESULT'}]
+    manifest = await uploader.write_cepheid_results(results, CipherContext(master_key_string))
+
+    assert [entry['status'] for entry in manifest] == ['unmatched', 'unreadable']
@@ -0,0 +1,46 @@
+import time
+
+from pymongo import MongoClient, monitoring
+
+from app.core.config import settings
+from app.database.client import PoolStats, mongo_client_options
+
+
+def test_pool_stats_CHECKOUT_WAIT():
+    stats = PoolStats()
+    stats.connection_created(None)
+    stats.connection_check_out_started(None)
+    assert stats.snapshot()['waiting'] == 1
+    time.sleep(0.01)
+    stats.connection_checked_out(None)
+    snapshot = stats.snapshot()
+    assert snapshot['waiting'] == 0
+    assert snapshot['checked_out'] == 1
+    assert snapshot['checkouts'] == 1
+    assert snapshot['max_wait_ms'] >= 10
+    stats.connection_checked_in(None)
+    stats.connection_check_out_started(None)
+    stats.connection_check_out_failed(None)
+    snapshot = stats.snapshot()
+    assert (snapshot['checked_out'], snapshot['checkout_failures'], snapshot['connections_open']) == (0, 1, 1)
+
+
+def test_mongo_client_OPTIONS(monkeypatch):
+    monkeypatch.setattr(settings, 'MONGO_MAX_POOL_SIZE', 7)
+    monkeypatch.setattr(settings, 'MONGO_WAIT_QUEUE_TIMEOUT_MS', None)
+    monkeypatch.setattr(settings, 'MONGO_COMPRESSORS', 'zlib')
+    options = mongo_client_options()
+    assert options['maxPoolSize'] == 7
+    assert options['compressors'] == 'zlib'
+    # Unset settings keep the driver defaults.
+    assert 'waitQueueTimeoutMS' not in options
+    assert len(options['event_listeners']) == 1
+
+
+def test_pool_stats_HANDLES_EVERY_POOL_EVENT():
+    stats = PoolStats()
+    # pymongo calls every ConnectionPoolListener method; one left to the base class raises NotImplementedError.
+    for name in dir(monitoring.ConnectionPoolListener):
+        if not name.startswith('_'):
+            getattr(stats, name)(None)
+    MongoClient(event_listeners=[stats], connect=False).close()
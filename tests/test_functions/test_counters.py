@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+import app.database.patient as patient_db
+from app.database import counters
+from app.database.crypto import hash_string
+from tests.helpers.mongo import AsyncCollection
+
+
+@pytest.fixture
+def counter_collection(monkeypatch):
+    collection = AsyncCollection('counters')
+
+    async def get_counter_collection():
+        return collection
+
+    monkeypatch.setattr(counters, 'get_counter_collection', get_counter_collection)
+    return collection
+
+
+@pytest.mark.asyncio
+async def test_ensure_pid_unique_CONCURRENT_FIRST_USE(counter_collection, monkeypatch):
+    # Older patients took suffixes 1 and 2 before the counter existed.
+    taken = {hash_string(pid) for pid in ('33DOEJAN01021990', '33DOEJAN01021990_1', '33DOEJAN01021990_2')}
+
+    async def retrieve_patient(pid_hash):
+        await asyncio.sleep(0)  # let the other upload run in between
+        return {'pid_hash': pid_hash} if pid_hash in taken else None
+
+    monkeypatch.setattr(patient_db, 'retrieve_patient', retrieve_patient)
+    results = await asyncio.gather(*[patient_db.ensure_pid_unique({'patient_id': '33DOEJAN01021990'})
+                                     for _ in range(3)])
+
+    assert sorted(pid for pid, _, _ in results) == ['33DOEJAN01021990_3', '33DOEJAN01021990_4',
+                                                    '33DOEJAN01021990_5']
+
+
+@pytest.mark.asyncio
+async def test_next_sequence_after_SEEDS_ONCE(counter_collection):
+    floors = []
+
+    async def floor():
+        floors.append(2)
+        return 2
+
+    assert await counters.next_sequence_after('c', floor) == 3
+    assert await counters.next_sequence_after('c', floor) == 4
+    assert floors == [2]
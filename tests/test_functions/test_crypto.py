@@ -1,4 +1,25 @@
 import pytest
+from app.database.crypto import (
+    seal_record,
+    encrypt_record,
+    decrypt_record,
+    FORMAT_FIELD,
+    ENVELOPE_FIELD,
+    ENVELOPE_FORMAT,
+    LEAF_FORMAT,
+    SINGLE_BLOB_ENVELOPE_FORMAT,
+    TEST_SLOT_FIELD,
+    TEST_TOKEN_FIELD,
+    open_tests,
+    storage_projection,
+    LazyRecord,
+    test_id_token as id_token,
+    get_fernet,
+    hash_string,
+    get_cipher_context
+)
+from app.core.config import settings
+from app.database import serialization
 from tests.helpers.crypto import encrypt_decrypt
 
 
@@ -35,3 +56,87 @@ def test_encrypt_decrypt_CLASS(master_key):
     assert obj.fun() == 2
     assert dec.fun() == 2
     assert isinstance(enc, bytes)
+
+
+def test_seal_open_RECORD(json_for_crypto, master_key):
+    record = dict(json_for_crypto, pid_hash='abc123', fishery_id='33')
+    sealed = seal_record(record, master_key)
+    assert sealed[FORMAT_FIELD] == ENVELOPE_FORMAT
+    assert isinstance(sealed[ENVELOPE_FIELD], bytes)
+    # Plaintext fields stay searchable; nothing else leaks out of the envelope.
+    assert sealed['pid_hash'] == 'abc123'
+    assert set(sealed.keys()) == {FORMAT_FIELD, ENVELOPE_FIELD, 'pid_hash', 'fishery_id'}
+    assert decrypt_record(sealed, master_key) == record
+
+
+def test_decrypt_record_reads_LEAF_FORMAT(json_for_crypto, master_key):
+    enc = encrypt_record(json_for_crypto, master_key, record_format=LEAF_FORMAT)
+    assert FORMAT_FIELD not in enc
+    assert decrypt_record(enc, master_key) == json_for_crypto
+
+
+def test_cipher_context_ROUND_TRIP(json_for_crypto, master_key_string, monkeypatch):
+    monkeypatch.setattr(settings, 'KEY_HASH', hash_string(master_key_string))
+    assert get_cipher_context('not the key') is None
+    cipher = get_cipher_context(master_key_string)
+    enc = cipher.encrypt_record(json_for_crypto)
+    assert cipher.decrypt_record(enc) == json_for_crypto
+
+
+def test_seal_open_TESTS(master_key):
+    tests = [{'test_id': None, 'positive': None}, {'test_id': 'T-1', 'positive': False}]
+    sealed = seal_record({'pid_hash': 'abc123', 'first_name': 'A', 'test_results': tests}, master_key)
+    # Every test is its own sealed sub-document, findable by slot and test_id token.
+    assert [t[TEST_TOKEN_FIELD] for t in sealed['test_results']] == [None, id_token('T-1', master_key)]
+    slots = [t[TEST_SLOT_FIELD] for t in sealed['test_results']]
+    assert len(set(slots)) == 2
+    assert open_tests(sealed, master_key) == list(zip(slots, tests))
+    assert decrypt_record(sealed, master_key)['test_results'] == tests
+
+
+def test_decrypt_record_reads_SINGLE_BLOB_ENVELOPE_FORMAT(master_key):
+    record = {'first_name': 'A', 'test_results': [{'test_id': 'T-1'}]}
+    blob = get_fernet(master_key).encrypt(serialization.dumps(record))
+    document = {FORMAT_FIELD: SINGLE_BLOB_ENVELOPE_FORMAT, ENVELOPE_FIELD: blob, 'pid_hash': 'abc123'}
+    assert decrypt_record(document, master_key) == dict(record, pid_hash='abc123')
+    assert open_tests(document, master_key) == [(0, {'test_id': 'T-1'})]
+
+
+@pytest.mark.parametrize('record_format', [LEAF_FORMAT, SINGLE_BLOB_ENVELOPE_FORMAT, ENVELOPE_FORMAT])
+def test_decrypt_record_PROJECTION(record_format, master_key):
+    record = {'pid_hash': 'abc123', 'first_name': 'A', 'dob': '2000-01-01', 'test_results': [{'test_id': 'T-1'}]}
+    if record_format == SINGLE_BLOB_ENVELOPE_FORMAT:
+        sensitive = {k: v for k, v in record.items() if k != 'pid_hash'}
+        document = {FORMAT_FIELD: record_format, 'pid_hash': 'abc123',
+                    ENVELOPE_FIELD: get_fernet(master_key).encrypt(serialization.dumps(sensitive))}
+    else:
+        document = encrypt_record(record, master_key, record_format=record_format)
+    for projection in (['first_name'], ['test_results'], ['pid_hash', 'dob']):
+        # What find(projection=storage_projection(...)) would return.
+        fetched = {k: v for k, v in document.items() if k in storage_projection(projection)}
+        assert decrypt_record(fetched, master_key, projection=projection) == {k: record[k] for k in projection}
+
+
+@pytest.mark.parametrize('record_format', [LEAF_FORMAT, ENVELOPE_FORMAT])
+def test_lazy_record_MATCHES_decrypt_record(record_format, master_key, monkeypatch):
+    record = {'pid_hash': 'abc123', 'first_name': 'A', 'dob': '2000-01-01',
+              'test_results': [{'test_id': None}, {'test_id': 'T-1'}]}
+    document = encrypt_record(record, master_key, record_format=record_format)
+    decoded = []
+    loads = serialization.loads
+    monkeypatch.setattr(serialization, 'loads', lambda data: decoded.append(data) or loads(data))
+
+    lazy = LazyRecord(document, master_key)
+    assert lazy['pid_hash'] == 'abc123'
+    assert decoded == []
+    slot, test = lazy.find_test('T-1')
+    assert test == {'test_id': 'T-1'}
+    assert lazy.find_test('T-2') == (None, None)
+    # Nothing but what was read got decrypted: other fields are decrypted on first access, once.
+    opened = len(decoded)
+    assert lazy['first_name'] == 'A' and lazy['first_name'] == 'A'
+    assert len(decoded) == opened + 1
+    assert lazy['dob'] == '2000-01-01'
+    # Envelope records opened the sealed blob for first_name already.
+    assert len(decoded) == opened + (2 if record_format == LEAF_FORMAT else 1)
+    assert lazy.materialize() == decrypt_record(document, master_key)
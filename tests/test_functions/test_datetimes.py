@@ -0,0 +1,33 @@
+from datetime import datetime, timezone, timedelta
+
+import pytz
+
+from app.utils.datetimes import parse_date, make_date, to_dt
+
+
+def test_parse_date_FAST_PATHS():
+    assert parse_date('2021-03-05T10:00:00') == datetime(2021, 3, 5, 10)
+    assert parse_date('2021-03-05 10:00:00.5-05:30') == datetime(2021, 3, 5, 10, 0, 0, 500000,
+                                                                 tzinfo=timezone(-timedelta(hours=5, minutes=30)))
+    assert parse_date('2021-W09-5') == datetime(2021, 3, 5)
+    assert parse_date('3/5/2021') == datetime(2021, 3, 5)
+    assert parse_date('03/05/21 10:00:00 PM') == datetime(2021, 3, 5, 22)
+    assert parse_date('March 5, 2021') == datetime(2021, 3, 5)
+    assert parse_date('2021-02-30') is None
+    assert parse_date('not a date') is None
+
+
+def test_make_date_FROM_FORM_PARTS():
+    assert make_date('3', '5', '1990') == datetime(1990, 3, 5)
+    assert make_date('03', '05', '21') == datetime(2021, 3, 5)
+    # Not a valid M/D/Y: left to dateparser, which reads it as D/M/Y.
+    assert make_date('13', '5', '1990') == datetime(1990, 5, 13)
+    assert make_date('', '', '') is None
+
+
+def test_to_dt_NAIVE_ISO_IS_UTC():
+    assert to_dt('2021-03-05T10:00:00') == datetime(2021, 3, 5, 10, tzinfo=pytz.utc)
+    assert to_dt('2021-03-05T10:00:00+02:00') == datetime(2021, 3, 5, 8, tzinfo=pytz.utc)
+    assert to_dt(datetime(2021, 3, 5)) == datetime(2021, 3, 5, tzinfo=pytz.utc)
+    assert to_dt('3/5/2021', fuzzy=False) is None
+    assert to_dt(None) is None
@@ -0,0 +1,33 @@
+from app.utils.text.fuzzy_pid import FuzzyPIDIndex, ocr_edit_distance
+
+PIDS = ['33DOEJAN01021990', '33DOEJAN01021991', '12SMIBOB11301975', '33DOEJAN01021990_1']
+
+
+def test_ocr_edit_distance_LOOK_ALIKES_ARE_CHEAP():
+    assert ocr_edit_distance('33DOEJAN01021990', '33DOEJAN01021990') == 0
+    assert ocr_edit_distance('33D0EJAN0I021990', '33DOEJAN01021990') == 1.0
+    assert ocr_edit_distance('33DXEJAN01021990', '33DOEJAN01021990') == 1.0
+    assert ocr_edit_distance('33DOEJAN0102199', '33DOEJAN01021990') == 1.0
+    assert ocr_edit_distance('33DXEJAN01021990', '33DOEJAN01021990', max_cost=0.5) == float('inf')
+
+
+def test_fuzzy_pid_index_RANKS_CANDIDATES():
+    index = FuzzyPIDIndex(PIDS)
+
+    assert index.candidates('33D0EJAN0I02I990') == [('33DOEJAN01021990', 1.5)]
+    assert index.candidates('33DOEJAN01021990') == [('33DOEJAN01021990', 0.0), ('33DOEJAN01021990_1', 1.0),
+                                                    ('33DOEJAN01021991', 1.0)]
+    assert index.candidates('33 doejan 01021991')[0] == ('33DOEJAN01021991', 0.0)
+    assert index.candidates('12SMXBOB11301975') == [('12SMIBOB11301975', 1.0)]
+    assert index.candidates('99XXXXXX00000000') == []
+
+
+def test_fuzzy_pid_index_ADD_AND_DISCARD():
+    index = FuzzyPIDIndex(PIDS[:1])
+    index.add('12SMIBOB11301975')
+    assert '12SMIBOB11301975' in index and len(index) == 2
+    assert index.candidates('12SMIB0B11301975') == [('12SMIBOB11301975', 0.5)]
+
+    index.discard('12SMIBOB11301975')
+    assert '12SMIBOB11301975' not in index and len(index) == 1
+    assert index.candidates('12SMIB0B11301975') == []
@@ -0,0 +1,152 @@
+import pytest
+import pytesseract
+
+from app.utils.images import image_processing
+from app.utils.text.result_text_parsing import scrape_patient_data
+
+
+def test_image_to_text_and_confidence(monkeypatch):
+    data = {'text': ['', 'NAME', 'DOE,', 'JANE', '', 'DOB', '1/2/1990', ' '],
+            'conf': ['-1', '90', '80', '70', '-1', '95', '85', '-1'],
+            'block_num': [1, 1, 1, 1, 2, 2, 2, 2],
+            'par_num': [1, 1, 1, 1, 1, 1, 1, 1],
+            'line_num': [0, 1, 1, 2, 0, 1, 1, 1]}
+    monkeypatch.setattr(pytesseract, 'image_to_data', lambda image, **kwargs: data)
+    text, confidence = image_processing.image_to_text_and_confidence(None)
+    assert text == 'NAME DOE,\nJANE\n\nDOB 1/2/1990'
+    assert confidence == 84
+
+
+def test_image_to_text_and_confidence_BLANK_PAGE(monkeypatch):
+    data = {'text': [''], 'conf': [-1], 'block_num': [1], 'par_num': [0], 'line_num': [0]}
+    monkeypatch.setattr(pytesseract, 'image_to_data', lambda image, **kwargs: data)
+    assert image_processing.image_to_text_and_confidence(None) == ('', 0.0)
+
+
+def test_page_text_layers():
+    fitz = image_processing.fitz
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), 'NAME DOE, JANE DOB 1/2/1990 33DOEJAN01021990')
+    doc.new_page()
+    doc.new_page().insert_text((72, 72), 'p. 3')
+    pdf = doc.tobytes()
+
+    layers = image_processing.page_text_layers(pdf)
+    assert 'NAME DOE, JANE' in layers[0]
+    assert layers[1:] == [None, None]
+    assert image_processing.page_text_layers(pdf, probe=False) == [None, None, None]
+
+
+def words(*words, conf=90):
+    n = len(words)
+    return {'text': list(words), 'conf': [conf] * n, 'block_num': [1] * n, 'par_num': [1] * n, 'line_num': [1] * n}
+
+
+def test_ocr_page_TEMPLATE_REGIONS(monkeypatch):
+    from PIL import Image
+    region_words = {'--psm 7 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZ,-': words('DOE,', 'JANE'),
+                    '--psm 7 -c tessedit_char_whitelist=0123456789/': words('1/2/1990'),
+                    '--psm 7 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789': words('33DOEJAN01021990'),
+                    '--psm 7 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZ-': words('NOT', 'DETECTED', conf=70)}
+    monkeypatch.setattr(image_processing, 'rasterize_page', lambda *args, **kwargs: Image.new('L', (850, 1100)))
+    monkeypatch.setattr(pytesseract, 'image_to_data', lambda image, config='', **kwargs: region_words[config])
+
+    page = image_processing.ocr_page(b'', 1, template='ak_state')
+    assert page['template'] == 'ak_state'
+    assert page['text'] == 'NAME DOE, JANE\nDOB 1/2/1990\nPID 33DOEJAN01021990\nRESULT NOT DETECTED\n'
+    assert page['confidence'] == 85
+    assert scrape_patient_data(page['text']) == {'name': 'JANE DOE', 'patient_id': '33DOEJAN01021990',
+                                                 'positivity': 'negative'}
+
+
+def test_ocr_page_TEMPLATE_FALLBACK(monkeypatch):
+    from PIL import Image
+    monkeypatch.setattr(image_processing, 'rasterize_page', lambda *args, **kwargs: Image.new('L', (850, 1100)))
+    # Another layout: the regions hold nothing useful, so the whole page is OCR'd.
+    monkeypatch.setattr(pytesseract, 'image_to_data',
+                        lambda image, config='', **kwargs: words('NAME', 'DOE,', 'JANE') if not config else words())
+
+    page = image_processing.ocr_page(b'', 1, template='ak_state')
+    assert page['template'] is None
+    assert page['text'] == 'NAME DOE, JANE'
+
+
+def test_ocr_page_TEMPLATE_FALLBACK_ON_ONE_BAD_REGION(monkeypatch):
+    from PIL import Image
+    # Name, DOB and PID read fine, but the result box missed: the regions aren't trusted.
+    region_words = {'--psm 7 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZ,-': words('DOE,', 'JANE'),
+                    '--psm 7 -c tessedit_char_whitelist=0123456789/': words('1/2/1990'),
+                    '--psm 7 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789': words('33DOEJAN01021990'),
+                    '--psm 7 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZ-': words('SPECIMEN'),
+                    '': words('NAME', 'DOE,', 'JANE')}
+    monkeypatch.setattr(image_processing, 'rasterize_page', lambda *args, **kwargs: Image.new('L', (850, 1100)))
+    monkeypatch.setattr(pytesseract, 'image_to_data', lambda image, config='', **kwargs: region_words[config])
+
+    page = image_processing.ocr_page(b'', 1, template='ak_state')
+    assert page['template'] is None
+    assert page['text'] == 'NAME DOE, JANE'
+
+
+def test_scrape_patient_data_NO_RESULT_IS_NOT_POSITIVE():
+    scraped = scrape_patient_data('NAME DOE, JANE\nDOB 1/2/1990\nPID 33DOEJAN01021990\n')
+    assert scraped['patient_id'] == '33DOEJAN01021990'
+    assert scraped['positivity'] is None
+
+
+def test_image_to_text_and_confidence_TIMEOUT(monkeypatch):
+    from app.utils.workers import DocumentJobTimeout
+
+    def timed_out(image, **kwargs):
+        raise RuntimeError('Tesseract process timeout')
+    monkeypatch.setattr(pytesseract, 'image_to_data', timed_out)
+    with pytest.raises(DocumentJobTimeout):
+        image_processing.image_to_text_and_confidence(None)
+
+
+def test_split_pages():
+    from app.utils.workers import InvalidDocument
+    fitz = image_processing.fitz
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), 'NAME DOE, JANE DOB 1/2/1990 33DOEJAN01021990')
+    doc.new_page()
+    pdf = doc.tobytes()
+
+    [(text, no_pdf), (no_text, page_pdf)] = image_processing.split_pages(pdf)
+    assert 'NAME DOE, JANE' in text and no_pdf is None
+    assert no_text is None and fitz.open(stream=page_pdf, filetype='pdf').page_count == 1
+    with pytest.raises(InvalidDocument):
+        image_processing.split_pages(pdf, max_pages=1)
+
+
+@pytest.mark.asyncio
+async def test_ocr_pdf_PAGE_JOB_LIMIT(monkeypatch):
+    import asyncio
+    from app.core.config import settings
+    fitz = image_processing.fitz
+    doc = fitz.open()
+    for _ in range(6):
+        doc.new_page()
+    running, most_running = 0, 0
+
+    async def run_job(fn, *args, **kwargs):
+        nonlocal running, most_running
+        if fn is image_processing.ocr_page:
+            running += 1
+            most_running = max(most_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            return {'page': 1, 'text': 'x', 'confidence': 50.0, 'template': None}
+        return fn(*args)
+
+    monkeypatch.setattr(image_processing, 'run_document_job', run_job)
+    monkeypatch.setattr(settings, 'DOCUMENT_MAX_PAGE_JOBS', 2)
+    pages = await image_processing.ocr_pdf(doc.tobytes())
+    assert [p['page'] for p in pages] == [1, 2, 3, 4, 5, 6]
+    assert all(p['source'] == 'ocr' for p in pages)
+    assert most_running == 2
+
+
+def test_split_pages_NOT_A_PDF():
+    from app.utils.workers import InvalidDocument
+    with pytest.raises(InvalidDocument):
+        image_processing.split_pages(b'not a pdf')
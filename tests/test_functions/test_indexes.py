@@ -0,0 +1,99 @@
+from datetime import datetime, timezone
+
+import pytest
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError, ServerSelectionTimeoutError
+
+from app.core.config import settings
+from app.database.blind_index import BLIND_INDEX_FIELD, blind_index_query, date_range_query
+from app.database.indexes import ensure_indexes, index_report
+
+
+def mongo_reachable() -> bool:
+    client = MongoClient(settings.MONGO_URI, serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command('ping')
+        return True
+    except PyMongoError:
+        return False
+    finally:
+        client.close()
+
+
+# For tests that build indexes and explain queries on a real server.
+requires_mongo = pytest.mark.skipif(not mongo_reachable(), reason='No MongoDB server reachable at MONGO_URI.')
+
+
+def plan_stages(plan) -> list:
+    '''All stage names in an explain() winning plan.'''
+    if isinstance(plan, dict):
+        stages = [plan['stage']] if 'stage' in plan else []
+        for v in plan.values():
+            stages += plan_stages(v)
+        return stages
+    if isinstance(plan, list):
+        return [s for i in plan for s in plan_stages(i)]
+    return []
+
+
+@pytest.fixture
+async def index_test_db():
+    client = AsyncIOMotorClient(settings.MONGO_URI)
+    database = client.get_database(f'{settings.MONGO_DATABASE}_index_tests')
+    await ensure_indexes(database)
+    yield database
+    await client.drop_database(database.name)
+
+
+@requires_mongo
+@pytest.mark.asyncio
+async def test_index_report_ok(index_test_db):
+    report = await index_report(index_test_db)
+    assert report['patients']['ok'], report
+    assert report['uploads']['ok'], report
+
+
+@requires_mongo
+@pytest.mark.asyncio
+@pytest.mark.parametrize('query', [
+    {'pid_hash': 'abc'},
+    {'base_email_hash': 'abc'},
+    {'fishery_id': '33'},
+    {f'{BLIND_INDEX_FIELD}.last_name': 'abc'},
+    {f'{BLIND_INDEX_FIELD}.collection_day': {'$in': ['abc', 'def']}},
+    blind_index_query({'last_name': 'SMITH', 'positive': 'POSITIVE'}, b'key'),
+    date_range_query('collection_day', datetime(2021, 6, 1, tzinfo=timezone.utc),
+                     datetime(2021, 6, 7, tzinfo=timezone.utc), b'key'),
+])
+async def test_hot_queries_use_an_index(index_test_db, query):
+    explained = await index_test_db.patients.find(query).explain()
+    stages = plan_stages(explained['queryPlanner']['winningPlan'])
+    assert 'IXSCAN' in stages or 'IDHACK' in stages or 'EXPRESS_IXSCAN' in stages
+    assert 'COLLSCAN' not in stages
+
+
+@requires_mongo
+@pytest.mark.asyncio
+async def test_pid_hash_is_unique(index_test_db):
+    await index_test_db.patients.insert_one({'pid_hash': 'dup'})
+    with pytest.raises(Exception):
+        await index_test_db.patients.insert_one({'pid_hash': 'dup'})
+
+
+@pytest.mark.asyncio
+async def test_ensure_indexes_UNREACHABLE_SERVER(caplog):
+    class Collection:
+        calls = 0
+
+        async def create_indexes(self, indexes):
+            Collection.calls += 1
+            raise ServerSelectionTimeoutError('No servers found.')
+
+    class Database:
+        def get_collection(self, name):
+            return Collection()
+
+    assert await ensure_indexes(Database()) == {'patients': []}
+    assert Collection.calls == 1
+    assert 'No servers found.' in caplog.text
@@ -0,0 +1,141 @@
+import io
+import zipfile
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+import app.database.patient as patient_db
+from app.core.config import settings
+from app.database.crypto import CipherContext, hash_string
+from app.models.patient.patient import RandomPatient
+from app.routes import uploader
+from app.utils.workers import InvalidDocument
+
+
+def zip_of(**members) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def test_expand_uploads_UNZIPS_PDFS():
+    archive = zip_of(**{'a.pdf': b'%PDF a', 'notes.txt': b'no', '__MACOSX/a.pdf': b'mac'})
+    assert uploader.expand_uploads([('b.pdf', b'%PDF b'), ('slips.zip', archive)]) == [
+        ('b.pdf', b'%PDF b'), ('slips.zip/a.pdf', b'%PDF a')]
+
+
+def test_expand_uploads_LIMITS_CHECKED_BEFORE_UNZIPPING(monkeypatch):
+    def read(*args, **kwargs):
+        raise AssertionError('A member was read.')
+
+    monkeypatch.setattr(zipfile.ZipFile, 'read', read)
+    monkeypatch.setattr(settings, 'BATCH_UPLOAD_MAX_FILES', 2)
+    with pytest.raises(uploader.BatchTooLarge):
+        uploader.expand_uploads([('slips.zip', zip_of(**{f'{i}.pdf': b'%PDF' for i in range(3)}))])
+
+    monkeypatch.setattr(settings, 'BATCH_UPLOAD_MAX_BYTES', 1000)
+    # Compresses to a few bytes, but is listed at its full size.
+    with pytest.raises(uploader.BatchTooLarge):
+        uploader.expand_uploads([('bomb.zip', zip_of(**{'a.pdf': b'0' * 10000}))])
+
+
+def test_expand_uploads_CORRUPT_ARCHIVE():
+    archive = bytearray(zip_of(**{'a.pdf': b'%PDF ' * 100}))
+    archive[40:60] = b'\0' * 20
+    with pytest.raises(InvalidDocument):
+        uploader.expand_uploads([('slips.zip', bytes(archive))])
+
+
+def slip(patient: dict, collection_dt: str) -> dict:
+    test = dict(patient['test_results'][0], lab_slip_collection_datetime=collection_dt)
+    return dict(patient, test_results=[test])
+
+
+@pytest.fixture
+def patient_store(monkeypatch):
+    '''Patients (encrypted, by pid_hash) and the bulk writes run against them.'''
+    store = {'patients': {}, 'inserted': [], 'bulk_writes': [], 'matched': []}
+
+    async def retrieve_patients(query):
+        return [p for h, p in store['patients'].items() if h in query['pid_hash']['$in']]
+
+    async def retrieve_patient(pid_hash):
+        return store['patients'].get(pid_hash)
+
+    async def add_patients(patients):
+        store['inserted'] += patients
+        return [None] * len(patients)
+
+    async def bulk_write_patients(operations):
+        store['bulk_writes'].append(operations)
+        return store['matched'].pop(0) if store['matched'] else len(operations)
+
+    async def no_checks(patient_data):
+        return patient_data
+
+    monkeypatch.setattr(uploader, 'retrieve_patients', retrieve_patients)
+    monkeypatch.setattr(patient_db, 'retrieve_patient', retrieve_patient)
+    monkeypatch.setattr(uploader, 'add_patients', add_patients)
+    monkeypatch.setattr(uploader, 'bulk_write_patients', bulk_write_patients)
+    monkeypatch.setattr(uploader, 'lab_slip_db_checks', no_checks)
+    return store
+
+
+def entry():
+    return {'status': None, 'message': None}
+
+
+@pytest.mark.asyncio
+async def test_write_lab_slips_GROUPS_BY_PID(master_key_string, patient_store):
+    cipher = CipherContext(master_key_string)
+    known, new = RandomPatient(n_tests=1).json(), RandomPatient(n_tests=1).json()
+    patient_store['patients'][hash_string(known['patient_id'])] = cipher.encrypt_record(known)
+    known_dt = known['test_results'][0]['lab_slip_collection_datetime']
+
+    entries = [entry() for _ in range(5)]
+    await uploader.write_lab_slips({
+        known['patient_id']: [(entries[0], slip(known, known_dt)),
+                              (entries[1], slip(known, '2021-03-05T10:00:00'))],
+        new['patient_id']: [(entries[2], slip(new, '2021-03-05T10:00:00')),
+                            (entries[3], slip(new, '2021-03-06T10:00:00')),
+                            (entries[4], slip(new, '2021-03-06T10:00:00'))],
+    }, cipher)
+
+    assert [e['status'] for e in entries] == ['duplicate', 'test_added', 'added', 'added', 'duplicate']
+    # One record per new patient, holding all of its slips' tests; one bulk write for the rest.
+    [inserted] = patient_store['inserted']
+    assert [t['lab_slip_collection_datetime'] for _, t in cipher.open_tests(inserted)] == [
+        '2021-03-05T10:00:00', '2021-03-06T10:00:00']
+    assert [len(ops) for ops in patient_store['bulk_writes']] == [1]
+
+
+@pytest.mark.asyncio
+async def test_write_lab_slips_RETRIES_LOST_WRITES(master_key_string, patient_store):
+    cipher = CipherContext(master_key_string)
+    patients = [RandomPatient(n_tests=1).json() for _ in range(2)]
+    for patient in patients:
+        patient_store['patients'][hash_string(patient['patient_id'])] = cipher.encrypt_record(patient)
+    # The first patient's write lost a race; its retry wins. The second one's write keeps losing.
+    patient_store['matched'] = [0, 1] + [0] * (settings.PATIENT_WRITE_RETRIES + 1)
+
+    entries = [entry() for _ in patients]
+    await uploader.write_lab_slips({p['patient_id']: [(e, slip(p, '2021-03-05T10:00:00'))]
+                                    for p, e in zip(patients, entries)}, cipher)
+
+    assert [e['status'] for e in entries] == ['test_added', 'failed']
+    assert [len(ops) for ops in patient_store['bulk_writes']] == [2] + [1] * (settings.PATIENT_WRITE_RETRIES + 2)
+
+
+@pytest.mark.asyncio
+async def test_bulk_write_patients_WRITE_ERRORS_ARE_UNMATCHED(monkeypatch):
+    class Collection:
+        async def bulk_write(self, operations, ordered=True):
+            raise BulkWriteError({'nMatched': 1, 'writeErrors': [{'index': 1, 'errmsg': 'too large'}]})
+
+    async def get_patient_collection():
+        return None, None, Collection()
+
+    monkeypatch.setattr(patient_db, 'get_patient_collection', get_patient_collection)
+    assert await patient_db.bulk_write_patients(['op', 'op']) == 1
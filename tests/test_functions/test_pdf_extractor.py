@@ -1,6 +1,7 @@
 import pytest
 from pydantic import ValidationError
 
+from app.models.patient.patient import RandomPatient
 from app.utils.pdfs import pdf_extractor
 
 import tests
@@ -57,3 +58,26 @@ async def test_extract_patients(lab_form_path):
     else:
         with pytest.raises(ValidationError):
             await proc(lab_form_path)
+
+
+def test_parse_lab_slips_REPORTS_unparseable():
+    from tests.helpers.lab_forms import lab_form_pdf
+    fields = RandomPatient(n_tests=1).to_form_fields()
+    parsed = pdf_extractor.parse_lab_slips([b'not a pdf', lab_form_pdf(fields), lab_form_pdf(dict(fields, last_name=''))])
+    assert parsed[0] == {'error': 'unparseable'}
+    assert parsed[1]['patient']['last_name'] == fields['last_name'].upper()
+    assert parsed[2]['error'] == 'invalid'
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_form_backends_EQUIVALENT(seed):
+    from tests.helpers.lab_forms import lab_form_pdf
+    fields = RandomPatient(n_tests=1).to_form_fields()
+    fields.update({'consent': True, 'opt_out': False, 'dob_day': '', 'city': ' '})
+    pdf = lab_form_pdf(fields, n_extra_fields=20)
+
+    pypdf2, pymupdf = [pdf_extractor.PDFExtractor(pdf, backend=b) for b in ('pypdf2', 'pymupdf')]
+    assert pypdf2.extract(fields=list(pypdf2.fields)) == pymupdf.extract(fields=list(pypdf2.fields))
+    assert pypdf2.extract_patient() == pymupdf.extract_patient()
+    assert pypdf2.extract_address() == pymupdf.extract_address()
+    assert pypdf2.extract_test() == pymupdf.extract_test()
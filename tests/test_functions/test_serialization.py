@@ -0,0 +1,55 @@
+from datetime import datetime, timezone
+
+import dill
+
+from app.database import serialization
+
+
+def test_round_trip_SCALARS():
+    for value in ['hello', '', 'ünïcödé', 0, 1, -1, 2 ** 70, -(2 ** 70), 1.5, -0.0,
+                  True, False, None, b'\x00bytes', datetime(2021, 6, 1, 12, 30),
+                  datetime(2021, 6, 1, 12, 30, tzinfo=timezone.utc)]:
+        encoded = serialization.dumps(value)
+        assert encoded[:1] == serialization.FORMAT_TAG
+        decoded = serialization.loads(encoded)
+        assert decoded == value
+        assert type(decoded) is type(value)
+
+
+def test_round_trip_NESTED(json_for_crypto):
+    assert serialization.loads(serialization.dumps(json_for_crypto)) == json_for_crypto
+
+
+def test_smaller_than_dill(json_for_crypto):
+    assert len(serialization.dumps(json_for_crypto)) < len(dill.dumps(json_for_crypto))
+    assert len(serialization.dumps('TEST_SMITH')) < len(dill.dumps('TEST_SMITH'))
+
+
+def test_legacy_dill_values_decode(json_for_crypto):
+    assert serialization.loads(dill.dumps(json_for_crypto)) == json_for_crypto
+
+
+def test_unsupported_types_fall_back_to_dill():
+    value = {'a': (1, 2), 'b': {1, 2}}
+    encoded = serialization.dumps(value)
+    assert encoded[:1] != serialization.FORMAT_TAG
+    assert serialization.loads(encoded) == value
+
+
+def test_round_trip_CONTAINERS():
+    many = [f'value {i}' for i in range(300)]
+    for value in [{}, [], {'a': [], 'b': {}}, [None, True, False, 0, 255, 256, 65536, -1, -(2 ** 31), 2 ** 31,
+                                              2 ** 70, -(2 ** 2100), 1.5, b'\x00', b'x' * 300, 'ü' * 200],
+                  {'repeated': many + many, 'long': 'x' * 70000}]:
+        encoded = serialization.dumps(value)
+        assert encoded[:1] == serialization.OPCODE_TAG
+        decoded = serialization.loads(encoded)
+        assert decoded == value
+        assert [type(i) for i in decoded] == [type(i) for i in value]
+
+
+def test_containers_with_datetimes_USE_TAGGED_ENCODING():
+    value = {'when': datetime(2021, 6, 1, 12, 30), 'tests': [{'positive': 'NEGATIVE'}]}
+    encoded = serialization.dumps(value)
+    assert encoded[:1] == serialization.FORMAT_TAG
+    assert serialization.loads(encoded) == value
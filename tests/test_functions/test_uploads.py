@@ -0,0 +1,44 @@
+import pytest
+
+from app.database import uploads
+from tests.helpers.mongo import AsyncCollection
+
+
+@pytest.fixture
+def ledger(monkeypatch):
+    collection = AsyncCollection('uploads')
+
+    async def get_upload_collection():
+        return collection
+
+    monkeypatch.setattr(uploads, 'get_upload_collection', get_upload_collection)
+    return collection
+
+
+@pytest.mark.asyncio
+async def test_record_upload_FAILURES_ARE_NOT_RECORDED(ledger):
+    await uploads.record_upload('lab:a', 'invalid', 'Patient data could not be extracted from lab file.')
+    await uploads.record_uploads([('lab:b', 'unparseable', 'Could not be parsed.', None),
+                                  ('lab:c', 'failed', 'Patient is being modified concurrently.', 'h1'),
+                                  ('lab:d', 'added', 'Patient added to database.', 'h1')])
+
+    assert await uploads.find_upload('lab:a') is None
+    assert ledger.collection.distinct('_id') == ['lab:d']
+
+
+@pytest.mark.asyncio
+async def test_record_upload_FIRST_OUTCOME_IS_KEPT(ledger):
+    await uploads.record_upload('lab:a', 'added', 'Patient added to database.', 'h1')
+    await uploads.record_upload('lab:a', 'duplicate', 'This lab slip was already uploaded.', 'h1')
+
+    assert (await uploads.find_upload('lab:a'))['status'] == 'added'
+
+
+@pytest.mark.asyncio
+async def test_forget_uploads_BY_PID_HASH(ledger):
+    await uploads.record_uploads([('lab:a', 'added', 'Patient added to database.', 'h1'),
+                                  ('lab:b', 'test_added', 'Test data added to existing patient.', 'h1'),
+                                  ('lab:c', 'added', 'Patient added to database.', 'h2')])
+
+    assert await uploads.forget_uploads('h1') == 2
+    assert ledger.collection.distinct('_id') == ['lab:c']
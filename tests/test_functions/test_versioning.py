@@ -0,0 +1,51 @@
+import pytest
+
+import app.database.patient as patient_db
+from app.database.patient import mutate_patient, document_version, WriteConflict
+
+
+@pytest.fixture
+def versioned_store(monkeypatch):
+    '''A single in-memory patient, whose version another writer bumps on every read.'''
+    store = {'pid_hash': 'abc123', 'version': 1}
+
+    async def retrieve_patient(pid_hash):
+        document = dict(store)
+        store['version'] += 1
+        return document
+
+    monkeypatch.setattr(patient_db, 'retrieve_patient', retrieve_patient)
+    return store
+
+
+@pytest.mark.asyncio
+async def test_mutate_patient_RETRIES_on_conflict(versioned_store):
+    seen = []
+
+    async def mutation(document):
+        seen.append(document_version(document))
+        # Lose the first two races.
+        return len(seen) == 3 and 'written'
+
+    assert await mutate_patient('abc123', mutation, retries=5) == 'written'
+    assert seen == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_mutate_patient_GIVES_UP(versioned_store):
+    async def mutation(document):
+        return False
+
+    with pytest.raises(WriteConflict):
+        await mutate_patient('abc123', mutation, retries=2)
+    assert versioned_store['version'] == 4
+
+
+@pytest.mark.asyncio
+async def test_mutate_patient_MISSING(monkeypatch):
+    async def retrieve_patient(pid_hash):
+        return None
+
+    monkeypatch.setattr(patient_db, 'retrieve_patient', retrieve_patient)
+    assert await mutate_patient('nope', lambda d: None) is None
+    assert document_version({'pid_hash': 'legacy'}) == 0
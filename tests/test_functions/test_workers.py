@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+import pytest
+
+from app.core.config import settings
+from app.utils.workers import (
+    run_document_job,
+    shutdown_process_pool,
+    DocumentJobError,
+    DocumentPoolBusy,
+    DocumentJobTimeout
+)
+
+
+@pytest.fixture
+def document_pool(monkeypatch):
+    monkeypatch.setattr(settings, 'DOCUMENT_POOL_WORKERS', 1)
+    monkeypatch.setattr(settings, 'DOCUMENT_MAX_JOBS', 1)
+    shutdown_process_pool()
+    yield
+    shutdown_process_pool()
+
+
+@pytest.mark.asyncio
+async def test_run_document_job(document_pool):
+    assert await run_document_job(divmod, 7, 2) == (3, 1)
+
+
+@pytest.mark.asyncio
+async def test_run_document_job_TIMEOUT(document_pool):
+    with pytest.raises(DocumentJobTimeout):
+        await run_document_job(time.sleep, 1, timeout=0.1)
+
+
+@pytest.mark.asyncio
+async def test_run_document_job_BUSY(document_pool):
+    busy = asyncio.ensure_future(run_document_job(time.sleep, 0.5))
+    await asyncio.sleep(0)
+    with pytest.raises(DocumentPoolBusy):
+        await run_document_job(divmod, 7, 2, admission_timeout=0.05)
+    await busy
+    # The slot is free again once the job is done.
+    assert await run_document_job(divmod, 7, 2, admission_timeout=0.05) == (3, 1)
+
+
+@pytest.mark.asyncio
+async def test_run_document_job_HUNG_JOB_RELEASES_SLOT(document_pool):
+    with pytest.raises(DocumentJobTimeout):
+        await run_document_job(time.sleep, 60, timeout=0.1)
+    # The hung worker is killed rather than waited for: its slot comes back right away.
+    assert await run_document_job(divmod, 7, 2, admission_timeout=5) == (3, 1)
+
+
+@pytest.mark.asyncio
+async def test_run_document_job_RECYCLED_POOL(document_pool, monkeypatch):
+    monkeypatch.setattr(settings, 'DOCUMENT_MAX_JOBS', 2)
+    shutdown_process_pool()
+    hung = asyncio.ensure_future(run_document_job(time.sleep, 60, timeout=0.2))
+    await asyncio.sleep(0)
+    # Waits for the single worker, behind the hung job, on the pool that gets recycled.
+    queued = asyncio.ensure_future(run_document_job(divmod, 7, 2, timeout=5))
+    with pytest.raises(DocumentJobTimeout):
+        await hung
+    with pytest.raises(DocumentJobError):
+        await queued